@@ -3,10 +3,17 @@ from mnms import utils
 import numpy as np
 from scipy import ndimage
 
+from concurrent import futures
+
 
 def smooth_ps_grid_uniform(ps, res, zero_dc=True, diag=False, shape=None, rfft=False,
-                        fill=False, fill_lmax=None, fill_lmax_est_width=None, fill_value=None, **kwargs):
-    """Smooth a 2d power spectrum to the target resolution in l.
+                        fill=False, fill_lmax=None, fill_lmax_est_width=None, fill_value=None,
+                        nthread=1, **kwargs):
+    """Smooth a 2d power spectrum to the target resolution in l. 
+    
+    ps may be a stack of power spectra (..., ny, nx) with the same geometry, 
+    in which case each is filled and smoothed on its own, concurrently over 
+    nthread threads (if 0, use output of utils.get_cpu_count()).
     """
     # first fill any values beyond max lmax
     if fill:
@@ -25,17 +32,39 @@ def smooth_ps_grid_uniform(ps, res, zero_dc=True, diag=False, shape=None, rfft=F
     smooth = np.round(np.abs(res/ires)).astype(int)
     # We now know how many pixels to somoth by in each direction,
     # so perform the actual smoothing
-    if rfft:
-        # the y-direction needs a 'wrap' boundary and the x-direction
-        # needs a 'reflect' boundary. this is because the enmap rfft 
-        # convention cuts half the x-domain, so we don't have two-sided
-        # kx=0 data, but we do have two-sided ky=0 data. this is better 
-        # than the transpose, because it tends to be that the scan is
-        # up-down, making features stick out more along the x-axis than y
-        ps = ndimage.uniform_filter1d(ps, size=smooth[-2], axis=-2, mode='wrap')
-        ps = ndimage.uniform_filter1d(ps, size=smooth[-1], axis=-1, mode='reflect')
+    def _smooth(ps):
+        if rfft:
+            # the y-direction needs a 'wrap' boundary and the x-direction
+            # needs a 'reflect' boundary. this is because the enmap rfft 
+            # convention cuts half the x-domain, so we don't have two-sided
+            # kx=0 data, but we do have two-sided ky=0 data. this is better 
+            # than the transpose, because it tends to be that the scan is
+            # up-down, making features stick out more along the x-axis than y
+            ps = ndimage.uniform_filter1d(ps, size=smooth[-2], axis=-2, mode='wrap')
+            ps = ndimage.uniform_filter1d(ps, size=smooth[-1], axis=-1, mode='reflect')
+        else:
+            ps = ndimage.uniform_filter(ps, size=smooth, mode='wrap')
+        return ps
+
+    if ps.ndim == 2:
+        ps = _smooth(ps)
     else:
-        ps = ndimage.uniform_filter(ps, size=smooth, mode='wrap')
+        # filter each 2d power spectrum of the stack concurrently
+        out = np.empty(ps.shape, dtype=ps.dtype)
+        _ps = ps.reshape(-1, *ps.shape[-2:])
+        _out = out.reshape(-1, *ps.shape[-2:])
+
+        if nthread == 0:
+            nthread = utils.get_cpu_count()
+        executor = futures.ThreadPoolExecutor(max_workers=nthread)
+
+        def _fill(i):
+            _out[i] = _smooth(_ps[i])
+
+        fs = [executor.submit(_fill, i) for i in range(len(_ps))]
+        for f in fs:
+            f.result()
+        ps = out
     if zero_dc: ps[..., 0,0] = 0
     if diag: assert np.all(ps>=0), 'If diag output ps must be positive semi-definite'
     return ps
@@ -53,11 +82,19 @@ def fill_boundary(ps, shape=None, rfft=False, fill_lmax=None, fill_lmax_est_widt
     assert fill_lmax_est_width > 0 or fill_value is not None, 'Must supply at least fill_lmax_est_width or fill_value'
     if fill_lmax_est_width > 0 and fill_value is None:
         fill_value = get_avg_value_by_ring(ps, modlmap, fill_lmax - fill_lmax_est_width, fill_lmax)
-    ps[fill_lmax <= modlmap] = fill_value
+    ps[..., fill_lmax <= modlmap] = np.asarray(fill_value)[..., None]
 
 def get_avg_value_by_ring(ps, modlmap, ell0, ell1):
+    """Average ps over the ring ell0 <= modlmap < ell1, for each 2d power
+    spectrum in the stack ps (..., ny, nx)."""
     ring_mask = np.logical_and(ell0 <= modlmap, modlmap < ell1)
-    return ps[ring_mask].mean()
+    ring = ps[..., ring_mask]
+
+    # a reduction over the last axis of a stack rounds differently than
+    # over each 1d array, so average them one at a time
+    return np.array(
+        [r.mean() for r in ring.reshape(-1, ring.shape[-1])], dtype=ring.dtype
+        ).reshape(ring.shape[:-1])
 
 log_smooth_corrections = [ 1.0, # dummy for 0 dof
  3.559160, 1.780533, 1.445805, 1.310360, 1.237424, 1.192256, 1.161176, 1.139016,
@@ -1,5 +1,5 @@
 from pixell import enmap
-from mnms import utils
+from mnms import utils, smallmat, telemetry
 from optweight import wlm_utils
 
 import numpy as np 
@@ -9,14 +9,37 @@ import astropy.io.fits as pyfits
 import astropy.wcs as pywcs
 import h5py
 
+from collections.abc import Mapping
+import threading
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent import futures
+
 
 FWHM_FACT_0 = 2
 
+# kernels with fewer real-space pixels than this are transformed many at a
+# time, each with a single-threaded FFT; larger kernels are transformed one
+# at a time with a multithreaded FFT
+MIN_THREADED_KERNEL_SIZE = 256**2
+
+# bump this whenever a change to the code changes the kernels, so that 
+# kernels cached by get_cached_fdw_kernels are rebuilt
+KERNEL_CACHE_VERSION = 2
+
+# the ways of taking the square root of the covariance in get_fdw_noise_covsqrt.
+# the method is recorded in the 'sqrt_method' attribute of the model file (and
+# of SqrtCovWavs), from which sims know how to multiply by the square root. 
+# files without it hold symmetric square roots
+SQRT_METHODS = ('eigpow', 'cholesky')
+
 class FDWKernels:
 
     def __init__(self, lamb, lmax, lmin, lmax_j, n, p, shape, wcs,
                  dtype=np.float32, nforw=None, nback=None, pforw=None, 
-                 pback=None):
+                 pback=None, skip_empty=False):
         """A set of Fourier directional wavelets, allowing users to
         analyze maps by simultaneous scale-, direction-, and location-dependence
         of information. Also supports map synthesis. The wavelet transform (both
@@ -77,10 +100,15 @@ class FDWKernels:
             None. For example, if p is 4 but pback is [1, 2], then the highest-
             ell kernel have a locality paramater of 1, and the next highest-
             ell kernel will have a locality parameter of 2, and 4 thereafter. 
+        skip_empty : bool, optional
+            Leave out kernels without any Fourier modes in this geometry, by
+            default False, in which case they raise an AssertionError. Small
+            geometries cannot resolve the largest-scale kernels. The remaining
+            kernels keep their (radial index, azimuthal index) keys.
         """
         self._kf = KernelFactory(lamb, lmax, lmin, lmax_j, n, p, shape, wcs,
                                  dtype=dtype, nforw=nforw, nback=nback, 
-                                 pforw=pforw, pback=pback)
+                                 pforw=pforw, pback=pback, skip_empty=skip_empty)
         self._shape = shape
         self._real_shape = (shape[-2], shape[-1]//2 + 1)
         self._wcs = wcs
@@ -95,12 +123,115 @@ class FDWKernels:
             _n = self._kf._ns[i]
             for j in range(_n+1):
                 kern = self._kf.get_kernel(i, j)
+                if kern is None:
+                    continue
                 self._kernels[i, j] = kern
                 self._lmaxs[i, j] = self._kf._lmaxs[i]
                 self._ns[i, j] = self._kf._ns[i]
                 self._mean_sqs[i, j] = np.mean(abs(kern._k_kernel)**2)
 
-    def k2wav(self, kmap, nthread=0):
+    def write(self, fname):
+        """Write the kernels to an HDF5 file, from which they can be loaded
+        with FDWKernels.read without being rebuilt. Only the support of each
+        kernel is written.
+
+        Parameters
+        ----------
+        fname : path-like
+            Destination on-disk for file.
+        """
+        kern_keys = list(self._kernels)
+        sels = [
+            [[[sl.start, sl.stop, sl.step] for sl in sel[1:]] for sel in self._kernels[k]._sels]
+            for k in kern_keys
+            ]
+        # the wcs written with each dataset are rounded, so also keep the exact
+        # pixelization, which sets e.g. the smoothing scale in pixels
+        wcs_params = [_get_wcs_params(self._kernels[k]._wcs) for k in kern_keys]
+        wcs_params.append(_get_wcs_params(self._wcs))
+        extra_attrs = dict(
+            kern_keys=json.dumps(kern_keys),
+            sels=json.dumps(sels, default=int),
+            wcs_params=json.dumps(wcs_params),
+            lmaxs=json.dumps([self._lmaxs[k] for k in kern_keys], default=int),
+            ns=json.dumps([self._ns[k] for k in kern_keys], default=int),
+            shape=json.dumps(self._shape, default=int),
+            dtype=np.dtype(self._cdtype).str,
+            kern_shapes=json.dumps([self._kernels[k]._shape for k in kern_keys], default=int),
+            sel_counts=json.dumps([self._kernels[k]._sel_counts for k in kern_keys])
+            )
+        extra_datasets = dict(
+            mean_sqs=np.array([self._mean_sqs[k] for k in kern_keys]),
+            geometry=enmap.zeros((0, 0), self._wcs),
+            supports=np.concatenate([self._kernels[k]._support for k in kern_keys])
+            )
+        write_wavs(
+            fname, 
+            {k: enmap.ndmap(self._kernels[k]._k_values, self._kernels[k]._wcs) for k in kern_keys},
+            extra_attrs=extra_attrs, extra_datasets=extra_datasets
+            )
+
+    @classmethod
+    def read(cls, fname, mmap=True):
+        """Load kernels written by FDWKernels.write.
+
+        Parameters
+        ----------
+        fname : path-like
+            Location on-disk for file.
+        mmap : bool, optional
+            Memory-map the kernels rather than reading them into memory, by
+            default True.
+
+        Returns
+        -------
+        FDWKernels
+            The kernels, identical to those that were written.
+        """
+        wavs, extra_attrs, extra_datasets = read_wavs(
+            fname, 
+            extra_attrs=[
+                'kern_keys', 'sels', 'wcs_params', 'lmaxs', 'ns', 'shape', 'dtype',
+                'kern_shapes', 'sel_counts'
+                ],
+            extra_datasets=['mean_sqs', 'geometry', 'supports'], mmap=mmap
+            )
+        kern_keys = [tuple(k) for k in json.loads(extra_attrs['kern_keys'])]
+        sels = json.loads(extra_attrs['sels'])
+        wcs_params = json.loads(extra_attrs['wcs_params'])
+        lmaxs = json.loads(extra_attrs['lmaxs'])
+        ns = json.loads(extra_attrs['ns'])
+        mean_sqs = extra_datasets['mean_sqs']
+        kern_shapes = json.loads(extra_attrs['kern_shapes'])
+        sel_counts = json.loads(extra_attrs['sel_counts'])
+        supports = extra_datasets['supports']
+
+        # skip __init__, which builds the kernels
+        fdw_kernels = cls.__new__(cls)
+        fdw_kernels._shape = tuple(json.loads(extra_attrs['shape']))
+        fdw_kernels._real_shape = (fdw_kernels._shape[-2], fdw_kernels._shape[-1]//2 + 1)
+        fdw_kernels._wcs = _set_wcs_params(extra_datasets['geometry'].wcs, wcs_params[-1])
+        fdw_kernels._cdtype = np.dtype(extra_attrs['dtype'])
+
+        fdw_kernels._kernels = {}
+        fdw_kernels._lmaxs = {}
+        fdw_kernels._ns = {}
+        fdw_kernels._mean_sqs = {}
+        start = 0
+        for i, k in enumerate(kern_keys):
+            _sels = [(Ellipsis, *[slice(*sl) for sl in sel]) for sel in sels[i]]
+            stop = start + sum(sel_counts[i])
+            fdw_kernels._kernels[k] = Kernel.from_support(
+                supports[start:stop], np.asarray(wavs[k]), sel_counts[i], kern_shapes[i],
+                _set_wcs_params(wavs[k].wcs, wcs_params[i]), index=k, sels=_sels
+                )
+            start = stop
+            fdw_kernels._lmaxs[k] = lmaxs[i]
+            fdw_kernels._ns[k] = ns[i]
+            fdw_kernels._mean_sqs[k] = mean_sqs[i]
+        return fdw_kernels
+
+    def k2wav(self, kmap, kern_keys=None, nthread=0):
         """Analyze a real DFT of a map, producing a set of wavelet-
         convolved maps in real space.
 
@@ -108,6 +239,9 @@ class FDWKernels:
         ----------
         kmap : (..., nky, nkx) array-like
             Real DFT of a map to be analyzed.
+        kern_keys : iterable, optional
+            Only analyze these kernels, by default None. If None, analyze all
+            kernels.
         nthread : int, optional
             Number of threads to use in multithreaded FFTs, by default 0. If
             0, use all cpu cores available. Optimal efficiency may be less 
@@ -119,10 +253,34 @@ class FDWKernels:
             Wavelet map dictionary, indexed by (radial index, azimuthal index)
             tuple.
         """
-        wavs = {}
-        for kern_key, kernel in self._kernels.items():
-            wavs[kern_key] = kernel.k2wav(kmap, from_full=True, nthread=nthread)
-        return wavs
+        return dict(self.iter_k2wav(kmap, kern_keys=kern_keys, nthread=nthread))
+
+    def iter_k2wav(self, kmap, kern_keys=None, nthread=0):
+        """Analyze a real DFT of a map, yielding the wavelet-convolved map of 
+        each kernel in turn. Only a few wavelet maps are held at once: small
+        kernels are analyzed concurrently a little ahead of the consumer.
+
+        Parameters
+        ----------
+        kmap : (..., nky, nkx) array-like
+            Real DFT of a map to be analyzed.
+        kern_keys : iterable, optional
+            Only analyze these kernels, by default None. If None, analyze all
+            kernels.
+        nthread : int, optional
+            Number of concurrent threads, by default 0. If 0, the result
+            of mnms.utils.get_cpu_count().
+
+        Yields
+        ------
+        tuple
+            The (radial index, azimuthal index) of each kernel in kern_keys
+            order, and its wavelet map.
+        """
+        def k2wav(kernel, nthread):
+            with telemetry.span('k2wav', kernel=kernel.index):
+                return kernel.k2wav(kmap, from_full=True, nthread=nthread)
+        yield from self._map_kernels(k2wav, kern_keys=kern_keys, nthread=nthread)
 
     def wav2k(self, wavs, nthread=0):
         """Synthesize a set of wavelet-convolved maps in real space, to
@@ -155,16 +313,61 @@ class FDWKernels:
             oshape, wcs=self._wcs, dtype=self._cdtype
             )
 
-        # extract each kernel and insert
-        for kern_key, kernel in self._kernels.items():
+        for kern_key in self._kernels:
             wav = wavs[kern_key]
             assert wav.shape[:-2] == preshape, \
                 f'wav {kern_key} preshape is {wav.shape[:-2]}, expected {preshape}'
-            kmap_wav = kernel.wav2k(wav, nthread=nthread)
-            for sel in kernel._sels:
-                kmap[sel] += kmap_wav[sel]
+
+        # transform the wavelet maps concurrently, but insert them into
+        # kmap one at a time in kernel order, so that the sum is the same
+        # as if done serially
+        def wav2k(kernel, nthread):
+            return kernel.wav2k(wavs[kernel.index], support_only=True, nthread=nthread)
+        for kern_key, kmap_wav in self._map_kernels(wav2k, nthread=nthread):
+            self._kernels[kern_key].add_support(kmap, kmap_wav)
         return kmap
 
+    def _map_kernels(self, func, kern_keys=None, nthread=0):
+        """Yield func(kernel, nthread) for each kernel, in kern_keys order.
+        Kernels smaller than MIN_THREADED_KERNEL_SIZE are evaluated 
+        concurrently, with nthread=1 each. Larger kernels are evaluated in 
+        the calling thread with all nthread. At most 2*nthread results are
+        held at once.
+        """
+        if kern_keys is None:
+            kern_keys = self._kernels.keys()
+        nthread = utils.get_cpu_count() if nthread == 0 else nthread
+
+        if nthread == 1:
+            for kern_key in kern_keys:
+                yield kern_key, func(self._kernels[kern_key], 1)
+            return
+
+        # pending holds futures of small kernels, and the results of large 
+        # ones, in kern_keys order
+        pending = deque()
+        def pop():
+            kern_key, res = pending.popleft()
+            return kern_key, res.result() if isinstance(res, futures.Future) else res
+
+        with futures.ThreadPoolExecutor(max_workers=nthread) as executor:
+            for kern_key in kern_keys:
+                kernel = self._kernels[kern_key]
+                if kernel.size < MIN_THREADED_KERNEL_SIZE:
+                    pending.append((kern_key, executor.submit(func, kernel, 1)))
+                else:
+                    # let the small kernels ahead of this one finish first,
+                    # so they don't compete with its threads
+                    while pending:
+                        yield pop()
+                    pending.append((kern_key, func(kernel, nthread)))
+
+                while len(pending) > 2*nthread:
+                    yield pop()
+
+            while pending:
+                yield pop()
+
     @property
     def kernels(self):
         """The wavelet kernels in Fourier space.
@@ -253,8 +456,6 @@ class Kernel:
             If sels is not an iterable.
         """
         assert k_kernel.ndim == 2, f'k_kernel must have 2 dims, got{k_kernel.ndim}'
-        self._k_kernel = k_kernel
-        self._k_kernel_conj = np.conj(k_kernel)
         self._index = index
 
         # assume odd nx in orig map (very important)! in principle, we
@@ -275,14 +476,14 @@ class Kernel:
         self._sels = sels
 
         # check that selection tuples touch each element exactly once
-        test_arr = np.zeros(self._k_kernel.shape, dtype=int)
+        test_arr = np.zeros(k_kernel.shape, dtype=int)
         for sel in self._sels:
             test_arr[sel] += 1
         assert np.all(test_arr == 1), \
             'Selection tuples do not cover each kernel element exactly once'
-        
+
         # check that kernel is compatible with rfft.
-        # (a) only the symmetry of the first column excl. the first item 
+        # (a) only the symmetry of the first column excl. the first item
         # matters for odd self._n
         # (b) the below thresholds seemed to work for common kernel sets
         if k_kernel.shape[-2] > 2:
@@ -295,6 +496,103 @@ class Kernel:
                 f'Kernel {index} does not correspond to real fft:\n' + \
                 f'mean rel_diff={np.mean(rel_diff)}, expected < 5e-6'
 
+        # directional kernels are mostly zero within their box, so only
+        # keep the nonzero elements and their flat indices in the box,
+        # ordered by selection tuple. the conjugate kernel is formed on
+        # the fly
+        self._shape = k_kernel.shape
+        self._wcs = k_kernel.wcs
+        box_idxs = np.arange(np.prod(self._shape)).reshape(self._shape)
+        supports = []
+        values = []
+        for sel in self._sels:
+            _k_kernel = np.asarray(k_kernel[sel]).reshape(-1)
+            nonzero = np.flatnonzero(_k_kernel)
+            supports.append(box_idxs[sel].reshape(-1)[nonzero])
+            values.append(_k_kernel[nonzero])
+        self._set_support(
+            np.concatenate(supports), np.concatenate(values), [len(s) for s in supports]
+            )
+
+    @classmethod
+    def from_support(cls, support, values, sel_counts, shape, wcs, index=None,
+                     sels=None):
+        """Build a Kernel directly from its nonzero elements, as stored by a
+        Kernel instance, without any checks.
+
+        Parameters
+        ----------
+        support : (nsupport,) np.ndarray
+            The flat indices of the nonzero elements within the kernel,
+            ordered by selection tuple.
+        values : (nsupport,) np.ndarray
+            The complex values of the nonzero elements.
+        sel_counts : iterable of int
+            The number of nonzero elements within each selection tuple.
+        shape : (nky, nkx) tuple
+            The shape of the kernel.
+        wcs : astropy.wcs.WCS
+            The wcs of the kernel.
+        index : any
+            Any value to name this Kernel.
+        sels : iterable of (Ellipsis, [slice,]) iterables, optional
+            Selection tuples for the multiresolution partitioning, by
+            default None. If None, set to [(Ellipsis,)].
+
+        Returns
+        -------
+        Kernel
+            The kernel.
+        """
+        kernel = cls.__new__(cls)
+        kernel._index = index
+        kernel._n = 2*(shape[-1]-1) + 1
+        kernel._sels = [(Ellipsis,)] if sels is None else sels
+        kernel._shape = tuple(shape)
+        kernel._wcs = wcs
+        kernel._set_support(support, values, sel_counts)
+        return kernel
+
+    def _set_support(self, support, values, sel_counts):
+        assert len(support) == len(values) == sum(sel_counts), \
+            f'Kernel {self._index} support, values, and sel_counts do not match'
+        self._support = np.asarray(support, dtype=np.intp)
+        self._k_values = values
+        self._sel_counts = [int(c) for c in sel_counts]
+
+        # flat indices of the support within full-sized real DFTs, by shape
+        self._full_supports = {}
+
+    def _get_full_support(self, full_shape):
+        """Return the flat indices of the support within a real DFT of shape
+        full_shape[-2:], in the same order as the stored support"""
+        full_shape = tuple(full_shape[-2:])
+        full_support = self._full_supports.get(full_shape)
+        if full_support is not None:
+            return full_support
+
+        full_support = []
+        start = 0
+        for sel, count in zip(self._sels, self._sel_counts):
+            rows, cols = np.divmod(self._support[start:start + count], self._shape[-1])
+            start += count
+
+            # each selection tuple extracts the same number of rows and
+            # cols from the kernel and from the full-sized real DFT
+            sel = (*sel[1:], slice(None), slice(None))[:2]
+            box_rows, full_rows = np.arange(self._shape[0])[sel[0]], np.arange(full_shape[0])[sel[0]]
+            box_cols, full_cols = np.arange(self._shape[1])[sel[1]], np.arange(full_shape[1])[sel[1]]
+            assert len(box_rows) == len(full_rows) and len(box_cols) == len(full_cols), \
+                f'Kernel {self._index} selection tuple {sel} is incompatible with shape {full_shape}'
+            full_support.append(
+                full_rows[np.searchsorted(box_rows, rows)] * full_shape[1] + \
+                    full_cols[np.searchsorted(box_cols, cols)]
+                )
+        full_support = np.concatenate(full_support)
+
+        self._full_supports[full_shape] = full_support
+        return full_support
+
     def k2wav(self, kmap, use_kernel_wcs=True, inplace=True, from_full=True, nthread=0):
         """Generate the wavelet map for this kernel from a real DFT of a map. 
         This is achieved by convolving the real DFT with the kernel.
@@ -323,30 +621,32 @@ class Kernel:
         (..., ny, nx) enmap.ndmap
             The wavelet map.
         """
+        preshape = kmap.shape[:-2]
         if from_full:
-            _shape = (*kmap.shape[:-2], *self._k_kernel.shape)
-            _kmap = np.empty(_shape, dtype=kmap.dtype)
-
-            # need to do this because _kmap, _k_kernel are small res
+            # need to do this because _kmap, the kernel are small res
             # but kmap is not
-            for sel in self._sels:
-                _kmap[sel] = self._k_kernel[sel] * kmap[sel]
+            full_support = self._get_full_support(kmap.shape)
+            _kmap = np.zeros((*preshape, *self._shape), dtype=kmap.dtype)
+            _kmap.reshape(*preshape, -1)[..., self._support] = \
+                self._k_values * kmap.reshape(*preshape, -1)[..., full_support]
             kmap = _kmap
         else:
+            assert kmap.shape[-2:] == self._shape, \
+                f'kmap must have same shape[-2:] as k_kernel, got\n' + \
+                f'{kmap.shape} and {self._shape}'
             if not inplace:
                 kmap = kmap.copy()
-            kmap *= self._k_kernel
-
-        assert kmap.shape[-2:] == self._k_kernel.shape, \
-            f'kmap must have same shape[-2:] as k_kernel, got\n' + \
-            f'{kmap.shape} and {self._k_kernel.shape}'
+            rows, cols = np.divmod(self._support, self._shape[-1])
+            values = self._k_values * kmap[..., rows, cols]
+            kmap[...] = 0
+            kmap[..., rows, cols] = values
 
         # destroys kmap buffer
         wmap = utils.irfft(kmap, n=self._n, normalize='backward', nthread=nthread) 
-        wcs = self._k_kernel.wcs if use_kernel_wcs else kmap.wcs
+        wcs = self._wcs if use_kernel_wcs else kmap.wcs
         return enmap.ndmap(wmap, wcs)
 
-    def wav2k(self, wmap, use_kernel_wcs=True, nthread=0):
+    def wav2k(self, wmap, use_kernel_wcs=True, support_only=False, nthread=0):
         """Generate the real DFT of a wavelet map for this kernel. This is 
         achieved by convolving the real DFT of the wavelet map with the
         complex conjugate of this kernel.
@@ -358,6 +658,10 @@ class Kernel:
         use_kernel_wcs : bool, optional
             The real DFT will have the wcs information of the kernel, rather
             than of wmap, by default True.
+        support_only : bool, optional
+            Only return the real DFT where the kernel is nonzero, in the order
+            of the kernel support, by default False. Add these to a full-sized
+            real DFT with add_support.
         nthread : int, optional
             Number of threads to use in multithreaded FFTs, by default 0. If
             0, use all cpu cores available. Optimal efficiency may be less 
@@ -365,32 +669,67 @@ class Kernel:
 
         Returns
         -------
-        kmap : (..., nky, nkx) enmap.ndmap
+        kmap : (..., nky, nkx) enmap.ndmap or (..., nsupport) np.ndarray
             Real DFT of a map to be analyzed.
         """
-        assert wmap.shape[-2] == self._k_kernel.shape[-2], \
+        assert wmap.shape[-2] == self._shape[-2], \
             f'wmap must have same shape[-2] as k_kernel, got\n' + \
-            f'{wmap.shape[-2]} and {self._k_kernel.shape[-2]}'
-        assert wmap.shape[-1]//2+1 == self._k_kernel.shape[-1], \
+            f'{wmap.shape[-2]} and {self._shape[-2]}'
+        assert wmap.shape[-1]//2+1 == self._shape[-1], \
             f'wmap must have same shape[-1]//2+1 as k_kernel, got\n' + \
-            f'{wmap.shape[-1]//2+1} and {self._k_kernel.shape[-1]}'
+            f'{wmap.shape[-1]//2+1} and {self._shape[-1]}'
         
-        kmap = utils.rfft(wmap, normalize='backward', nthread=nthread) 
-        kmap *= self._k_kernel_conj
-        # kmap = utils.concurrent_op(np.multiply, kmap, self._k_kernel_conj, nthread=nthread)
-        # NOTE: the above actually has too much overhead, slower
-        wcs = self._k_kernel.wcs if use_kernel_wcs else wmap.wcs
-        return enmap.ndmap(kmap, wcs)
+        kmap = utils.rfft(wmap, normalize='backward', nthread=nthread)
+        preshape = kmap.shape[:-2]
+        values = kmap.reshape(*preshape, -1)[..., self._support] * np.conj(self._k_values)
+        if support_only:
+            return values
+
+        wcs = self._wcs if use_kernel_wcs else wmap.wcs
+        kmap = enmap.zeros(kmap.shape, wcs=wcs, dtype=kmap.dtype)
+        kmap.reshape(*preshape, -1)[..., self._support] = values
+        return kmap
+
+    def add_support(self, kmap, values):
+        """Add the support-only output of wav2k into a full-sized real DFT.
+
+        Parameters
+        ----------
+        kmap : (..., nky, nkx) enmap.ndmap
+            C-contiguous real DFT of a full-sized map, modified inplace.
+        values : (..., nsupport) np.ndarray
+            The output of wav2k with support_only=True.
+        """
+        assert kmap.flags['C_CONTIGUOUS'], 'kmap must be C-contiguous'
+        full_support = self._get_full_support(kmap.shape)
+        kmap.reshape(*kmap.shape[:-2], -1)[..., full_support] += values
 
     @property
     def index(self):
         return self._index
 
+    @property
+    def size(self):
+        """The number of real-space pixels of this kernel's wavelet map."""
+        return self._shape[-2] * self._n
+
+    @property
+    def _k_kernel(self):
+        """The dense (nky, nkx) kernel, formed from its support"""
+        k_kernel = enmap.zeros(self._shape, wcs=self._wcs, dtype=self._k_values.dtype)
+        k_kernel.reshape(-1)[self._support] = self._k_values
+        return k_kernel
+
+    @property
+    def _k_kernel_conj(self):
+        """The dense (nky, nkx) conjugate kernel, formed from its support"""
+        return np.conj(self._k_kernel)
+
 class KernelFactory:
 
     def __init__(self, lamb, lmax, lmin, lmax_j, n, p, shape, wcs,
                  dtype=np.float32, nforw=None, nback=None, pforw=None,
-                 pback=None):
+                 pback=None, skip_empty=False):
         """A helper class to build Kernel objects.
 
         Parameters
@@ -444,6 +783,10 @@ class KernelFactory:
             None. For example, if p is 4 but pback is [1, 2], then the highest-
             ell kernel have a locality paramater of 1, and the next highest-
             ell kernel will have a locality parameter of 2, and 4 thereafter. 
+        skip_empty : bool, optional
+            If a kernel has no Fourier modes in this geometry, get_kernel
+            returns None instead of raising an AssertionError, by default 
+            False.
 
         Notes
         -----
@@ -506,6 +849,7 @@ class KernelFactory:
         # in one go, we are going to get rad funcs, rad_kerns (sliced), 
         # the slice/selection tuples (function of rad kern only), and 
         # kernel shapes
+        self._skip_empty = skip_empty
         self._rad_funcs = []
         self._sels = []
         self._rad_kerns = []
@@ -516,6 +860,11 @@ class KernelFactory:
             # interp1d returns as np.float64 always, need to cast
             unsliced_rad_kern = rad_func(modlmap).astype(modlmap.dtype)
 
+            if skip_empty and not unsliced_rad_kern.any():
+                self._sels.append(None)
+                self._rad_kerns.append(None)
+                continue
+
             kern_shape, sels = self._get_sliced_shape_and_sels(
                 unsliced_rad_kern, idx=i
                 )
@@ -709,10 +1058,13 @@ class KernelFactory:
         Returns
         -------
         Kernel
-            A Kernel class instance.
+            A Kernel class instance, or None if skip_empty and the kernel
+            has no Fourier modes.
         """
         rad_kern = self._rad_kerns[rad_idx]
         sels = self._sels[rad_idx]
+        if rad_kern is None:
+            return None
 
         # get a sliced phimap, evaluate the az_func on it
         kern_phimap = np.empty(rad_kern.shape, self._phimap.dtype)
@@ -726,6 +1078,8 @@ class KernelFactory:
         # helps speed things up. we then slice again the individual
         # kernel
         _kern = rad_kern * az_kern
+        if self._skip_empty and not _kern.any():
+            return None
         kern_shape, sels = self._get_sliced_shape_and_sels(
             _kern, idx=(rad_idx, az_idx), unsliced_sels=sels
             )
@@ -853,10 +1207,93 @@ def get_az_func(n, p, j):
             return 1+0j
     return w_phi
 
+def _get_wcs_params(wcs):
+    """Return the cdelt, crval, and crpix of a wcs as lists of floats"""
+    return [list(map(float, getattr(wcs.wcs, k))) for k in ['cdelt', 'crval', 'crpix']]
+
+def _set_wcs_params(wcs, wcs_params):
+    """Set the cdelt, crval, and crpix of a wcs inplace, and return it"""
+    for k, v in zip(['cdelt', 'crval', 'crpix'], wcs_params):
+        setattr(wcs.wcs, k, v)
+    return wcs
+
+def get_kernels_cache_fname(cache_path, lamb, lmax, lmin, lmax_j, n, p, shape, wcs,
+                            dtype=np.float32, nforw=None, nback=None, pforw=None,
+                            pback=None, skip_empty=False):
+    """Return the filename of cached FDWKernels in directory cache_path. The
+    filename is a hash of all the arguments of FDWKernels, and 
+    KERNEL_CACHE_VERSION."""
+    params = dict(
+        version=KERNEL_CACHE_VERSION, lamb=lamb, lmax=lmax, lmin=lmin,
+        lmax_j=lmax_j, n=n, p=p, shape=list(shape), wcs=wcs.to_header_string(),
+        dtype=np.dtype(dtype).str, nforw=nforw, nback=nback, pforw=pforw,
+        pback=pback
+        )
+    # kernels built without skip_empty keep the filenames they had before it
+    if skip_empty:
+        params['skip_empty'] = True
+    key = hashlib.sha256(
+        json.dumps(params, sort_keys=True, default=int).encode()
+        ).hexdigest()[:16]
+    return os.path.join(cache_path, f'fdw_kernels_{key}.hdf5')
+
+def get_cached_fdw_kernels(cache_path, lamb, lmax, lmin, lmax_j, n, p, shape, wcs,
+                           dtype=np.float32, nforw=None, nback=None, pforw=None,
+                           pback=None, skip_empty=False, mmap=True):
+    """Return FDWKernels with the supplied arguments, loaded from a file in 
+    cache_path if they were built before. Otherwise, build them and write them
+    to cache_path for next time.
+
+    Parameters
+    ----------
+    cache_path : path-like
+        Directory of cached kernels. Created if it does not exist.
+    mmap : bool, optional
+        Memory-map kernels loaded from the cache rather than reading them 
+        into memory, by default True.
+
+    Returns
+    -------
+    FDWKernels
+        The kernels.
+
+    Notes
+    -----
+    See FDWKernels for the other arguments. The cache file is written 
+    atomically, so concurrent processes building the same kernels don't read
+    each other's partial files. If the cache file can't be written, a message
+    is printed and the built kernels are returned anyway.
+    """
+    args = (lamb, lmax, lmin, lmax_j, n, p, shape, wcs)
+    kwargs = dict(
+        dtype=dtype, nforw=nforw, nback=nback, pforw=pforw, pback=pback,
+        skip_empty=skip_empty
+        )
+    fname = get_kernels_cache_fname(cache_path, *args, **kwargs)
+
+    if is_complete(fname):
+        return FDWKernels.read(fname, mmap=mmap)
+
+    fdw_kernels = FDWKernels(*args, **kwargs)
+
+    root, ext = os.path.splitext(fname)
+    tmp_fname = f'{root}.tmp{os.getpid()}_{threading.get_ident()}{ext}'
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        fdw_kernels.write(tmp_fname)
+        os.replace(tmp_fname, fname)
+    except OSError as e:
+        print(f'Could not cache kernels to {fname}: {e}')
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+    return fdw_kernels
+
 def get_fdw_noise_covsqrt(fdw_kernels, imap, mask_obs=1, mask_est=1, 
                           fwhm_fact=2, rad_filt=True, pre_filt_downgrade=1, 
                           post_filt_downgrade=1, post_filt_downgrade_wcs=None,
-                          nthread=0, verbose=True):
+                          checkpoint_fname=None, resume=True, compression=None,
+                          quantize=None, sqrt_method='eigpow', nthread=0, verbose=True):
     """Generate square-root covariance information for the signal in imap.
     The covariance matrix is assumed to be block-diagonal in wavelet kernels,
     neglecting correlations due to their overlap. Kernels are managed by 
@@ -903,6 +1340,28 @@ def get_fdw_noise_covsqrt(fdw_kernels, imap, mask_obs=1, mask_est=1,
         kwarg exists because if imap is already downgraded, downgrading a 
         second time after filtering can erroneously result in a wcs that is 
         shifted by 360 degrees.
+    checkpoint_fname : path-like, optional
+        If provided, write the square-root covariance of each kernel to this 
+        file as soon as it is computed, by default None. Once all kernels are
+        written, the file is marked complete and holds the same products as 
+        write_wavs. Until then, read_wavs will not read it.
+    resume : bool, optional
+        If checkpoint_fname holds an incomplete checkpoint, only compute the
+        kernels not yet in it, by default True. Otherwise, start over.
+    compression : str, optional
+        Write the checkpoint with this lossless compression, by default None.
+        See write_wavs.
+    quantize : str, optional
+        Write the wavelet maps to the checkpoint with this lossy quantization,
+        by default None. See write_wavs. The returned maps are not quantized,
+        except those read back from a previous checkpoint.
+    sqrt_method : str, optional
+        How to take the square root of the covariance in each pixel, by 
+        default 'eigpow'. If 'eigpow', the symmetric square root. If 
+        'cholesky', the upper-triangular Cholesky factor, which is much 
+        faster to find for more than two components. The method is recorded
+        with the result, and in the checkpoint, so that sims are drawn 
+        accordingly. A checkpoint made with another method is started over.
     nthread : int, optional
         Number of concurrent threads, by default 0. If 0, the result
         of mnms.utils.get_cpu_count()., by default 0.
@@ -911,11 +1370,11 @@ def get_fdw_noise_covsqrt(fdw_kernels, imap, mask_obs=1, mask_est=1,
 
     Returns
     -------
-    dict, [np.ndarray]
+    SqrtCovWavs, [np.ndarray]
         A dictionary holding wavelet maps of the square-root covariance, 
-        indexed by the wavelet key (radial index, azimuthal index). If
-        rad_filt, an array of the square root power spectrum in harmonic
-        space.
+        indexed by the wavelet key (radial index, azimuthal index), and the
+        sqrt_method. If rad_filt, an array of the square root power spectrum
+        in harmonic space.
 
     Notes
     -----
@@ -923,23 +1382,51 @@ def get_fdw_noise_covsqrt(fdw_kernels, imap, mask_obs=1, mask_est=1,
     covaried against themselves. For example, if imap has axes corresponding
     to (arr, pol, y, x), the covariance will have axes corresponding to
     (arr, pol, arr, pol, y, x) in each wavelet map. This is not exactly true:
-    the preceding axes will be flattened in the output.
+    the preceding axes will be flattened in the output, and because the 
+    square-root covariance is symmetric (or upper-triangular, for 
+    sqrt_method='cholesky'), only its upper triangle is kept, flattened as
+    in utils.to_flat_triu. Each wavelet map thus has shape
+    (ncomp*(ncomp+1)/2, ny, nx), where ncomp is the size of the flattened
+    preceding axes.
     """
+    if sqrt_method not in SQRT_METHODS:
+        raise ValueError(f'sqrt_method must be one of {list(SQRT_METHODS)}, got {sqrt_method}')
+
     mask_obs = np.asanyarray(mask_obs, dtype=imap.dtype)
     mask_est = np.asanyarray(mask_est, dtype=imap.dtype)
 
     imap = utils.atleast_nd(imap, 3)
 
+    # possibly pick up from a previous, incomplete checkpoint
+    done, ckpt_ells = set(), {}
+    if checkpoint_fname is not None:
+        _check_storage(compression=compression, quantize=quantize)
+        if checkpoint_fname[-5:] != '.hdf5':
+            checkpoint_fname += '.hdf5'
+        done, ckpt_ells = _open_checkpoint(
+            checkpoint_fname, resume=resume, sqrt_method=sqrt_method
+            )
+    todo = [idx for idx in fdw_kernels.kernels if idx not in done]
+
+    if len(done) > 0 and verbose:
+        print(f'Resuming from checkpoint with {len(done)} of {len(fdw_kernels.kernels)} kernels')
+
     if rad_filt:
         # measure correlated pseudo spectra for filtering
         lmax = utils.lmax_from_wcs(imap.wcs) 
-        alm = utils.map2alm(imap * mask_est, lmax=lmax)
-        sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', 0.5, mask_est=mask_est)
-        inv_sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', -0.5, mask_est=mask_est)
-
-        imap = utils.ell_filter_correlated(
-            imap * mask_obs, 'map', inv_sqrt_cov_ell, lmax=lmax
-            )
+        if len(ckpt_ells) == len(CHECKPOINT_ELL_DATASETS):
+            sqrt_cov_ell = ckpt_ells['checkpoint_sqrt_cov_ell']
+            inv_sqrt_cov_ell = ckpt_ells['checkpoint_inv_sqrt_cov_ell']
+        else:
+            with telemetry.span('ell-filter'):
+                alm = utils.map2alm(imap * mask_est, lmax=lmax)
+                sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', 0.5, mask_est=mask_est)
+                inv_sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', -0.5, mask_est=mask_est)
+            if checkpoint_fname is not None:
+                _write_checkpoint(checkpoint_fname, extra_datasets={
+                    'checkpoint_sqrt_cov_ell': sqrt_cov_ell,
+                    'checkpoint_inv_sqrt_cov_ell': inv_sqrt_cov_ell
+                    })
 
         if post_filt_downgrade > pre_filt_downgrade:
             post_filt_rel_downgrade = post_filt_downgrade / pre_filt_downgrade
@@ -950,80 +1437,117 @@ def get_fdw_noise_covsqrt(fdw_kernels, imap, mask_obs=1, mask_est=1,
                 f'{post_filt_rel_downgrade}'
             post_filt_rel_downgrade = int(post_filt_rel_downgrade)
 
-            imap = utils.fourier_downgrade_cc_quad(imap, post_filt_rel_downgrade)
-                
-            # if imap is already downgraded, second downgrade may introduce
-            # 360-deg offset in RA, so we give option to overwrite wcs with
-            # right answer
-            if post_filt_downgrade_wcs is not None:
-                imap = enmap.ndmap(np.asarray(imap), post_filt_downgrade_wcs)
-
-            # we need to explicitly check the shape because some default fdw_kernels
-            # slicing is Ellipsis
-            assert imap.shape[-2:] == fdw_kernels.shape, \
-                f'If downgrading after filtering, result map shape must match' + \
-                f' fdw_kernels shape; got {imap.shape[-2:]} and expected {fdw_kernels.shape}'
-            
             # also need to downgrade the measured power spectra!
             sqrt_cov_ell = sqrt_cov_ell[..., :lmax//post_filt_rel_downgrade+1]
 
-        kmap = utils.rfft(imap, nthread=nthread)
-    else:
-        kmap = utils.rfft(imap * mask_obs, nthread=nthread)
-
-    if verbose:
-        print(
-            f'Map shape: {imap.shape}\n'
-            f'Num kernels: {len(fdw_kernels.kernels)}\n'
-            f'Smoothing factor: {fwhm_fact}\n'
-            f'Radial filtering: {rad_filt}'
-            )
-        
-    wavs = fdw_kernels.k2wav(kmap, nthread=nthread)
-
-    # get fwhm_fact(l) callable
-    def _fwhm_fact(l):
-        if callable(fwhm_fact):
-            return fwhm_fact(l)
-        else:
-            return fwhm_fact
-
     # get model
-    sqrt_cov_wavs = {}
-    for idx, wmap in wavs.items():
-        # get outer prod of wavelet maps with normalization factor
-        ncomp = np.prod(wmap.shape[:-2], dtype=int)
-        wmap = wmap.reshape((ncomp, *wmap.shape[-2:]))
-        wmap2 = utils.concurrent_einsum(
-            '...a, ...b -> ...ab', wmap, wmap, nthread=nthread
-            )
-        wmap2 /= fdw_kernels.mean_sqs[idx]
-        wmap2 = enmap.ndmap(wmap2, wmap.wcs)
-
-        # smooth them
-        _lmax = fdw_kernels.lmaxs[idx]
-        fwhm = _fwhm_fact(_lmax) * np.pi / _lmax
-        utils.smooth_gauss(
-            wmap2, fwhm, method='map', flatten_axes=[0, 1],
-            nthread=nthread, mode=['constant', 'wrap']
-            )
-        
-        # raise to 0.5 power. need to do some reshaping to allow use of
-        # chunked eigpow, along a flattened pixel axis
-        wmap2 = wmap2.reshape((*wmap2.shape[:-2], -1))
-
-        # sqrt much faster, but only possible for one component
-        if wmap2.shape[0] == 1:
-            wmap2 = np.sqrt(wmap2)
+    sqrt_cov_wavs = SqrtCovWavs(sqrt_method=sqrt_method)
+    if len(todo) > 0:
+        if rad_filt:
+            with telemetry.span('ell-filter'):
+                imap = utils.ell_filter_correlated(
+                    imap * mask_obs, 'map', inv_sqrt_cov_ell, lmax=lmax
+                    )
+
+            if post_filt_downgrade > pre_filt_downgrade:
+                with telemetry.span('downgrade'):
+                    imap = utils.fourier_downgrade_cc_quad(imap, post_filt_rel_downgrade)
+                    
+                # if imap is already downgraded, second downgrade may introduce
+                # 360-deg offset in RA, so we give option to overwrite wcs with
+                # right answer
+                if post_filt_downgrade_wcs is not None:
+                    imap = enmap.ndmap(np.asarray(imap), post_filt_downgrade_wcs)
+
+                # we need to explicitly check the shape because some default fdw_kernels
+                # slicing is Ellipsis
+                assert imap.shape[-2:] == fdw_kernels.shape, \
+                    f'If downgrading after filtering, result map shape must match' + \
+                    f' fdw_kernels shape; got {imap.shape[-2:]} and expected {fdw_kernels.shape}'
+
+            kmap = utils.rfft(imap, nthread=nthread)
         else:
-            utils.chunked_eigpow(
-                wmap2, 0.5, axes=[-3, -2], chunk_axis=-1
+            kmap = utils.rfft(imap * mask_obs, nthread=nthread)
+
+        if verbose:
+            print(
+                f'Map shape: {imap.shape}\n'
+                f'Num kernels: {len(todo)}\n'
+                f'Smoothing factor: {fwhm_fact}\n'
+                f'Radial filtering: {rad_filt}'
+                )
+
+        # only the kmap is needed from here on. if imap was filtered, this
+        # frees the filtered copy
+        del imap
+            
+        # get fwhm_fact(l) callable
+        def _fwhm_fact(l):
+            if callable(fwhm_fact):
+                return fwhm_fact(l)
+            else:
+                return fwhm_fact
+
+        # analyze one kernel at a time, so that only a few wavelet maps and 
+        # one covariance are in memory at once
+        for idx, wmap in fdw_kernels.iter_k2wav(kmap, kern_keys=todo, nthread=nthread):
+            # get outer prod of wavelet maps with normalization factor. the
+            # covariance is symmetric, so only keep its upper triangle
+            ncomp = np.prod(wmap.shape[:-2], dtype=int)
+            wmap = wmap.reshape((ncomp, *wmap.shape[-2:]))
+            with telemetry.span('outer-product', kernel=idx):
+                wmap2 = utils.concurrent_outer_flat_triu(wmap, nthread=nthread)
+                wmap2 /= fdw_kernels.mean_sqs[idx]
+                wmap2 = enmap.ndmap(wmap2, wmap.wcs)
+
+            # smooth them
+            _lmax = fdw_kernels.lmaxs[idx]
+            fwhm = _fwhm_fact(_lmax) * np.pi / _lmax
+            with telemetry.span('smooth', kernel=idx):
+                utils.smooth_gauss(
+                    wmap2, fwhm, method='map', flatten_axes=[0],
+                    nthread=nthread, mode=['constant', 'wrap']
+                    )
+            
+            # raise to 0.5 power, along a flattened pixel axis
+            wmap2 = wmap2.reshape((*wmap2.shape[:-2], -1))
+
+            # sqrt much faster, but only possible for one component
+            with telemetry.span('eigpow', kernel=idx):
+                if wmap2.shape[0] == 1:
+                    wmap2 = np.sqrt(wmap2)
+                elif sqrt_method == 'eigpow':
+                    smallmat.eigpow(wmap2, 0.5, nthread=nthread)
+                else:
+                    smallmat.cholesky(wmap2, nthread=nthread)
+
+            sqrt_cov_wavs[idx] = wmap2.reshape(
+                (*wmap2.shape[:-1], *wmap.shape[-2:])
                 )
 
-        sqrt_cov_wavs[idx] = wmap2.reshape(
-            (*wmap2.shape[:-1], *wmap.shape[-2:])
+            if checkpoint_fname is not None:
+                with telemetry.span('write', kernel=idx):
+                    _write_checkpoint(
+                        checkpoint_fname, wavs={idx: sqrt_cov_wavs[idx]},
+                        compression=compression, quantize=quantize
+                        )
+
+            del wmap, wmap2
+
+    if checkpoint_fname is not None:
+        _finish_checkpoint(
+            checkpoint_fname, extra_datasets={'sqrt_cov_ell': sqrt_cov_ell} if rad_filt else None,
+            compression=compression
             )
 
+        # gather the kernels computed before resuming, in kernel order
+        if len(done) > 0:
+            prev_sqrt_cov_wavs = read_wavs(checkpoint_fname)
+            sqrt_cov_wavs = SqrtCovWavs({
+                idx: sqrt_cov_wavs[idx] if idx in sqrt_cov_wavs else prev_sqrt_cov_wavs[idx]
+                for idx in fdw_kernels.kernels
+                }, sqrt_method=sqrt_method)
+
     if rad_filt:
         return sqrt_cov_wavs, sqrt_cov_ell
     else:
@@ -1040,9 +1564,16 @@ def get_fdw_noise_sim(fdw_kernels, sqrt_cov_wavs, preshape=None,
         A set of Fourier steerable anisotropic wavelets, allowing users to
         analyze/synthesize maps by simultaneous scale-, direction-, and 
         location-dependence of information.
-    sqrt_cov_wavs : dict
+    sqrt_cov_wavs : dict or LazyWavs
         A dictionary holding wavelet maps of the square-root covariance, 
-        indexed by the wavelet key (radial index, azimuthal index).
+        indexed by the wavelet key (radial index, azimuthal index). Only
+        one wavelet map is accessed at a time. Each wavelet map may be the
+        flattened upper triangle of the matrix, as returned by 
+        get_fdw_noise_covsqrt, with shape (ncomp*(ncomp+1)/2, ny, nx), or 
+        the full matrix, with shape (ncomp, ncomp, ny, nx). If its 
+        sqrt_method is 'cholesky' (see SqrtCovWavs), the flattened upper
+        triangles are the Cholesky factors R of the covariance (A = R.T @ R),
+        otherwise the symmetric square roots.
     preshape : tuple, optional
         Reshape preceding dimensions of the sim to preshape, by default None.
         Preceding dimensions are those before the last two (the pixel axes).
@@ -1063,42 +1594,296 @@ def get_fdw_noise_sim(fdw_kernels, sqrt_cov_wavs, preshape=None,
     (*preshape, ny, nx) enmap.ndmap
         The simulated draw from the supplied covariance matrix.
     """
+    return get_fdw_noise_sims(
+        fdw_kernels, sqrt_cov_wavs, [seed], preshape=preshape,
+        sqrt_cov_ell=sqrt_cov_ell, nthread=nthread, verbose=verbose
+        )[0]
+
+def get_fdw_noise_sims(fdw_kernels, sqrt_cov_wavs, seeds, preshape=None,
+                       sqrt_cov_ell=None, nthread=0, verbose=True):
+    """Draw a stack of Guassian realizations from the covariance corresponding
+    to the square-root covariance wavelet maps in sqrt_cov_wavs, one for each
+    seed in seeds. The draws of all the realizations are multiplied by each
+    square-root covariance wavelet map in one batched operation.
+
+    Parameters
+    ----------
+    fdw_kernels : FDWKernels
+        A set of Fourier steerable anisotropic wavelets, allowing users to
+        analyze/synthesize maps by simultaneous scale-, direction-, and 
+        location-dependence of information.
+    sqrt_cov_wavs : dict or LazyWavs
+        A dictionary holding wavelet maps of the square-root covariance, 
+        indexed by the wavelet key (radial index, azimuthal index). Only
+        one wavelet map is accessed at a time. Each wavelet map may be the
+        flattened upper triangle of the matrix, as returned by 
+        get_fdw_noise_covsqrt, with shape (ncomp*(ncomp+1)/2, ny, nx), or 
+        the full matrix, with shape (ncomp, ncomp, ny, nx). If its 
+        sqrt_method is 'cholesky' (see SqrtCovWavs), the flattened upper
+        triangles are the Cholesky factors R of the covariance (A = R.T @ R),
+        otherwise the symmetric square roots.
+    seeds : iterable of iterable of ints
+        Seeds for the random draws, one per realization. 
+    preshape : tuple, optional
+        Reshape preceding dimensions of each sim to preshape, by default None.
+        Preceding dimensions are those before the last two (the pixel axes).
+    sqrt_cov_ell : np.ndarray, optional
+        An array of the square root power spectrum in harmonic space,
+        by default None. If provided, will be used to filter the sims in
+        harmonic space before returning. 
+    nthread : int, optional
+        Number of concurrent threads, by default 0. If 0, the result
+        of mnms.utils.get_cpu_count()., by default 0.
+    verbose : bool, optional
+        Print possibly helpful messages, by default True.
+
+    Returns
+    -------
+    (nsims, *preshape, ny, nx) enmap.ndmap
+        The simulated draws from the supplied covariance matrix. Each draw
+        is identical to the output of get_fdw_noise_sim for the same seed.
+
+    Notes
+    -----
+    Only the draws and the square-root covariance multiplication are batched.
+    The FFT backends vectorize over the transforms in a batch, which changes
+    the rounding of a transform depending on its position in the batch, so 
+    each realization is still synthesized on its own.
+
+    The sims are synthesized one kernel at a time: the draws of a kernel are
+    made, multiplied by its square-root covariance, transformed, and added 
+    into the Fourier transform of each sim before the next kernel is 
+    visited. Thus, only a few kernels' draws are in memory at once.
+    """
+    nsims = len(seeds)
+    triangular = get_sqrt_method(sqrt_cov_wavs) == 'cholesky'
     if verbose:
         print(
+            f'Num sims: {nsims}\n'
             f'Num kernels: {len(fdw_kernels.kernels)}\n'
             f'Radial filtering: {sqrt_cov_ell is not None}\n'
-            f'Seed: {seed}'
+            f'Seeds: {seeds}'
             )
 
-    wavs_sim = {}
-    for idx, wmap in sqrt_cov_wavs.items():
-        if seed is not None:
-            wseed = list(seed) + list(idx)
+    def synth(kernel, nthread):
+        # draw this kernel's part of each sim and return their real DFTs
+        idx = kernel.index
+        wmap = sqrt_cov_wavs[idx]
+        if wmap.ndim == 3:
+            ncomp = utils.triangular_idx(wmap.shape[0])
         else:
-            wseed = seed
-        wmap_sim = utils.concurrent_normal(
-            size=wmap.shape[1:], seed=wseed, dtype=wmap.dtype, nthread=nthread
-            )
-        wmap_sim = utils.concurrent_einsum(
-            '...ab, ...b -> ...a', wmap, wmap_sim, nthread=nthread)
-        wavs_sim[idx] = wmap_sim
+            ncomp = wmap.shape[0]
+        wmap_sim = np.empty((nsims, ncomp, *wmap.shape[-2:]), dtype=wmap.dtype)
+        for i, seed in enumerate(seeds):
+            if seed is not None:
+                wseed = list(seed) + list(idx)
+            else:
+                wseed = seed
+            with telemetry.span('draw', kernel=idx):
+                wmap_sim[i] = utils.concurrent_normal(
+                    size=wmap_sim.shape[1:], seed=wseed, dtype=wmap.dtype, nthread=nthread
+                    )
+        with telemetry.span('synth', kernel=idx):
+            if wmap.ndim == 3:
+                # the flattened upper triangles are never expanded
+                wmap_sim = utils.symv_flat_triu(
+                    np.asarray(wmap), wmap_sim, triangular=triangular, nthread=nthread
+                    )
+            else:
+                # a full Cholesky factor R is applied as R.T
+                subscripts = '...ba, ...sb -> ...sa' if triangular else '...ab, ...sb -> ...sa'
+                wmap_sim = utils.concurrent_einsum(
+                    subscripts, wmap, wmap_sim, nthread=nthread)
+            return [
+                kernel.wav2k(wmap_sim[i], support_only=True, nthread=nthread) for i in range(nsims)
+                ]
+
+    # accumulate the kernels into each sim in kernel order, as in 
+    # FDWKernels.wav2k
+    kmaps = None
+    for idx, kmap_wavs in fdw_kernels._map_kernels(synth, nthread=nthread):
+        if kmaps is None:
+            kmaps = [
+                enmap.zeros(
+                    (*kmap_wavs[0].shape[:-1], *fdw_kernels._real_shape),
+                    wcs=fdw_kernels.wcs, dtype=fdw_kernels._cdtype
+                    ) for i in range(nsims)
+                ]
+        for i in range(nsims):
+            fdw_kernels.kernels[idx].add_support(kmaps[i], kmap_wavs[i])
+        del kmap_wavs
+
+    omaps = []
+    for i in range(nsims):
+        with telemetry.span('synth'):
+            # irfft destroys the kmap, so drop our reference to it
+            kmap, kmaps[i] = kmaps[i], None
+            if preshape is not None:
+                kmap = kmap.reshape((*preshape, *kmap.shape[-2:]))
+
+            omap = utils.irfft(kmap, n=fdw_kernels.shape[-1], nthread=nthread)
+            
+        # filter kmap in harmonic space
+        if sqrt_cov_ell is not None:
+            lmax = sqrt_cov_ell.shape[-1] - 1
+            with telemetry.span('ell-filter'):
+                omap = utils.ell_filter_correlated(omap, 'map', sqrt_cov_ell, lmax=lmax)
+
+        omaps.append(omap)
+
+    return enmap.samewcs(np.array(omaps), omaps[0])
 
-    kmap = fdw_kernels.wav2k(wavs_sim, nthread=nthread)
-    if preshape is not None:
-        kmap = kmap.reshape((*preshape, *kmap.shape[-2:]))
-    preshape = kmap.shape[:-2]
+def get_roi_sqrt_cov_wavs(fdw_kernels, sqrt_cov_wavs, roi_kernels, order=1):
+    """Resample square-root covariance wavelet maps onto the kernels of a 
+    region of interest (ROI), such that sims of the ROI can be drawn with
+    get_fdw_noise_sims(roi_kernels, ...) without any full-map transforms.
 
-    omap = utils.irfft(kmap, n=fdw_kernels.shape[-1], nthread=nthread)
+    Parameters
+    ----------
+    fdw_kernels : FDWKernels
+        The kernels of the full map, with which sqrt_cov_wavs were measured.
+    sqrt_cov_wavs : dict or LazyWavs
+        The square-root covariance wavelet maps, see get_fdw_noise_sims. Only
+        the region of each map covering the ROI is accessed.
+    roi_kernels : FDWKernels
+        The kernels of the ROI, with the same parameters as fdw_kernels but 
+        the ROI geometry, built with skip_empty=True.
+    order : int, optional
+        The order of the spline interpolation, by default 1.
+
+    Returns
+    -------
+    SqrtCovWavs
+        The resampled wavelet maps, indexed by the keys of roi_kernels, with 
+        the sqrt_method of sqrt_cov_wavs.
+
+    Notes
+    -----
+    The sqrt-covariance of a kernel scales as 1/sqrt(npix) of its wavelet 
+    map, so the resampled maps are scaled by the square root of the ratio of
+    the full to the ROI wavelet map sizes. Sims of the ROI then have the same
+    local power as the full sims at scales the ROI resolves, but no power at
+    scales larger than the ROI (the kernels skipped by roi_kernels). The ROI
+    sims are periodic, so they should be drawn in a padded ROI and cropped.
+    """
+    out = SqrtCovWavs(sqrt_method=get_sqrt_method(sqrt_cov_wavs))
+    for idx, roi_kernel in roi_kernels.kernels.items():
+        kernel = fdw_kernels.kernels[idx]
+        wshape = (kernel._shape[0], kernel._n)
+        oshape = (roi_kernel._shape[0], roi_kernel._n)
         
-    # filter kmap in harmonic space
-    if sqrt_cov_ell is not None:
-        lmax = sqrt_cov_ell.shape[-1] - 1
-        omap = utils.ell_filter_correlated(omap, 'map', sqrt_cov_ell, lmax=lmax)
+        # only read the pixels covering the ROI, with a margin for the
+        # interpolation
+        corners = enmap.corners(oshape, roi_kernel._wcs, corner=True)
+        pix = enmap.sky2pix(wshape, kernel._wcs, corners.T)
+        pb = np.array([np.floor(pix.min(axis=1)), np.ceil(pix.max(axis=1)) + 1], dtype=int)
+        pb = np.clip(pb + [[-order-1], [order+1]], 0, wshape)
+        _, wcs = utils.slice_geometry_by_pixbox(wshape, kernel._wcs, pb)
+        wmap = sqrt_cov_wavs[idx][..., pb[0, 0]:pb[1, 0], pb[0, 1]:pb[1, 1]]
+        wmap = enmap.ndmap(np.asarray(wmap), wcs)
+
+        omap = enmap.project(
+            wmap, (*wmap.shape[:-2], *oshape), roi_kernel._wcs, order=order, 
+            mode='nearest'
+            )
+        omap *= np.sqrt(kernel.size / roi_kernel.size)
+        out[idx] = omap.astype(wmap.dtype, copy=False)
+    return out
+
+# datasets written to a checkpoint of get_fdw_noise_covsqrt to avoid 
+# remeasuring the power spectra when resuming. they are deleted when the
+# checkpoint is complete.
+CHECKPOINT_ELL_DATASETS = ('checkpoint_sqrt_cov_ell', 'checkpoint_inv_sqrt_cov_ell')
+
+def _open_checkpoint(fname, resume=True, sqrt_method='eigpow'):
+    """Prepare fname to hold a checkpoint of get_fdw_noise_covsqrt. If resume 
+    and fname holds an incomplete checkpoint with the same sqrt_method, return
+    the wavelet keys and a dict of the CHECKPOINT_ELL_DATASETS already in it. 
+    Otherwise, (re)create an empty, incomplete file recording sqrt_method and 
+    return an empty set and dict"""
+    if resume:
+        try:
+            with h5py.File(fname, 'r') as hfile:
+                if not hfile.attrs.get('complete', True) and \
+                    hfile.attrs.get('sqrt_method', 'eigpow') == sqrt_method:
+                    done = set(
+                        _get_wav_key(dname) for dname in hfile.keys() 
+                        if _get_wav_key(dname) is not None
+                        )
+                    ells = {
+                        dname: hfile[dname][()] for dname in CHECKPOINT_ELL_DATASETS
+                        if dname in hfile
+                        }
+                    return done, ells
+        except OSError: # missing or unreadable
+            pass
 
-    return omap
+    with h5py.File(fname, 'w') as hfile:
+        hfile.attrs['complete'] = False
+        hfile.attrs['sqrt_method'] = sqrt_method
+    return set(), {}
+
+def _write_checkpoint(fname, wavs=None, extra_datasets=None, compression=None,
+                      quantize=None):
+    """Add wavelet maps and extra datasets to the checkpoint file fname. The 
+    file is closed after each write so that completed kernels survive a crash.
+    Only the wavelet maps are quantized"""
+    with h5py.File(fname, 'a') as hfile:
+        if wavs is not None:
+            for kern_key, wmap in wavs.items():
+                _write_wav_dataset(
+                    hfile, _get_wav_dname(kern_key), wmap, compression=compression,
+                    quantize=quantize
+                    )
+        
+        if extra_datasets is not None:
+            for ekey, emap in extra_datasets.items():
+                _write_wav_dataset(hfile, ekey, emap, compression=compression)
+
+def _finish_checkpoint(fname, extra_datasets=None, compression=None):
+    """Add the final extra datasets to the checkpoint file fname, delete the
+    CHECKPOINT_ELL_DATASETS, and mark it complete"""
+    _write_checkpoint(fname, extra_datasets=extra_datasets, compression=compression)
+    with h5py.File(fname, 'a') as hfile:
+        for dname in CHECKPOINT_ELL_DATASETS:
+            if dname in hfile:
+                del hfile[dname]
+        hfile.attrs['complete'] = True
+
+def is_complete(fname):
+    """Return whether fname is a readable file written by write_wavs, or a
+    checkpoint of get_fdw_noise_covsqrt that has been completed"""
+    if fname[-5:] != '.hdf5':
+        fname += '.hdf5'
+    try:
+        with h5py.File(fname, 'r') as hfile:
+            # files from before checkpointing have no 'complete' attr
+            return bool(hfile.attrs.get('complete', True))
+    except OSError:
+        return False
+
+# lossless HDF5 filters for write_wavs. each is preceded by the byte-shuffle
+# filter, which groups the bytes of each float by significance, so that the
+# smooth high bytes compress well
+H5_COMPRESSION = ('gzip', 'lzf')
+
+# attributes of a quantized dataset, see utils.quantize
+QUANTIZE_ATTRS = ('quantize', 'quantize_dtype', 'quantize_scale', 'quantize_max_abs_err')
+
+def _check_storage(compression=None, quantize=None):
+    """Raise a ValueError if compression or quantize is not supported"""
+    if compression is not None and compression not in H5_COMPRESSION:
+        raise ValueError(
+            f'compression must be None or one of {list(H5_COMPRESSION)}, got {compression}'
+            )
+    if quantize is not None and quantize not in utils.QUANTIZE_DTYPES:
+        raise ValueError(
+            f'quantize must be None or one of {list(utils.QUANTIZE_DTYPES)}, got {quantize}'
+            )
 
 # follows pixell.enmap.write_hdf recipe for writing wcs information
-def write_wavs(fname, wavs, extra_attrs=None, extra_datasets=None):
+def write_wavs(fname, wavs, extra_attrs=None, extra_datasets=None,
+               compression=None, quantize=None):
     """Write wavelets and auxiliary information to disk.
 
     Parameters
@@ -1114,29 +1899,46 @@ def write_wavs(fname, wavs, extra_attrs=None, extra_datasets=None):
     extra_datasets : dict, optional
         A dictionary holding additional numpy arrays or enmap ndmaps, by
         default None.
+    compression : str, optional
+        Write chunked datasets with this lossless filter, one of 
+        H5_COMPRESSION, by default None (contiguous and uncompressed).
+    quantize : str, optional
+        Store the wavelet maps (but not the extra datasets) with this lossy
+        quantization, one of utils.QUANTIZE_DTYPES, by default None. Each map
+        is scaled separately along all but its last two axes.
 
     Notes
     -----
-    Will overwrite a file at fname if it already exists.
+    Will overwrite a file at fname if it already exists. The file's 'complete'
+    attribute is only set to True once everything is written; read_wavs
+    raises an OSError for incomplete files.
+
+    If wavs records a sqrt_method (a SqrtCovWavs, or a LazyWavs of a file
+    with one), it is written to the file's 'sqrt_method' attribute, and read
+    back by read_wavs.
+
+    read_wavs reads compressed and quantized files transparently. The maximum
+    absolute error of each quantized map is recorded in its dataset's 
+    'quantize_max_abs_err' attribute.
     """
     if fname[-5:] != '.hdf5':
         fname += '.hdf5'
+    _check_storage(compression=compression, quantize=quantize)
 
     with h5py.File(fname, 'w') as hfile:
+        
+        # a file interrupted while writing stays marked as incomplete
+        hfile.attrs['complete'] = False
 
-        for kern_key, wmap in wavs.items():
-            
-            # if kern_key is singleton (not tuple)
-            try:
-                dname = '_'.join([str(i) for i in kern_key])
-            except TypeError:
-                dname = '_'.join([str(kern_key)])
-            
-            wset = hfile.create_dataset(dname, data=np.asarray(wmap))
+        sqrt_method = getattr(wavs, 'sqrt_method', None)
+        if sqrt_method is not None:
+            hfile.attrs['sqrt_method'] = sqrt_method
 
-            if hasattr(wmap, 'wcs'):
-                for k, v in wmap.wcs.to_header().items():
-                    wset.attrs[k] = v
+        for kern_key, wmap in wavs.items():
+            _write_wav_dataset(
+                hfile, _get_wav_dname(kern_key), wmap, compression=compression,
+                quantize=quantize
+                )
 
         if extra_attrs is not None:
             for k, v in extra_attrs.items():
@@ -1144,14 +1946,46 @@ def write_wavs(fname, wavs, extra_attrs=None, extra_datasets=None):
 
         if extra_datasets is not None:
             for ekey, emap in extra_datasets.items():
-                eset = hfile.create_dataset(ekey, data=np.asarray(emap))
+                _write_wav_dataset(hfile, ekey, emap, compression=compression)
+
+        hfile.attrs['complete'] = True
+
+def _get_wav_dname(kern_key):
+    """Return the dataset name of a wavelet key"""
+    # if kern_key is singleton (not tuple)
+    try:
+        return '_'.join([str(i) for i in kern_key])
+    except TypeError:
+        return '_'.join([str(kern_key)])
+
+def _write_wav_dataset(hfile, dname, imap, compression=None, quantize=None):
+    """Write an array to dataset dname of the open HDF5 file hfile, including 
+    wcs information if it is an ndmap. If compression, write it chunked with
+    that filter. If quantize, write it quantized with a scale for each map
+    along all but the last two axes"""
+    data = np.asarray(imap)
+    if quantize is not None:
+        data, scale, max_abs_err = utils.quantize(data, quantize, axes=(-2, -1))
+
+    if compression is None:
+        iset = hfile.create_dataset(dname, data=data)
+    else:
+        iset = hfile.create_dataset(
+            dname, data=data, chunks=True, compression=compression, shuffle=True
+            )
+
+    if quantize is not None:
+        iset.attrs['quantize'] = quantize
+        iset.attrs['quantize_dtype'] = np.dtype(imap.dtype).str
+        iset.attrs['quantize_scale'] = scale
+        iset.attrs['quantize_max_abs_err'] = max_abs_err
 
-                if hasattr(emap, 'wcs'):
-                    for k, v in emap.wcs.to_header().items():
-                        eset.attrs[k] = v
+    if hasattr(imap, 'wcs'):
+        for k, v in imap.wcs.to_header().items():
+            iset.attrs[k] = v
 
 # follows pixell.enmap.read_hdf recipe for reading wcs information
-def read_wavs(fname, extra_attrs=None, extra_datasets=None):
+def read_wavs(fname, extra_attrs=None, extra_datasets=None, lazy=False, mmap=False):
     """Read wavelets and auxiliary information from disk.
 
     Parameters
@@ -1164,12 +1998,21 @@ def read_wavs(fname, extra_attrs=None, extra_datasets=None):
     extra_datasets : iterable, optional
         List of additional numpy arrays or enmap ndmaps expected to be stored
         in the file, by default None.
+    lazy : bool, optional
+        If True, return the wavelet maps as a LazyWavs mapping backed by the
+        open file, which only reads a wavelet map when it is accessed, by 
+        default False. Extra datasets are always read immediately.
+    mmap : bool, optional
+        If True, return read-only memory-mapped views of wavelet maps that are
+        stored uncompressed and contiguously in the file, by default False. 
+        Other wavelet maps are read into memory as usual.
 
     Returns
     -------
-    dict, [dict], [dict]
+    dict or SqrtCovWavs or LazyWavs, [dict], [dict]
         Always returns a dictionary  of wavelet maps, indexed by the wavelet 
-        key (radial index, azimuthal index). If extra_attrs supplied, 
+        key (radial index, azimuthal index). If the file records a 
+        sqrt_method, and not lazy, this is a SqrtCovWavs with that method. If extra_attrs supplied, 
         also returns a dictionary with keys given by the supplied arguments. If
         extra_datasets supplied, also returns a dictionary with keys given by 
         the supplied arguments. If both extra_attrs and extra_datasets supplied,
@@ -1178,47 +2021,38 @@ def read_wavs(fname, extra_attrs=None, extra_datasets=None):
     """
     if fname[-5:] != '.hdf5':
         fname += '.hdf5'
+
+    if not is_complete(fname):
+        # let h5py raise if the file is missing or unreadable
+        with h5py.File(fname, 'r'):
+            pass
+        raise OSError(f'{fname} is an incomplete checkpoint')
     
+    if lazy:
+        wavs = LazyWavs(fname, mmap=mmap)
+
     with h5py.File(fname, 'r') as hfile:
 
-        wavs = {}
+        if not lazy and 'sqrt_method' in hfile.attrs:
+            wavs = SqrtCovWavs(sqrt_method=hfile.attrs['sqrt_method'])
+        elif not lazy:
+            wavs = {}
+
         extra_datasets_dict = {}
         for ikey, iset in hfile.items():
+            wav_key = _get_wav_key(ikey)
 
-            imap = np.empty(iset.shape, iset.dtype)
-            iset.read_direct(imap)
-                
-            # get possible wcs information
-            if len(iset.attrs) > 0:
-                header = pyfits.Header()
-                for k, v in iset.attrs.items():
-                    header[k] = v
-                wcs = pywcs.WCS(header)
-                imap = enmap.ndmap(imap, wcs)
-
-            try: # look for numeric style key
-                ikey = tuple([int(i) for i in ikey.split('_')])
-                if len(ikey) == 1:
-                    ikey = ikey[0]
-                wavs[ikey] = imap
-            except ValueError: # otherwise it's extra
-                ikey = str(ikey)
-                extra_datasets_dict[ikey] = imap
+            if wav_key is not None:
+                if not lazy:
+                    wavs[wav_key] = _read_wav_dataset(fname, iset, mmap=mmap)
+            elif extra_datasets is not None and ikey in extra_datasets:
+                extra_datasets_dict[str(ikey)] = _read_wav_dataset(fname, iset)
 
         extra_attrs_dict = {}
         if extra_attrs is not None:
             for k in extra_attrs:
                 extra_attrs_dict[k] = hfile.attrs[k]
 
-        # any extra maps will have already been loaded into extra_datasets_dict
-        # so, if not requested, need to delete them out
-        if extra_datasets is None:
-            extra_datasets = {}
-        # get copy of keys so can delete while iterating
-        for k in list(extra_datasets_dict.keys()):
-            if k not in extra_datasets:
-                del extra_datasets_dict[k]
-
     # return
     if extra_attrs_dict == {} and extra_datasets_dict == {}:
         return wavs
@@ -1227,4 +2061,136 @@ def read_wavs(fname, extra_attrs=None, extra_datasets=None):
     elif extra_attrs_dict == {}:
         return wavs, extra_datasets_dict
     else:
-        return wavs, extra_attrs_dict, extra_datasets_dict
\ No newline at end of file
+        return wavs, extra_attrs_dict, extra_datasets_dict
+
+def _get_wav_key(dname):
+    """Return the wavelet key of a dataset name, or None if the dataset is
+    not a wavelet map"""
+    try: # look for numeric style key
+        wav_key = tuple([int(i) for i in dname.split('_')])
+    except ValueError: # otherwise it's extra
+        return None
+    if len(wav_key) == 1:
+        wav_key = wav_key[0]
+    return wav_key
+
+def _read_wav_dataset(fname, iset, mmap=False):
+    """Read an HDF5 dataset of the file at fname into an array, or an ndmap
+    if it has wcs information. If mmap, return a read-only memory-mapped view
+    of the dataset if it is stored uncompressed, unquantized and contiguously"""
+    attrs = dict(iset.attrs)
+    quantize = attrs.get('quantize')
+    
+    offset = iset.id.get_offset() if mmap and quantize is None else None
+    if offset is not None and iset.chunks is None and iset.compression is None:
+        imap = np.memmap(
+            fname, dtype=iset.dtype, mode='r', offset=offset, shape=iset.shape
+            )
+    else:
+        imap = np.empty(iset.shape, iset.dtype)
+        iset.read_direct(imap)
+
+    if quantize is not None:
+        imap = utils.dequantize(imap, attrs['quantize_scale'], attrs['quantize_dtype'])
+        for k in QUANTIZE_ATTRS:
+            del attrs[k]
+        
+    # get possible wcs information
+    if len(attrs) > 0:
+        header = pyfits.Header()
+        for k, v in attrs.items():
+            header[k] = v
+        wcs = pywcs.WCS(header)
+        imap = enmap.ndmap(imap, wcs)
+    
+    return imap
+
+class SqrtCovWavs(dict):
+
+    def __init__(self, *args, sqrt_method='eigpow', **kwargs):
+        """A dictionary of square-root covariance wavelet maps, indexed by the
+        wavelet key (radial index, azimuthal index), that records how the
+        square roots were taken.
+
+        Parameters
+        ----------
+        args, kwargs : optional
+            The wavelet maps, as for dict.
+        sqrt_method : str, optional
+            The method of get_fdw_noise_covsqrt that took the square roots, by
+            default 'eigpow'. See SQRT_METHODS.
+        """
+        super().__init__(*args, **kwargs)
+        if sqrt_method not in SQRT_METHODS:
+            raise ValueError(f'sqrt_method must be one of {list(SQRT_METHODS)}, got {sqrt_method}')
+        self.sqrt_method = sqrt_method
+
+def get_sqrt_method(sqrt_cov_wavs):
+    """Return the sqrt_method of square-root covariance wavelet maps: that of
+    a SqrtCovWavs, or of the file of a LazyWavs. Anything else, like a plain 
+    dict or a file without the attribute, holds symmetric square roots."""
+    sqrt_method = getattr(sqrt_cov_wavs, 'sqrt_method', None)
+    return 'eigpow' if sqrt_method is None else sqrt_method
+
+class LazyWavs(Mapping):
+
+    def __init__(self, fname, mmap=False):
+        """A read-only mapping of wavelet maps, indexed by the wavelet key 
+        (radial index, azimuthal index), that are only read from the file when
+        accessed. Holds the file open until closed.
+
+        Parameters
+        ----------
+        fname : path-like
+            Location on-disk for file written by write_wavs.
+        mmap : bool, optional
+            If True, return read-only memory-mapped views of wavelet maps that
+            are stored uncompressed and contiguously in the file, by default False.
+
+        Notes
+        -----
+        Accessed wavelet maps are not retained by the mapping, so iterating over
+        it only holds one wavelet map in memory at a time (unless the caller
+        holds on to them).
+        """
+        self._fname = fname
+        self._mmap = mmap
+        self._hfile = h5py.File(fname, 'r')
+        self.sqrt_method = self._hfile.attrs.get('sqrt_method', None)
+        
+        self._dnames = {}
+        for dname in self._hfile.keys():
+            wav_key = _get_wav_key(dname)
+            if wav_key is not None:
+                self._dnames[wav_key] = dname
+
+    def __getitem__(self, key):
+        return _read_wav_dataset(
+            self._fname, self._hfile[self._dnames[key]], mmap=self._mmap
+            )
+
+    def __iter__(self):
+        return iter(self._dnames)
+
+    def __len__(self):
+        return len(self._dnames)
+
+    @property
+    def nbytes(self):
+        """The wavelet maps are read on access and not retained, so the
+        mapping itself holds no array memory."""
+        return 0
+
+    def close(self):
+        hfile = getattr(self, '_hfile', None)
+        if hfile:
+            hfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+from pixell import fft as enfft
+
+from collections import OrderedDict
+import numpy as np
+import pickle
+import threading
+import warnings
+
+# A process-wide cache of real FFT plans over the last two axes, keyed by
+# (shape, dtype, n, direction, nthread, engine, flags). The same kernel and
+# tile shapes are transformed many times per job, so planning (and, with
+# FFTW, allocating aligned buffers) is done once per shape. Only FFTW engines
+# have plans to reuse (see has_plans); plans of engines that plan internally
+# (ducc, numpy) only hold the geometry of the transform and, if requested, the
+# pre-allocated buffers, so callers of those engines can skip the cache.
+
+# the maximum number of plans to keep, and the maximum memory in GB of the
+# buffers they hold; the least recently used are evicted. FFTW plans hold
+# their buffers from when they are built, other plans only once the buffers
+# are first accessed. A plan whose buffers alone exceed MAX_PLAN_GB is not
+# cached
+MAX_PLANS = 128
+MAX_PLAN_GB = 1.
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+def _empty(engine, shape, dtype):
+    return enfft.engines[engine].empty_aligned(shape, dtype=dtype, n=enfft.alignment)
+
+def _is_aligned(a, alignment):
+    return a.ctypes.data % alignment == 0 and a.flags['C_CONTIGUOUS']
+
+def has_plans(engine='auto'):
+    """Return whether the pixell.fft engine has plans that can be reused on new
+    arrays, i.e. whether it is an FFTW engine."""
+    return hasattr(enfft.engines[enfft.get_engine(engine)].FFTW, 'update_arrays')
+
+class FFTPlan:
+    """A real-to-complex (or complex-to-real) FFT over the last two axes of
+    arrays of a fixed shape and dtype.
+
+    Parameters
+    ----------
+    shape : iterable of int
+        Shape of the input arrays.
+    dtype : np.dtype
+        Dtype of the input arrays. Real for a forward plan, complex for an
+        inverse plan.
+    n : int, optional
+        Number of pixels in the real-space x-direction of an inverse plan,
+        by default None. If None, assumed to be 2(nkx-1).
+    inverse : bool, optional
+        Plan the complex-to-real transform, by default False.
+    nthread : int, optional
+        The number of threads, by default 0. If 0, use pixell's default.
+    engine : str, optional
+        The pixell.fft engine, by default 'auto'.
+    flags : iterable of str, optional
+        FFTW planning flags, by default pixell.fft.default_flags.
+
+    Notes
+    -----
+    Only FFTW engines have plans to reuse: an FFTW plan is built once per 
+    thread, on the aligned buffers of this plan, and then executed on each new
+    array, so threads can transform arrays of the same shape concurrently.
+    After each call, the FFTW plan is pointed back at the buffers of this plan,
+    so it holds no references to the caller's arrays. ducc caches its own plans
+    internally, and numpy has none, so those engines are simply called.
+
+    As with pixell, the inverse transform is not normalized and may
+    overwrite its input.
+    """
+
+    def __init__(self, shape, dtype, n=None, inverse=False, nthread=0,
+                 engine='auto', flags=None):
+        self._engine = enfft.get_engine(engine)
+        self._nthread = enfft.nthread_fft if nthread == 0 else nthread
+        self._flags = enfft.default_flags if flags is None else list(flags)
+        self._inverse = inverse
+        self._axes = (-2, -1)
+
+        self._ishape = tuple(shape)
+        self._idtype = np.dtype(dtype)
+        if inverse:
+            assert np.iscomplexobj(np.empty(0, self._idtype)), \
+                'Inverse plan must have complex input'
+            self._oshape = tuple(enfft.irfft_shape(self._ishape, axes=self._axes, n=n))
+            self._odtype = np.zeros([], self._idtype).real.dtype
+            self._direction = 'FFTW_BACKWARD'
+        else:
+            self._idtype = np.result_type(self._idtype, 0.0)
+            self._oshape = tuple(enfft.rfft_shape(self._ishape, axes=self._axes))
+            self._odtype = np.result_type(self._idtype, 0j)
+            self._direction = 'FFTW_FORWARD'
+
+        self._n = self._oshape[-1] if inverse else None
+
+        self._input_array = None
+        self._output_array = None
+        self._local = threading.local()
+
+        # only FFTW plans can be rebound to new arrays. plan now, so that
+        # plans of other threads are built from the wisdom of this one
+        self._reuse = has_plans(self._engine)
+        if self._reuse:
+            self._get_engine_plan()
+
+    def _get_engine_plan(self):
+        """Return the FFTW plan of the calling thread, building it on the 
+        plan's buffers if it does not exist"""
+        plan = getattr(self._local, 'plan', None)
+        if plan is None:
+            plan = self._local.plan = enfft.engines[self._engine].FFTW(
+                self.input_array, self.output_array, flags=self._flags,
+                threads=self._nthread, axes=self._axes, direction=self._direction
+                )
+        return plan
+
+    @property
+    def input_array(self):
+        """The pre-allocated, aligned input buffer of the plan. Allocated on
+        first access."""
+        if self._input_array is None:
+            self._input_array = _empty(self._engine, self._ishape, self._idtype)
+        return self._input_array
+
+    @property
+    def output_array(self):
+        """The pre-allocated, aligned output buffer of the plan. Allocated on
+        first access."""
+        if self._output_array is None:
+            self._output_array = _empty(self._engine, self._oshape, self._odtype)
+        return self._output_array
+
+    @property
+    def nbytes(self):
+        """The memory of the buffers currently held by the plan."""
+        return sum(
+            buf.nbytes for buf in (self._input_array, self._output_array) if buf is not None
+            )
+
+    @property
+    def ishape(self):
+        return self._ishape
+
+    @property
+    def oshape(self):
+        return self._oshape
+
+    @property
+    def idtype(self):
+        return self._idtype
+
+    @property
+    def odtype(self):
+        return self._odtype
+
+    def empty_output(self):
+        """Return a new, aligned array of the output shape and dtype."""
+        return _empty(self._engine, self._oshape, self._odtype)
+
+    def __call__(self, a=None, out=None):
+        """Execute the plan.
+
+        Parameters
+        ----------
+        a : array-like, optional
+            Input of the plan's shape, by default None. If None, transform
+            the plan's input_array.
+        out : np.ndarray, optional
+            Output buffer into which result is written, by default None.
+            If None, write into the plan's output_array if a is None,
+            else into a new array.
+
+        Returns
+        -------
+        np.ndarray
+            The output array.
+        """
+        if a is None:
+            a = self.input_array
+            if out is None:
+                out = self.output_array
+        else:
+            a = np.asarray(a, dtype=self._idtype)
+            assert a.shape == self._ishape, \
+                f'Input shape {a.shape} does not match plan shape {self._ishape}'
+            if out is None:
+                out = self.empty_output()
+        assert out.shape == self._oshape and out.dtype == self._odtype, \
+            f'Output must have shape {self._oshape} and dtype {self._odtype}'
+        if out.size == 0:
+            return out
+
+        if not self._reuse:
+            if self._inverse:
+                enfft.irfft(
+                    a, out, n=self._n, nthread=self._nthread, axes=self._axes,
+                    flags=self._flags, engine=self._engine
+                    )
+            else:
+                enfft.rfft(
+                    a, out, nthread=self._nthread, axes=self._axes,
+                    flags=self._flags, engine=self._engine
+                    )
+            return out
+
+        # FFTW needs arrays aligned as the plan's buffers, and contiguous. copy
+        # into new ones rather than the plan's buffers, which may be in use by 
+        # other threads
+        plan = self._get_engine_plan()
+        _a = a
+        if not _is_aligned(a, plan.input_alignment):
+            _a = _empty(self._engine, self._ishape, self._idtype)
+            _a[...] = a
+        _out = out if _is_aligned(out, plan.output_alignment) else self.empty_output()
+
+        try:
+            plan.update_arrays(_a, _out)
+            plan.execute()
+        finally:
+            plan.update_arrays(self.input_array, self.output_array)
+
+        if _out is not out:
+            out[...] = _out
+        return out
+
+def get_plan(shape, dtype, n=None, inverse=False, nthread=0, engine='auto', flags=None):
+    """Get the cached FFTPlan for these arguments, building it if it does not
+    exist. See FFTPlan for the parameters.
+
+    Returns
+    -------
+    FFTPlan
+        The plan, shared by all callers in the process.
+    """
+    engine = enfft.get_engine(engine)
+    nthread = enfft.nthread_fft if nthread == 0 else nthread
+    flags = tuple(enfft.default_flags if flags is None else flags)
+    shape = tuple(shape)
+    if inverse and n is None:
+        n = 2 * (shape[-1] - 1)
+    elif not inverse:
+        n = None
+    key = (shape, np.dtype(dtype), n, inverse, nthread, engine, flags)
+
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is None:
+            plan = FFTPlan(
+                shape, dtype, n=n, inverse=inverse, nthread=nthread, engine=engine,
+                flags=flags
+                )
+            # do not cache plans that are too big by themselves, else evict
+            # the least recently used plans
+            if plan.nbytes <= MAX_PLAN_GB * 1e9:
+                _plans[key] = plan
+                nbytes = sum(p.nbytes for p in _plans.values())
+                while len(_plans) > MAX_PLANS or nbytes > MAX_PLAN_GB * 1e9:
+                    _, evicted = _plans.popitem(last=False)
+                    nbytes -= evicted.nbytes
+        else:
+            _plans.move_to_end(key)
+    return plan
+
+def clear_plans():
+    """Empty the plan cache, freeing the plans' buffers."""
+    with _plans_lock:
+        _plans.clear()
+
+def get_num_plans():
+    """Return the number of cached plans."""
+    return len(_plans)
+
+def get_plans_nbytes():
+    """Return the memory of the buffers held by the cached plans."""
+    with _plans_lock:
+        return sum(p.nbytes for p in _plans.values())
+
+def save_wisdom(fn):
+    """Save the accumulated FFTW wisdom of this process to disk.
+
+    Parameters
+    ----------
+    fn : path-like
+        Full filename to write.
+
+    Notes
+    -----
+    Engines other than FFTW have no wisdom, in which case an empty file
+    is written, so that load_wisdom works in any environment.
+    """
+    wisdom = {}
+    try:
+        import pyfftw
+    except ImportError:
+        pass
+    else:
+        wisdom['fftw'] = pyfftw.export_wisdom()
+    with open(fn, 'wb') as f:
+        pickle.dump(wisdom, f)
+
+def load_wisdom(fn):
+    """Load FFTW wisdom saved by save_wisdom. Plans built afterwards with
+    the same shapes and planning flags skip the planning.
+
+    Parameters
+    ----------
+    fn : path-like
+        Full filename to read.
+
+    Returns
+    -------
+    bool
+        Whether any wisdom was loaded.
+    """
+    with open(fn, 'rb') as f:
+        wisdom = pickle.load(f)
+    if 'fftw' not in wisdom:
+        return False
+    try:
+        import pyfftw
+    except ImportError:
+        warnings.warn(f'pyfftw not available, not loading the wisdom in {fn}', RuntimeWarning)
+        return False
+    return any(pyfftw.import_wisdom(wisdom['fftw']))
@@ -1,11 +1,17 @@
-from mnms import simio, tiled_ndmap, utils, soapack_utils as s_utils, tiled_noise, wav_noise, fdw_noise, inpaint
+from mnms import simio, tiled_ndmap, utils, soapack_utils as s_utils, tiled_noise, wav_noise, fdw_noise, inpaint, telemetry
 from pixell import enmap, wcsutils, sharp
-from enlib import bench
 from optweight import wavtrans, alm_c_utils
 
 import numpy as np
 
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent import futures
+from multiprocessing import shared_memory
+import multiprocessing
+import threading
+import mmap
+import pickle
 import os
 
 # expose only concrete noise models, helpful for namespace management in client
@@ -22,9 +28,223 @@ def register(registry=REGISTERED_NOISE_MODELS):
     return decorator
 
 
+# a process-wide cache of loaded noise models, shared between NoiseModel instances.
+# models are keyed by their filename, so two instances with identical parameters
+# share one model in memory.
+class ModelCache:
+
+    def __init__(self, max_gb=None):
+        """A byte-budgeted, least-recently-used cache of noise model dictionaries.
+
+        Parameters
+        ----------
+        max_gb : float, optional
+            The memory budget of the cache in GB, by default None. If None, use
+            the 'model_cache_gb' entry of the 'mnms' config block if present,
+            otherwise half of the physical memory of the node.
+
+        Notes
+        -----
+        If adding a model would exceed the budget, the least-recently-used models
+        are evicted until it fits. A model larger than the whole budget is not
+        stored, and this is only reported the first time for each key. The size
+        of a model is the sum of the nbytes of its in-memory arrays, see 
+        get_nbytes.
+        """
+        if max_gb is None:
+            max_gb = simio.config.get('model_cache_gb', None)
+        if max_gb is None:
+            max_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 / 1e9
+        self.max_gb = max_gb
+
+        self._cache = OrderedDict() # key: (nm_dict, nbytes)
+        self._nbytes = 0
+        self._lock = threading.RLock()
+        self._oversized_keys = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._cache
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
+
+    def get(self, key):
+        """Return the model under key and mark it as recently used, or None if
+        it is not in the cache"""
+        with self._lock:
+            try:
+                nm_dict, _ = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return nm_dict
+
+    def put(self, key, nm_dict):
+        """Store the model under key, evicting least-recently-used models as
+        necessary to stay within the budget. Return whether it was stored"""
+        nbytes = get_nbytes(nm_dict)
+        with self._lock:
+            if key in self._cache:
+                self.pop(key)
+
+            if nbytes > self.max_bytes:
+                if key not in self._oversized_keys:
+                    self._oversized_keys.add(key)
+                    print(f'Model of {nbytes/1e9:0.3f} GB exceeds model cache budget of ' + \
+                          f'{self.max_gb:0.3f} GB, not storing it in memory')
+                return False
+
+            while self._nbytes + nbytes > self.max_bytes:
+                evict_key, (_, evict_nbytes) = self._cache.popitem(last=False)
+                self._nbytes -= evict_nbytes
+                self.evictions += 1
+                print(f'Evicting model {evict_key} from memory')
+
+            self._cache[key] = (nm_dict, nbytes)
+            self._nbytes += nbytes
+            return True
+
+    def pop(self, key):
+        """Remove and return the model under key; raise KeyError if it is not
+        in the cache"""
+        with self._lock:
+            nm_dict, nbytes = self._cache.pop(key)
+            self._nbytes -= nbytes
+            return nm_dict
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """Return a dictionary of the cache counters and memory usage"""
+        with self._lock:
+            return dict(
+                hits=self.hits, misses=self.misses, evictions=self.evictions,
+                num_models=len(self._cache), nbytes=self._nbytes,
+                max_bytes=self.max_bytes
+            )
+
+    @property
+    def max_bytes(self):
+        return int(self.max_gb * 1e9)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+
+def get_nbytes(obj, _seen=None):
+    """Return the total nbytes of the in-memory arrays held by obj, recursing
+    into dictionaries, sequences, and object attributes. Memory-mapped arrays
+    (and views of them) are not counted, and objects that define their own
+    nbytes, such as fdw_noise.LazyWavs, are not recursed into."""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    if isinstance(obj, np.ndarray):
+        return 0 if is_memmap(obj) else obj.nbytes
+    elif hasattr(obj, 'nbytes'):
+        return obj.nbytes
+    elif isinstance(obj, dict):
+        return sum(get_nbytes(v, _seen) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(get_nbytes(v, _seen) for v in obj)
+    elif hasattr(obj, '__dict__'):
+        return sum(get_nbytes(v, _seen) for v in vars(obj).values())
+    else:
+        return 0
+
+def is_memmap(arr):
+    """Return whether arr is a memory-mapped array, or a view of one."""
+    while isinstance(arr, np.ndarray):
+        if isinstance(arr, np.memmap):
+            return True
+        arr = arr.base
+    return isinstance(arr, mmap.mmap)
+
+MODEL_CACHE = ModelCache()
+
+# sims of a pixbox (region of interest) are drawn in the pixbox padded by this 
+# many degrees on each side, and then cropped, so that the nonlocal steps of the
+# synthesis (periodic Fourier transforms, filters) don't affect the pixbox
+ROI_PAD_DEG = 3
+
+
+# helpers for building models in worker processes, see NoiseModel.get_models.
+# the input maps of the model Interface are placed in shared memory once by 
+# the parent process, and attached (not copied) by each worker process.
+INTERFACE_MAP_ATTRS = ('_mask_est', '_mask_obs')
+INTERFACE_DICT_ATTRS = ('_ivar_dict', '_cfact_dict', '_dmap_dict')
+
+_worker_noise_model = None
+_worker_shms = []
+
+def _to_shared_memory(arr):
+    """Copy arr into a new shared memory block. Return the block and a
+    picklable spec to attach to it with _from_shared_memory."""
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str, getattr(arr, 'wcs', None))
+
+def _from_shared_memory(spec):
+    """Attach to the shared memory block described by spec. Return the block 
+    and an array (or ndmap, if it had a wcs) backed by it."""
+    name, shape, dtype, wcs = spec
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if wcs is not None:
+        arr = enmap.ndmap(arr, wcs)
+    return shm, arr
+
+def _init_get_models_worker(model_bytes, specs, nthread, config):
+    """Initialize a worker process of NoiseModel.get_models with the pickled 
+    NoiseModel, the shared input maps of its model Interface, and the mnms
+    config of the parent process."""
+    global _worker_noise_model
+    os.environ['OMP_NUM_THREADS'] = str(nthread)
+    simio.config.update(config)
+
+    noise_model = pickle.loads(model_bytes)
+    inm = noise_model._model_inm
+    for (attr, key), spec in specs.items():
+        shm, arr = _from_shared_memory(spec)
+        _worker_shms.append(shm) # the array is only valid while shm is open
+        if key is None:
+            setattr(inm, attr, arr)
+        else:
+            getattr(inm, attr)[key] = arr
+    _worker_noise_model = noise_model
+
+def _get_models_worker(split_num, check_on_disk, target_gb, verbose):
+    """Build and write the model of split_num in a worker process of 
+    NoiseModel.get_models; return the model filename."""
+    noise_model = _worker_noise_model
+    noise_model.get_model(
+        split_num, check_in_memory=False, check_on_disk=check_on_disk,
+        keep_model=False, write=True, target_gb=target_gb, verbose=verbose
+        )
+    return noise_model._get_model_fn(split_num)
+
+
 # NoiseModel API and concrete NoiseModel classes. 
 class NoiseModel(ABC):
 
+    # whether _get_sim accepts a pixbox kwarg, see get_sim
+    _supports_pixbox = False
+
     def __init__(self, notes=None):
         """Base class for all NoiseModel subclasses. Supports loading raw data
         necessary for all subclasses, such as masks and ivars. Also defines
@@ -43,8 +263,19 @@ class NoiseModel(ABC):
         self._wcs = self._sim_inm.wcs
         self._dtype = self._sim_inm.dtype
 
-        # initialize unloaded noise model dictionary, holds model vars for each split
-        self._nm_dict = {}
+        # loaded noise models are held in the process-wide cache, keyed by
+        # their filename
+        self._model_cache = MODEL_CACHE
+
+    def __getstate__(self):
+        # the model cache is process-wide, so don't pickle it
+        state = self.__dict__.copy()
+        del state['_model_cache']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._model_cache = MODEL_CACHE
 
     @property
     @abstractmethod
@@ -171,7 +402,7 @@ class NoiseModel(ABC):
 
     def get_model(self, split_num, check_in_memory=True, check_on_disk=True,
                   generate=True, keep_model=False, keep_ivar=False,
-                  keep_cfact=False, keep_dmap=False, write=True,
+                  keep_cfact=False, keep_dmap=False, write=True, target_gb=2,
                   verbose=False):
         """Load or generate a sqrt-covariance matrix from this NoiseModel. 
         Will load necessary products to disk if not yet stored in instance
@@ -195,8 +426,9 @@ class NoiseModel(ABC):
             model. If False and the same occurs, raise a FileNotFoundError. By
             default True.
         keep_model : bool, optional
-            Store the loaded or generated model in the instance attributes, by 
-            default False.
+            Store the loaded or generated model in the process-wide model cache,
+            by default False. The cache is shared between instances and evicts
+            the least-recently-used models beyond its memory budget.
         keep_ivar : bool, optional
             Store the loaded, possibly downgraded, ivar in the instance
             attributes, by default False.
@@ -208,6 +440,10 @@ class NoiseModel(ABC):
             instance attributes, by default False.
         write : bool, optional
             Save a generated model to disk, by default True.
+        target_gb : float, optional
+            The approximate memory budget of the working arrays of subclasses
+            that estimate their model in batches (currently TiledNoiseModel), by
+            default 2.
         verbose : bool, optional
             Print possibly helpful messages, by default False.
 
@@ -220,8 +456,9 @@ class NoiseModel(ABC):
         inm = self._model_inm
 
         if check_in_memory:
-            if split_num in self._nm_dict:
-                return self.noise_model(split_num)
+            nm_dict = self._model_cache.get(self._get_model_fn(split_num))
+            if nm_dict is not None:
+                return nm_dict
             else:
                 pass
 
@@ -261,10 +498,19 @@ class NoiseModel(ABC):
         else:
             dmap = inm.dmap(split_num)
 
-        with bench.show(f'Generating noise model for split {split_num}'):
+        with telemetry.span(
+            'get_model', show=f'Generating noise model for split {split_num}',
+            split_num=split_num
+            ):
             # in order to have load/keep operations in abstract get_model, need
-            # to pass ivar and mask_obs here, rather than e.g. split_num
-            nm_dict = self._get_model(dmap*cfact, ivar=ivar, verbose=verbose)
+            # to pass ivar and mask_obs here, rather than e.g. split_num.
+            # subclasses may checkpoint a partial model to the model filename, 
+            # and resume from it if we were asked to look on-disk
+            fn = self._get_model_fn(split_num) if write else None
+            nm_dict = self._get_model(
+                dmap*cfact, ivar=ivar, verbose=verbose, model_fn=fn,
+                resume=check_on_disk, target_gb=target_gb
+                )
 
         if keep_model:
             self._keep_model(split_num, nm_dict)
@@ -279,11 +525,151 @@ class NoiseModel(ABC):
             inm._keep_dmap(split_num, dmap)
 
         if write:
-            fn = self._get_model_fn(split_num)
-            self._write_model(fn, **nm_dict)
+            with telemetry.span('write', split_num=split_num):
+                self._write_model(fn, **nm_dict)
 
         return nm_dict
 
+    def get_models(self, split_nums=None, nproc=1, check_on_disk=True, target_gb=2,
+                   verbose=False):
+        """Generate and write the sqrt-covariance matrices of many splits, in 
+        parallel worker processes. The masks, and any ivars, correction factors,
+        or data split differences already stored in the instance attributes, 
+        are loaded once and shared with the workers rather than copied.
+
+        Parameters
+        ----------
+        split_nums : iterable of int, optional
+            The 0-based indices of the splits to model, by default None. If None,
+            model all splits.
+        nproc : int, optional
+            The number of worker processes, by default 1. If 1, build the models
+            one-by-one in this process. Each worker uses get_cpu_count() // nproc
+            threads.
+        check_on_disk : bool, optional
+            If True, skip splits whose model already exists on-disk, by default 
+            True.
+        target_gb : float, optional
+            The approximate memory budget of the working arrays of each model
+            build, by default 2. See get_model.
+        verbose : bool, optional
+            Print possibly helpful messages, by default False.
+
+        Returns
+        -------
+        list of str
+            The model filenames of split_nums, in order.
+
+        Notes
+        -----
+        Unlike get_model, the models are not returned nor stored in memory, only
+        written to disk. Workers are started with the 'spawn' method, so each 
+        imports mnms anew.
+        """
+        inm = self._model_inm
+
+        if split_nums is None:
+            split_nums = range(inm._num_splits)
+        split_nums = list(split_nums)
+        fns = [self._get_model_fn(split_num) for split_num in split_nums]
+
+        todo = []
+        for split_num, fn in zip(split_nums, fns):
+            if check_on_disk and self._is_model_on_disk(split_num):
+                print(f'Model for split {split_num} found on-disk, skipping')
+            else:
+                todo.append(split_num)
+
+        if nproc == 1 or len(todo) <= 1:
+            for split_num in todo:
+                self.get_model(
+                    split_num, check_in_memory=False, check_on_disk=check_on_disk,
+                    write=True, target_gb=target_gb, verbose=verbose
+                    )
+            return fns
+
+        # load the masks once, here, rather than in every worker
+        if inm._mask_est is None:
+            inm._mask_est = inm.get_mask_est()
+        if inm._mask_obs is None:
+            inm._mask_obs = inm.get_mask_obs()
+
+        nproc = min(nproc, len(todo))
+        nthread = max(1, utils.get_cpu_count() // nproc)
+
+        shms = []
+        try:
+            model_bytes, specs = self._get_shared_state(todo, shms)
+
+            # the workers inherit the environment when spawned, so set the 
+            # thread count before any threaded library is imported there
+            omp_num_threads = os.environ.get('OMP_NUM_THREADS')
+            os.environ['OMP_NUM_THREADS'] = str(nthread)
+            try:
+                with futures.ProcessPoolExecutor(
+                    max_workers=nproc, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_get_models_worker,
+                    initargs=(model_bytes, specs, nthread, dict(simio.config))
+                    ) as executor:
+                    with telemetry.span(
+                        'get_models', show=f'Generating noise models for splits {todo} with {nproc} processes',
+                        split_nums=todo
+                        ):
+                        list(executor.map(
+                            _get_models_worker, todo, [check_on_disk] * len(todo),
+                            [target_gb] * len(todo), [verbose] * len(todo)
+                            ))
+            finally:
+                if omp_num_threads is None:
+                    del os.environ['OMP_NUM_THREADS']
+                else:
+                    os.environ['OMP_NUM_THREADS'] = omp_num_threads
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+        return fns
+
+    def _get_shared_state(self, split_nums, shms):
+        """Put the input maps of the model Interface for split_nums in shared
+        memory (appending the blocks to shms), and pickle this NoiseModel without
+        any Interface maps. Return the pickle and the specs of the shared maps,
+        keyed by (attribute, split_num or None)."""
+        inm = self._model_inm
+
+        specs = {}
+        for attr in INTERFACE_MAP_ATTRS:
+            arr = getattr(inm, attr)
+            if arr is not None:
+                shm, specs[(attr, None)] = _to_shared_memory(arr)
+                shms.append(shm)
+        for attr in INTERFACE_DICT_ATTRS:
+            for split_num, arr in getattr(inm, attr).items():
+                if split_num in split_nums:
+                    shm, specs[(attr, split_num)] = _to_shared_memory(arr)
+                    shms.append(shm)
+
+        # temporarily detach the maps of every Interface from the instance
+        inms = {id(inm): inm for inm in (self._model_inm, self._sim_inm)}.values()
+        detached = [
+            {attr: getattr(inm, attr) for attr in INTERFACE_MAP_ATTRS + INTERFACE_DICT_ATTRS}
+            for inm in inms
+            ]
+        try:
+            for inm in inms:
+                for attr in INTERFACE_MAP_ATTRS:
+                    setattr(inm, attr, None)
+                for attr in INTERFACE_DICT_ATTRS:
+                    setattr(inm, attr, {})
+            model_bytes = pickle.dumps(self)
+        finally:
+            for inm, attrs in zip(inms, detached):
+                for attr, val in attrs.items():
+                    setattr(inm, attr, val)
+
+        return model_bytes, specs
+
     def _check_model_on_disk(self, split_num, generate=True):
         """Check if this NoiseModel's model for a given split exists on disk. 
         If it does, return its nm_dict. Depending on the 'generate' kwarg, 
@@ -322,10 +708,11 @@ class NoiseModel(ABC):
                 raise FileNotFoundError(fn) from e
 
     def _keep_model(self, split_num, nm_dict):
-        """Store a dictionary of noise model variables in instance attributes under key split_num"""
-        if split_num not in self._nm_dict:
+        """Store a dictionary of noise model variables in the model cache under the model filename of split_num"""
+        fn = self._get_model_fn(split_num)
+        if fn not in self._model_cache:
             print(f'Storing model for split {split_num} in memory')
-            self._nm_dict[split_num] = nm_dict
+            self._model_cache.put(fn, nm_dict)
 
     def _keep_ivar(self, split_num, ivar, kind='sim'):
         """Store a dictionary of ivars in instance attributes under key split_num"""
@@ -353,10 +740,16 @@ class NoiseModel(ABC):
         return {}
 
     @abstractmethod
-    def _get_model(self, dmap, verbose=False, **kwargs):
-        """Return a dictionary of noise model variables for this NoiseModel subclass from difference map dmap"""
+    def _get_model(self, dmap, verbose=False, model_fn=None, resume=True, **kwargs):
+        """Return a dictionary of noise model variables for this NoiseModel subclass from difference map dmap.
+        If model_fn is not None, the model will be written there, so subclasses may checkpoint to it, resuming
+        from a previous checkpoint if resume"""
         return {}
 
+    def _is_model_on_disk(self, split_num):
+        """Return whether the model for split_num exists on-disk, without reading it"""
+        return os.path.isfile(self._get_model_fn(split_num))
+
     @abstractmethod
     def _write_model(self, fn, **kwargs):
         """Write a dictionary of noise model variables to filename fn"""
@@ -364,7 +757,8 @@ class NoiseModel(ABC):
 
     def get_sim(self, split_num, sim_num, alm=True, do_mask_obs=True,
                 check_on_disk=True, generate=True, keep_model=True,
-                keep_ivar=True, write=False, verbose=False):
+                keep_ivar=True, write=False, writer=None, pixbox=None,
+                verbose=False):
         """Load or generate a sim from this NoiseModel. Will load necessary
         products to disk if not yet stored in instance attributes.
 
@@ -394,14 +788,23 @@ class NoiseModel(ABC):
             sim. If False and the same occurs, raise a FileNotFoundError. By
             default True.
         keep_model : bool, optional
-            Store the loaded model for this split in instance attributes, by default True.
-            This spends memory to avoid spending time loading the model from disk
-            for each call to this method.
+            Store the loaded model for this split in the process-wide model cache, by
+            default True. This spends memory to avoid spending time loading the model
+            from disk for each call to this method.
         keep_ivar : bool, optional
             Store the loaded, possibly downgraded, ivar in the instance
             attributes, by default False.
         write : bool, optional
             Save a generated sim to disk, by default False.
+        writer : simio.SimWriter, optional
+            If write, hand the sim to this writer to be saved in the background
+            instead of writing it before returning, by default None. The returned
+            sim must not be modified until the writer is flushed.
+        pixbox : (2, 2) array-like, optional
+            Only simulate the region [[y0, x0], [y1, x1]] (in pixels) of the full
+            map, by default None. The cost of the sim then scales with the area
+            of the region rather than the full map. Requires alm=False,
+            write=False and check_on_disk=False. See Notes.
         verbose : bool, optional
             Print possibly helpful messages, by default False.
 
@@ -411,11 +814,31 @@ class NoiseModel(ABC):
             A sim of this noise model with the specified sim num, with shape
             (num_arrays, num_splits=1, num_pol, ny, nx), even if some of these
             axes have size 1. As implemented, num_splits is always 1. 
+
+        Notes
+        -----
+        A sim of a pixbox is only supported by models that can synthesize a
+        region without full-map transforms (TiledNoiseModel, FDWNoiseModel).
+        It is drawn in the pixbox padded by ROI_PAD_DEG, and then cropped. It
+        is not the crop of the full sim (see the subclass _get_sim for how the
+        two relate), so it is never loaded from a full sim on-disk: the same
+        split, sim_num and pixbox always give the same sim.
         """
         inm = self._sim_inm
 
         assert sim_num <= 9999, 'Cannot use a map index greater than 9999'
 
+        if pixbox is not None:
+            if not self._supports_pixbox:
+                raise NotImplementedError(
+                    f'{self.__class__.__name__} does not support sims of a pixbox'
+                    )
+            if alm or write or check_on_disk:
+                raise ValueError(
+                    'Sims of a pixbox must have alm=False, write=False and check_on_disk=False'
+                    )
+            pixbox = self._check_pixbox(pixbox)
+
         if check_on_disk:
             res = self._check_sim_on_disk(
                 split_num, sim_num, alm=alm, do_mask_obs=do_mask_obs, generate=generate
@@ -430,23 +853,29 @@ class NoiseModel(ABC):
             inm._mask_obs = inm.get_mask_obs()
 
         # get the model and ivar
-        if split_num not in self._nm_dict:
+        nm_dict = self._model_cache.get(self._get_model_fn(split_num))
+        if nm_dict is None:
             nm_dict = self._check_model_on_disk(split_num, generate=False)
-        else:
-            nm_dict = self.noise_model(split_num)
 
         if split_num not in inm._ivar_dict:
             ivar = inm.get_ivar(split_num, inm._mask_obs)
         else:
             ivar = inm.ivar(split_num)
         
-        with bench.show(f'Generating noise sim for split {split_num}, map {sim_num}'):
+        with telemetry.span(
+            'get_sim', show=f'Generating noise sim for split {split_num}, map {sim_num}',
+            split_num=split_num, sim_num=sim_num
+            ):
             seed = self._get_seed(split_num, sim_num)
             mask = inm._mask_obs if do_mask_obs else None
             if alm:
                 sim = self._get_sim_alm(
                     nm_dict, seed, verbose=verbose, ivar=ivar, mask=mask
                     )
+            elif pixbox is not None:
+                sim = self._get_sim_pixbox(
+                    nm_dict, seed, pixbox, verbose=verbose, ivar=ivar, mask=mask
+                    )
             else:
                 sim = self._get_sim(
                     nm_dict, seed, verbose=verbose, ivar=ivar, mask=mask
@@ -460,13 +889,251 @@ class NoiseModel(ABC):
         
         if write:
             fn = self._get_sim_fn(split_num, sim_num, alm=alm, mask_obs=do_mask_obs)
-            if alm:
-                utils.write_alm(fn, sim)
+            if writer is not None:
+                writer.submit(fn, sim, alm=alm)
             else:
-                enmap.write_map(fn, sim)
+                simio.write_sim(fn, sim, alm=alm)
 
         return sim
 
+    def _check_pixbox(self, pixbox):
+        """Return pixbox as a (2, 2) int array, checking that it is a nonempty
+        region of the sim geometry"""
+        pixbox = np.asarray(pixbox, dtype=int)
+        ny, nx = self._shape[-2:]
+        if pixbox.shape != (2, 2) or np.any(pixbox[0] < 0) or \
+            np.any(pixbox[1] > (ny, nx)) or np.any(pixbox[1] <= pixbox[0]):
+            raise ValueError(
+                f'pixbox must be [[y0, x0], [y1, x1]] within the map shape {(ny, nx)}, '
+                f'got {pixbox.tolist()}'
+                )
+        return pixbox
+
+    def _get_padded_pixbox(self, pixbox):
+        """Return pixbox padded by ROI_PAD_DEG on each side, clipped to the sim 
+        geometry"""
+        pix_deg_x, pix_deg_y = np.abs(self._wcs.wcs.cdelt)
+        pad = np.ceil(ROI_PAD_DEG / np.array([pix_deg_y, pix_deg_x])).astype(int)
+        return np.clip(pixbox + [-pad, pad], 0, self._shape[-2:])
+
+    def _get_sim_pixbox(self, nm_dict, seed, pixbox, ivar=None, mask=None, verbose=False):
+        """Return a masked enmap.ndmap sim of the region pixbox from nm_dict, with
+        seed <sequence of ints>. The sim is drawn in the padded pixbox and cropped"""
+        ppb = self._get_padded_pixbox(pixbox)
+        sel = np.s_[..., ppb[0, 0]:ppb[1, 0], ppb[0, 1]:ppb[1, 1]]
+        if ivar is not None:
+            ivar = ivar[sel]
+        if mask is not None:
+            mask = mask[sel]
+        
+        sim = self._get_sim(
+            nm_dict, seed, ivar=ivar, mask=mask, verbose=verbose, pixbox=ppb
+            )
+        pb = pixbox - ppb[0]
+        return sim[..., pb[0, 0]:pb[1, 0], pb[0, 1]:pb[1, 1]]
+
+    def get_sims(self, split_num, sim_nums, alm=True, do_mask_obs=True,
+                 check_on_disk=True, generate=True, keep_model=True,
+                 keep_ivar=True, write=False, writer=None, target_gb=2,
+                 verbose=False):
+        """Load or generate many sims from this NoiseModel and return them
+        stacked. See iter_sims, which this wraps, for how the sims are batched.
+        Each sim is identical to the output of get_sim for the same sim_num.
+
+        Parameters
+        ----------
+        split_num : int
+            The 0-based index of the split to simulate.
+        sim_nums : iterable of int
+            The map indices, used in setting the random seeds. See get_sim.
+        alm : bool, optional
+            Generate simulated alms instead of simulated maps, by default True.
+        do_mask_obs : bool, optional
+            Apply the mask_obs to the sims, by default True. See get_sim.
+        check_on_disk : bool, optional
+            If True, first check if identical sims (including the noise model 'notes')
+            exist on-disk. Sims that do are loaded, the rest are generated if 'generate'
+            is True, or a FileNotFoundError is raised if it is False. By default True.
+        generate: bool, optional
+            If 'check_on_disk' is True but a sim is not found, generate the
+            sim. If False and the same occurs, raise a FileNotFoundError. By
+            default True.
+        keep_model : bool, optional
+            Store the loaded model for this split in the process-wide model cache, by
+            default True.
+        keep_ivar : bool, optional
+            Store the loaded, possibly downgraded, ivar in the instance
+            attributes, by default True.
+        write : bool, optional
+            Save generated sims to disk, by default False.
+        writer : simio.SimWriter, optional
+            If write, hand the sims to this writer to be saved in the background,
+            by default None. See get_sim.
+        target_gb : float, optional
+            The approximate memory budget of the working arrays of one batch of
+            sims, by default 2. Sets the number of sims drawn per batch.
+        verbose : bool, optional
+            Print possibly helpful messages, by default False.
+
+        Returns
+        -------
+        enmap.ndmap or np.ndarray
+            The sims, stacked along a new leading axis in the order of sim_nums,
+            with shape (num_sims, num_arrays, num_splits=1, num_pol, ny, nx) if
+            maps, or (num_sims, num_arrays, num_splits=1, num_pol, nelem) if alms.
+
+        Notes
+        -----
+        The returned stack holds every sim at once. To write many sims to disk,
+        iterate over iter_sims with write=True instead, which only holds one
+        batch of sims at a time.
+        """
+        sim_nums = list(sim_nums)
+
+        sims = None
+        for i, (_, sim) in enumerate(self.iter_sims(
+            split_num, sim_nums, alm=alm, do_mask_obs=do_mask_obs,
+            check_on_disk=check_on_disk, generate=generate, keep_model=keep_model,
+            keep_ivar=keep_ivar, write=write, writer=writer, target_gb=target_gb,
+            verbose=verbose
+            )):
+            if sims is None:
+                sims = np.empty((len(sim_nums), *sim.shape), dtype=sim.dtype)
+            sims[i] = sim
+
+        if sims is None:
+            sims = self._empty_sims(alm=alm)
+
+        if alm:
+            return sims
+        else:
+            return enmap.ndmap(sims, self._wcs)
+
+    def iter_sims(self, split_num, sim_nums, alm=True, do_mask_obs=True,
+                  check_on_disk=True, generate=True, keep_model=True,
+                  keep_ivar=True, write=False, writer=None, target_gb=2,
+                  verbose=False):
+        """Load or generate many sims from this NoiseModel, one batch at a time.
+        The mask, model, and ivar are only fetched once, the first time a sim is
+        not found on-disk, and missing sims are drawn in batches, which amortizes
+        the synthesis cost over the batch. Only one batch of sims is held at once.
+
+        Parameters
+        ----------
+        split_num : int
+            The 0-based index of the split to simulate.
+        sim_nums : iterable of int
+            The map indices, used in setting the random seeds. See get_sim.
+        alm, do_mask_obs, check_on_disk, generate, keep_model, keep_ivar, write, writer, target_gb, verbose
+            See get_sims.
+
+        Yields
+        ------
+        tuple of (int, enmap.ndmap or np.ndarray)
+            The sim_num and its sim, in the order of sim_nums. Each sim is
+            identical to the output of get_sim for the same sim_num.
+        """
+        inm = self._sim_inm
+
+        sim_nums = list(sim_nums)
+        if len(sim_nums) > 0:
+            assert max(sim_nums) <= 9999, 'Cannot use a map index greater than 9999'
+
+        batch_size = self._get_sims_batch_size(target_gb)
+        nm_dict = None
+
+        for start in range(0, len(sim_nums), batch_size):
+            batch_sim_nums = sim_nums[start:start + batch_size]
+
+            sims = [None] * len(batch_sim_nums)
+            if check_on_disk:
+                for i, sim_num in enumerate(batch_sim_nums):
+                    res = self._check_sim_on_disk(
+                        split_num, sim_num, alm=alm, do_mask_obs=do_mask_obs, generate=generate
+                    )
+                    if res is not False:
+                        sims[i] = res
+            todo = [i for i, sim in enumerate(sims) if sim is None]
+
+            if len(todo) > 0 and nm_dict is None:
+                # get the observed-pixels mask
+                if inm._mask_obs is None:
+                    inm._mask_obs = inm.get_mask_obs()
+
+                # get the model and ivar
+                nm_dict = self._model_cache.get(self._get_model_fn(split_num))
+                if nm_dict is None:
+                    nm_dict = self._check_model_on_disk(split_num, generate=False)
+
+                if split_num not in inm._ivar_dict:
+                    ivar = inm.get_ivar(split_num, inm._mask_obs)
+                else:
+                    ivar = inm.ivar(split_num)
+
+                # keep them now, the caller may not exhaust the iterator
+                if keep_model:
+                    self._keep_model(split_num, nm_dict)
+
+                if keep_ivar:
+                    inm._keep_ivar(split_num, ivar)
+
+                mask = inm._mask_obs if do_mask_obs else None
+
+            if len(todo) > 0:
+                todo_sim_nums = [batch_sim_nums[i] for i in todo]
+
+                with telemetry.span(
+                    'get_sims', show=f'Generating noise sims for split {split_num}, maps {todo_sim_nums}',
+                    split_num=split_num, sim_nums=todo_sim_nums
+                    ):
+                    seeds = [self._get_seed(split_num, sim_num) for sim_num in todo_sim_nums]
+                    if alm:
+                        todo_sims = self._get_sims_alm(
+                            nm_dict, seeds, verbose=verbose, ivar=ivar, mask=mask
+                            )
+                    else:
+                        todo_sims = self._get_sims(
+                            nm_dict, seeds, verbose=verbose, ivar=ivar, mask=mask
+                            )
+
+                for i, sim_num, sim in zip(todo, todo_sim_nums, todo_sims):
+                    sims[i] = sim
+
+                    if write:
+                        fn = self._get_sim_fn(split_num, sim_num, alm=alm, mask_obs=do_mask_obs)
+                        if writer is not None:
+                            writer.submit(fn, sim, alm=alm)
+                        else:
+                            simio.write_sim(fn, sim, alm=alm)
+
+            yield from zip(batch_sim_nums, sims)
+
+    def _empty_sims(self, alm=True):
+        """Return an empty stack of sims, with the shape and dtype of get_sims
+        for no sim_nums"""
+        inm = self._sim_inm
+
+        preshape = (0, inm._num_arrays, 1, inm.num_pol)
+        if alm:
+            lmax = inm._lmax
+            dtype = np.result_type(self._dtype, np.complex64)
+            return np.empty((*preshape, (lmax + 1) * (lmax + 2) // 2), dtype=dtype)
+        else:
+            return np.empty((*preshape, *self._shape[-2:]), dtype=self._dtype)
+
+    def _get_sims_batch_size(self, target_gb):
+        """Return the number of sims to draw per batch such that their working
+        arrays take up about target_gb of memory"""
+        return max(1, int(target_gb * 1e9 // self._get_sim_nbytes()))
+
+    def _get_sim_nbytes(self):
+        """Return the approximate bytes of working arrays needed to draw one
+        sim. Subclasses should override this with the cost of their synthesis;
+        by default, assume a few map-sized arrays per component"""
+        inm = self._sim_inm
+        ncomp = inm._num_arrays * inm.num_pol
+        return 4 * ncomp * np.prod(self._shape[-2:]) * np.dtype(self._dtype).itemsize
+
     def _check_sim_on_disk(self, split_num, sim_num, alm=True, do_mask_obs=True,
                            return_if_exists=True, generate=True):
         """Check if this NoiseModel's sim for a given split, sim exists on-disk. 
@@ -504,21 +1171,52 @@ class NoiseModel(ABC):
             If 'generate' is False and the sim does not exist on-disk.
         """        
         fn = self._get_sim_fn(split_num, sim_num, alm=alm, mask_obs=do_mask_obs)
-        if os.path.isfile(fn):
+        if simio.sim_exists(fn):
             if return_if_exists:
-                if alm:
-                    return utils.read_alm(fn)
-                else:
-                    return enmap.read_map(fn)
+                # a sim that cannot be read is treated as missing
+                sim = simio.read_sim(fn, alm=alm)
+                if sim is not None:
+                    return sim
             else:
                 return True
+
+        if generate:
+            print(f'Sim for split {split_num}, map {sim_num} not found on-disk, generating instead')
+            return False
         else:
-            if generate:
-                print(f'Sim for split {split_num}, map {sim_num} not found on-disk, generating instead')
-                return False
-            else:
-                print(f'Sim for split {split_num}, map {sim_num} not found on-disk, please generate it first')
-                raise FileNotFoundError(fn)
+            print(f'Sim for split {split_num}, map {sim_num} not found on-disk, please generate it first')
+            raise FileNotFoundError(fn)
+
+    def get_missing_sims(self, split_nums, sim_nums, alm=True, do_mask_obs=True):
+        """Find which sims of this NoiseModel do not exist on-disk. Sims are
+        looked up in the SimManifest of their directory, if it has one, with
+        one read of the manifest, or else checked for one-by-one.
+
+        Parameters
+        ----------
+        split_nums : iterable of int
+            The 0-based indices of the splits to look for.
+        sim_nums : iterable of int
+            The sim index numbers to look for, for each split.
+        alm : bool, optional
+            Whether the sims are stored as alms or maps, by default True.
+        do_mask_obs : bool, optional
+            Whether the sims have been masked by this NoiseModel's mask_obs
+            in map-space, by default True.
+
+        Returns
+        -------
+        list of tuple
+            The (split_num, sim_num) pairs of the missing sims, ordered by 
+            split_num and then sim_num as passed.
+        """
+        sim_nums = list(sim_nums)
+        fns = {}
+        for split_num in split_nums:
+            for sim_num in sim_nums:
+                fn = self._get_sim_fn(split_num, sim_num, alm=alm, mask_obs=do_mask_obs)
+                fns[fn] = (split_num, sim_num)
+        return [fns[fn] for fn in simio.get_missing_sims(list(fns))]
 
     def _get_seed(self, split_num, sim_num):
         """Return seed for sim with split_num, sim_num."""
@@ -541,13 +1239,26 @@ class NoiseModel(ABC):
         """Return a masked alm sim from nm_dict, with seed <sequence of ints>"""
         pass
 
+    def _get_sims(self, nm_dict, seeds, mask=None, verbose=False, **kwargs):
+        """Return a list of masked enmap.ndmap sims from nm_dict, one per seed in seeds.
+        Subclasses may override this to batch the synthesis"""
+        return [self._get_sim(nm_dict, seed, mask=mask, verbose=verbose, **kwargs) for seed in seeds]
+
+    def _get_sims_alm(self, nm_dict, seeds, mask=None, verbose=False, **kwargs):
+        """Return a list of masked alm sims from nm_dict, one per seed in seeds.
+        Subclasses may override this to batch the synthesis"""
+        return [self._get_sim_alm(nm_dict, seed, mask=mask, verbose=verbose, **kwargs) for seed in seeds]
+
     def noise_model(self, split_num):
-        return self._nm_dict[split_num]
+        nm_dict = self._model_cache.get(self._get_model_fn(split_num))
+        if nm_dict is None:
+            raise KeyError(split_num)
+        return nm_dict
 
     def delete_model(self, split_num):
-        """Delete a dictionary entry of noise model variables from instance attributes under key split_num"""
+        """Delete the noise model variables under key split_num from the model cache"""
         try:
-            del self._nm_dict[split_num] 
+            self._model_cache.pop(self._get_model_fn(split_num))
         except KeyError:
             print(f'Nothing to delete, no model in memory for split {split_num}')
 
@@ -618,12 +1329,15 @@ class NoiseModel(ABC):
 @register()
 class TiledNoiseModel(NoiseModel):
 
+    _supports_pixbox = True
+
     def __init__(self, *qids, data_model=None, calibrated=True, downgrade=1,
                  lmax=None, mask_version=None, mask_est=None, mask_est_name=None,
                  mask_obs=None, mask_obs_name=None, ivar_dict=None, cfact_dict=None,
                  dmap_dict=None, union_sources=None, kfilt_lbounds=None,
                  fwhm_ivar=None, notes=None, dtype=None,
-                 width_deg=4., height_deg=4., delta_ell_smooth=400, **kwargs):
+                 width_deg=4., height_deg=4., delta_ell_smooth=400, compression=None,
+                 quantize=None, legacy_rng=False, **kwargs):
         """A TiledNoiseModel object supports drawing simulations which capture spatially-varying
         noise correlation directions in map-domain data. They also capture the total noise power
         spectrum, spatially-varying map depth, and array-array correlations.
@@ -697,6 +1411,17 @@ class TiledNoiseModel(NoiseModel):
         delta_ell_smooth : int, optional
             The smoothing scale in Fourier space to mitigate bias in the noise model
             from a small number of data splits, by default 400.
+        compression : str, optional
+            Write models with this lossless compression, by default None. See 
+            tiled_ndmap.write_tiled_ndmap. Models are read transparently.
+        quantize : str, optional
+            Write the square-root covariance of models with this lossy quantization,
+            by default None. See tiled_ndmap.write_tiled_ndmap.
+        legacy_rng : bool, optional
+            Draw sims from the random stream of mnms versions before the counter-based
+            draws, by default False. Only needed to reproduce sims made by those versions.
+            See tiled_noise.get_tiled_noise_sims. Sims from the counter-based draws have
+            the stream in their filenames, see simio.get_tiled_sim_fn.
         kwargs : dict, optional
             Optional keyword arguments to pass to simio.get_sim_mask_fn (currently just
             'galcut' and 'apod_deg'), by default None.
@@ -730,6 +1455,9 @@ class TiledNoiseModel(NoiseModel):
         self._width_deg = width_deg
         self._height_deg = height_deg
         self._delta_ell_smooth = delta_ell_smooth
+        self._compression = compression
+        self._quantize = quantize
+        self._legacy_rng = legacy_rng
 
     @property
     def _model_inm(self):
@@ -761,13 +1489,17 @@ class TiledNoiseModel(NoiseModel):
             fn, extra_hdu=['SQRT_COV_ELL']
         )
         sqrt_cov_ell = extra_hdu['SQRT_COV_ELL']
+
+        # models written before the flattened format hold the full matrices
+        if sqrt_cov_mat.ndim == 5:
+            sqrt_cov_mat = tiled_noise.pack_covsqrt(sqrt_cov_mat)
     
         return {
             'sqrt_cov_mat': sqrt_cov_mat,
             'sqrt_cov_ell': sqrt_cov_ell
             }
 
-    def _get_model(self, dmap, ivar=None, verbose=False, **kwargs):
+    def _get_model(self, dmap, ivar=None, target_gb=2, verbose=False, **kwargs):
         """Return a dictionary of noise model variables for this NoiseModel subclass from difference map dmap"""
         inm = self._model_inm
 
@@ -775,7 +1507,7 @@ class TiledNoiseModel(NoiseModel):
             dmap, ivar=ivar, mask_obs=inm._mask_obs,
             mask_est=inm._mask_est, width_deg=self._width_deg,
             height_deg=self._height_deg, delta_ell_smooth=self._delta_ell_smooth,
-            lmax=inm._lmax, rfft=True, nthread=0, verbose=verbose
+            lmax=inm._lmax, rfft=True, target_gb=target_gb, nthread=0, verbose=verbose
         )
 
         return {
@@ -786,7 +1518,8 @@ class TiledNoiseModel(NoiseModel):
     def _write_model(self, fn, sqrt_cov_mat=None, sqrt_cov_ell=None, **kwargs):
         """Write a dictionary of noise model variables to filename fn"""
         tiled_ndmap.write_tiled_ndmap(
-            fn, sqrt_cov_mat, extra_hdu={'SQRT_COV_ELL': sqrt_cov_ell}
+            fn, sqrt_cov_mat, extra_hdu={'SQRT_COV_ELL': sqrt_cov_ell},
+            compression=self._compression, quantize=self._quantize
         )
 
     def _get_sim_fn(self, split_num, sim_num, alm=False, mask_obs=True):
@@ -796,6 +1529,7 @@ class TiledNoiseModel(NoiseModel):
         return simio.get_tiled_sim_fn(
             inm._qids, self._width_deg, self._height_deg, self._delta_ell_smooth, 
             inm._lmax, split_num, sim_num, notes=self._notes, alm=alm, mask_obs=mask_obs, 
+            rng=None if self._legacy_rng else tiled_noise.RNG_NAME,
             data_model=inm._data_model, mask_version=inm._mask_version,
             bin_apod=inm._use_default_mask, mask_est_name=inm._mask_est_name,
             mask_obs_name=inm._mask_obs_name, calibrated=inm._calibrated, 
@@ -804,15 +1538,19 @@ class TiledNoiseModel(NoiseModel):
             **inm._kwargs
         )
 
-    def _get_sim(self, nm_dict, seed, ivar=None, mask=None, verbose=False, **kwargs):
-        """Return a masked enmap.ndmap sim from nm_dict, with seed <sequence of ints>"""
+    def _get_sim(self, nm_dict, seed, ivar=None, mask=None, pixbox=None, verbose=False,
+                 **kwargs):
+        """Return a masked enmap.ndmap sim from nm_dict, with seed <sequence of ints>.
+        If pixbox, only the tiles overlapping it are drawn, and ivar and mask must be
+        in the pixbox geometry. Before the ell filter, the sim is identical to the 
+        pixbox of the full sim"""
         # Get noise model variables 
         sqrt_cov_mat = nm_dict['sqrt_cov_mat']
         sqrt_cov_ell = nm_dict['sqrt_cov_ell']
         
         sim = tiled_noise.get_tiled_noise_sim(
-            sqrt_cov_mat, ivar=ivar, sqrt_cov_ell=sqrt_cov_ell, 
-            nthread=0, seed=seed, verbose=verbose
+            sqrt_cov_mat, ivar=ivar, sqrt_cov_ell=sqrt_cov_ell, pixbox=pixbox,
+            legacy_rng=self._legacy_rng, nthread=0, seed=seed, verbose=verbose
         )
         
         # We always want shape (num_arrays, num_splits=1, num_pol, ny, nx).
@@ -823,11 +1561,50 @@ class TiledNoiseModel(NoiseModel):
             sim *= mask
         return sim
 
-    def _get_sim_alm(self, nm_dict, seed, ivar=None, mask=None, verbose=False, **kwargs):    
+    def _get_sim_alm(self, nm_dict, seed, ivar=None, mask=None, verbose=False, **kwargs):
         """Return a masked alm sim from nm_dict, with seed <sequence of ints>"""
         sim = self._get_sim(nm_dict, seed, ivar=ivar, mask=mask, verbose=verbose, **kwargs)
         return utils.map2alm(sim, lmax=self._sim_inm._lmax)
 
+    def _get_sims(self, nm_dict, seeds, ivar=None, mask=None, verbose=False, **kwargs):
+        """Return a stack of masked enmap.ndmap sims from nm_dict, one per seed in seeds"""
+        # Get noise model variables
+        sqrt_cov_mat = nm_dict['sqrt_cov_mat']
+        sqrt_cov_ell = nm_dict['sqrt_cov_ell']
+
+        sims = tiled_noise.get_tiled_noise_sims(
+            sqrt_cov_mat, seeds, ivar=ivar, sqrt_cov_ell=sqrt_cov_ell,
+            legacy_rng=self._legacy_rng, nthread=0, verbose=verbose
+        )
+
+        # We always want shape (num_arrays, num_splits=1, num_pol, ny, nx).
+        assert sims.ndim == 6, \
+            'Sims must have shape (num_sims, num_arrays, num_splits=1, num_pol, ny, nx)'
+
+        if mask is not None:
+            sims *= mask
+        return sims
+
+    def _get_sims_alm(self, nm_dict, seeds, ivar=None, mask=None, verbose=False, **kwargs):
+        """Return a list of masked alm sims from nm_dict, one per seed in seeds"""
+        sims = self._get_sims(nm_dict, seeds, ivar=ivar, mask=mask, verbose=verbose, **kwargs)
+        return [utils.map2alm(sim, lmax=self._sim_inm._lmax) for sim in sims]
+
+    def _get_sim_nbytes(self):
+        """Return the approximate bytes of working arrays needed to draw one sim"""
+        inm = self._sim_inm
+        ncomp = inm._num_arrays * inm.num_pol
+        plan = tiled_ndmap.get_tiling_plan(
+            self._shape, self._wcs, self._width_deg, self._height_deg
+            )
+        tiled_npix = plan.numy * plan.numx * np.prod(plan.tile_shape)
+
+        # per component, the complex tile draws, their product with the model,
+        # and the real tiles (each about the size of the real tiles), plus the
+        # stitched output
+        npix = 3 * tiled_npix + np.prod(self._shape[-2:])
+        return ncomp * npix * np.dtype(self._dtype).itemsize
+
 
 @register()
 class WaveletNoiseModel(NoiseModel):
@@ -1068,12 +1845,15 @@ class WaveletNoiseModel(NoiseModel):
 @register()
 class FDWNoiseModel(NoiseModel):
 
+    _supports_pixbox = True
+
     def __init__(self, *qids, data_model=None, calibrated=True, downgrade=1,
                  lmax=None, mask_version=None, mask_est=None, mask_est_name=None,
                  mask_obs=None, mask_obs_name=None, ivar_dict=None, cfact_dict=None,
                  dmap_dict=None, union_sources=None, kfilt_lbounds=None,
                  fwhm_ivar=None, notes=None, dtype=None,
                  lamb=1.6, n=36, p=2, fwhm_fact_pt1=[1350, 10.], fwhm_fact_pt2=[5400, 16.],
+                 lazy_model=False, compression=None, quantize=None, sqrt_method='eigpow',
                  **kwargs):
         """An FDWNoiseModel object supports drawing simulations which capture direction- 
         and scale-dependent, spatially-varying map depth. The simultaneous direction- and
@@ -1161,6 +1941,23 @@ class FDWNoiseModel(NoiseModel):
             determining smoothing scale at each wavelet scale: FWHM = fact * pi / lmax,
             where lmax is the max wavelet ell. See utils.get_fwhm_fact_func_from_pts
             for functional form.
+        lazy_model : bool, optional
+            If True, models read from disk are not loaded into memory. Instead, the 
+            wavelet maps of the square-root covariance are memory-mapped from the file
+            one at a time when drawing a sim, by default False. This reduces the peak
+            memory of drawing sims from the whole model to its largest wavelet map.
+        compression : str, optional
+            Write models with this lossless compression, by default None. See 
+            fdw_noise.write_wavs. Models are read transparently, but compressed
+            wavelet maps cannot be memory-mapped.
+        quantize : str, optional
+            Write the square-root covariance of models with this lossy quantization,
+            by default None. See fdw_noise.write_wavs. Quantized wavelet maps 
+            cannot be memory-mapped.
+        sqrt_method : str, optional
+            How to take the square root of the covariance in each pixel, by default
+            'eigpow'. See fdw_noise.get_fdw_noise_covsqrt. Other methods are 
+            recorded in the model and sim filenames.
         kwargs : dict, optional
             Optional keyword arguments to pass to simio.get_sim_mask_fn (currently just
             'galcut' and 'apod_deg'), by default None.
@@ -1215,7 +2012,23 @@ class FDWNoiseModel(NoiseModel):
         self._fwhm_fact_func = utils.get_fwhm_fact_func_from_pts(
             fwhm_fact_pt1, fwhm_fact_pt2
             )
+        self._lazy_model = lazy_model
+        self._compression = compression
+        self._quantize = quantize
+        if sqrt_method not in fdw_noise.SQRT_METHODS:
+            raise ValueError(
+                f'sqrt_method must be one of {list(fdw_noise.SQRT_METHODS)}, got {sqrt_method}'
+                )
+        self._sqrt_method = sqrt_method
         self._fk = None
+        self._roi_fk = None
+
+    def __getstate__(self):
+        # kernels are cheap to rebuild relative to their size, so don't pickle them
+        state = super().__getstate__()
+        state['_fk'] = None
+        state['_roi_fk'] = None
+        return state
 
     @property
     def _model_inm(self):
@@ -1226,19 +2039,41 @@ class FDWNoiseModel(NoiseModel):
         return self._inm_nominal
 
     def _get_kernels(self):
-        """Build the kernels. This is slow and so we only call it in the first
-        call to _get_model or _get_sim."""
+        """Build the kernels, or load them from the kernel cache if they were
+        built before. This is slow and so we only call it in the first call to
+        _get_model or _get_sim."""
+        return fdw_noise.get_cached_fdw_kernels(
+            simio.get_fdw_kernels_cache_path(), *self._get_kernel_args(self._shape, self._wcs),
+            **self._get_kernel_kwargs()
+        )
+
+    def _get_roi_kernels(self, pixbox):
+        """Build the kernels of the region pixbox of the sim geometry, leaving
+        out the kernels the region cannot resolve, or load them from the kernel
+        cache if they were built before. The kernels of the last pixbox are 
+        kept."""
+        key = tuple(np.asarray(pixbox).ravel().tolist())
+        if self._roi_fk is None or self._roi_fk[0] != key:
+            shape, wcs = utils.slice_geometry_by_pixbox(self._shape, self._wcs, pixbox)
+            fk = fdw_noise.get_cached_fdw_kernels(
+                simio.get_fdw_kernels_cache_path(), *self._get_kernel_args(shape, wcs),
+                **self._get_kernel_kwargs(), skip_empty=True
+                )
+            self._roi_fk = (key, fk)
+        return self._roi_fk[1]
+
+    def _get_kernel_args(self, shape, wcs):
         # there is no real significance to lmax=10_800 here. it will just be
         # used to build the kernel generating functions, specifically, to 
         # check that the last kernel is not "clipped"
-        
+        return (self._lamb, 10_800, 10, 5300, self._n, self._p, shape, wcs)
+
+    def _get_kernel_kwargs(self):
         # TODO: this is tuned to ACT DR6 and should be passable via a 
         # yaml file or equivalent
-        return fdw_noise.FDWKernels(
-            self._lamb, 10_800, 10, 5300, self._n, self._p, self._shape,
-            self._wcs, nforw=[0, 6, 6, 6, 6, 12, 12, 12, 12, 24, 24],
-            nback=[18], pforw=[0, 6, 4, 2, 2, 12, 8, 4, 2, 12, 8],
-            dtype=self._dtype
+        return dict(
+            nforw=[0, 6, 6, 6, 6, 12, 12, 12, 12, 24, 24], nback=[18],
+            pforw=[0, 6, 4, 2, 2, 12, 8, 4, 2, 12, 8], dtype=self._dtype
         )
 
     def _get_model_fn(self, split_num):
@@ -1250,6 +2085,7 @@ class FDWNoiseModel(NoiseModel):
         return simio.get_fdw_model_fn(
             inm._qids, split_num, self._lamb, self._n, self._p, self._fwhm_fact_pt1,
             self._fwhm_fact_pt2, inm._lmax//2, notes=self._notes,
+            sqrt_method=self._get_sqrt_method_tag(),
             data_model=inm._data_model, mask_version=inm._mask_version,
             bin_apod=inm._use_default_mask, mask_est_name=inm._mask_est_name,
             mask_obs_name=inm._mask_obs_name, calibrated=inm._calibrated, 
@@ -1258,10 +2094,15 @@ class FDWNoiseModel(NoiseModel):
             **inm._kwargs
         )
 
+    def _get_sqrt_method_tag(self):
+        """Return the sqrt_method for the filenames, None if the default"""
+        return None if self._sqrt_method == 'eigpow' else self._sqrt_method
+
     def _read_model(self, fn):
         """Read a noise model with filename fn; return a dictionary of noise model variables"""
         sqrt_cov_mat, extra_datasets = fdw_noise.read_wavs(
-            fn, extra_datasets=['sqrt_cov_ell']
+            fn, extra_datasets=['sqrt_cov_ell'], lazy=self._lazy_model,
+            mmap=self._lazy_model
         )
         sqrt_cov_ell = extra_datasets['sqrt_cov_ell']
 
@@ -1270,8 +2111,9 @@ class FDWNoiseModel(NoiseModel):
             'sqrt_cov_ell': sqrt_cov_ell
             }
 
-    def _get_model(self, dmap, verbose=False, **kwargs):
-        """Return a dictionary of noise model variables for this NoiseModel subclass from difference map dmap"""
+    def _get_model(self, dmap, verbose=False, model_fn=None, resume=True, **kwargs):
+        """Return a dictionary of noise model variables for this NoiseModel subclass from difference map dmap.
+        If model_fn is not None, checkpoint each kernel to it as it is computed"""
         inm = self._model_inm
 
         if self._fk is None:
@@ -1282,7 +2124,9 @@ class FDWNoiseModel(NoiseModel):
             self._fk, dmap, mask_obs=inm._mask_obs, mask_est=inm._mask_est,
             fwhm_fact=self._fwhm_fact_func, 
             pre_filt_downgrade=inm._downgrade, post_filt_downgrade=self._sim_inm._downgrade, 
-            post_filt_downgrade_wcs=self._wcs, nthread=0, verbose=verbose
+            post_filt_downgrade_wcs=self._wcs, checkpoint_fname=model_fn, resume=resume,
+            compression=self._compression, quantize=self._quantize, 
+            sqrt_method=self._sqrt_method, nthread=0, verbose=verbose
         )
 
         return {
@@ -1292,10 +2136,18 @@ class FDWNoiseModel(NoiseModel):
 
     def _write_model(self, fn, sqrt_cov_mat=None, sqrt_cov_ell=None, **kwargs):
         """Write a dictionary of noise model variables to filename fn"""
+        # a completed checkpoint from _get_model is already the full model
+        if fdw_noise.is_complete(fn):
+            return
         fdw_noise.write_wavs(
-            fn, sqrt_cov_mat, extra_datasets={'sqrt_cov_ell': sqrt_cov_ell}
+            fn, sqrt_cov_mat, extra_datasets={'sqrt_cov_ell': sqrt_cov_ell},
+            compression=self._compression, quantize=self._quantize
         )
 
+    def _is_model_on_disk(self, split_num):
+        """Return whether the complete model for split_num exists on-disk, without reading it"""
+        return fdw_noise.is_complete(self._get_model_fn(split_num))
+
     def _get_sim_fn(self, split_num, sim_num, alm=False, mask_obs=True):
         """Get a sim filename for split split_num, sim sim_num, and bool alm/mask_obs; return as <str>"""
         inm = self._sim_inm
@@ -1303,6 +2155,7 @@ class FDWNoiseModel(NoiseModel):
         return simio.get_fdw_sim_fn(
             inm._qids, split_num, self._lamb, self._n, self._p, self._fwhm_fact_pt1,
             self._fwhm_fact_pt2, inm._lmax, sim_num, notes=self._notes, alm=alm, mask_obs=mask_obs, 
+            sqrt_method=self._get_sqrt_method_tag(),
             data_model=inm._data_model, mask_version=inm._mask_version,
             bin_apod=inm._use_default_mask, mask_est_name=inm._mask_est_name,
             mask_obs_name=inm._mask_obs_name, calibrated=inm._calibrated, 
@@ -1311,8 +2164,12 @@ class FDWNoiseModel(NoiseModel):
             **inm._kwargs
         )
 
-    def _get_sim(self, nm_dict, seed, mask=None, verbose=False, **kwargs):
-        """Return a masked enmap.ndmap sim from nm_dict, with seed <sequence of ints>"""
+    def _get_sim(self, nm_dict, seed, mask=None, pixbox=None, verbose=False, **kwargs):
+        """Return a masked enmap.ndmap sim from nm_dict, with seed <sequence of ints>.
+        If pixbox, the sim is synthesized with the kernels of the pixbox, and mask
+        must be in the pixbox geometry. It is then a different realization than the
+        full sim, with the same local power except at scales larger than the pixbox,
+        see fdw_noise.get_roi_sqrt_cov_wavs"""
         if self._fk is None:
             print('Building and storing FDWKernels')
             self._fk = self._get_kernels()
@@ -1321,8 +2178,13 @@ class FDWNoiseModel(NoiseModel):
         sqrt_cov_mat = nm_dict['sqrt_cov_mat']
         sqrt_cov_ell = nm_dict['sqrt_cov_ell']
 
+        fk = self._fk
+        if pixbox is not None:
+            fk = self._get_roi_kernels(pixbox)
+            sqrt_cov_mat = fdw_noise.get_roi_sqrt_cov_wavs(self._fk, sqrt_cov_mat, fk)
+
         sim = fdw_noise.get_fdw_noise_sim(
-            self._fk, sqrt_cov_mat, preshape=(self._sim_inm._num_arrays, -1),
+            fk, sqrt_cov_mat, preshape=(self._sim_inm._num_arrays, -1),
             sqrt_cov_ell=sqrt_cov_ell, seed=seed, nthread=0, verbose=verbose
         )
 
@@ -1339,6 +2201,45 @@ class FDWNoiseModel(NoiseModel):
         sim = self._get_sim(nm_dict, seed, mask=mask, verbose=verbose, **kwargs)
         return utils.map2alm(sim, lmax=self._sim_inm._lmax)
 
+    def _get_sims(self, nm_dict, seeds, mask=None, verbose=False, **kwargs):
+        """Return a stack of masked enmap.ndmap sims from nm_dict, one per seed in seeds"""
+        if self._fk is None:
+            print('Building and storing FDWKernels')
+            self._fk = self._get_kernels()
+
+        # Get noise model variables
+        sqrt_cov_mat = nm_dict['sqrt_cov_mat']
+        sqrt_cov_ell = nm_dict['sqrt_cov_ell']
+
+        sims = fdw_noise.get_fdw_noise_sims(
+            self._fk, sqrt_cov_mat, seeds, preshape=(self._sim_inm._num_arrays, -1),
+            sqrt_cov_ell=sqrt_cov_ell, nthread=0, verbose=verbose
+        )
+
+        # We always want shape (num_arrays, num_splits=1, num_pol, ny, nx).
+        assert sims.ndim == 5, 'Sims must have shape (num_sims, num_arrays, num_pol, ny, nx)'
+        sims = sims.reshape(*sims.shape[:2], 1, *sims.shape[2:])
+
+        if mask is not None:
+            sims *= mask
+        return sims
+
+    def _get_sims_alm(self, nm_dict, seeds, mask=None, verbose=False, **kwargs):
+        """Return a list of masked alm sims from nm_dict, one per seed in seeds"""
+        sims = self._get_sims(nm_dict, seeds, mask=mask, verbose=verbose, **kwargs)
+        return [utils.map2alm(sim, lmax=self._sim_inm._lmax) for sim in sims]
+
+    def _get_sim_nbytes(self):
+        """Return the approximate bytes of working arrays needed to draw one sim"""
+        inm = self._sim_inm
+        ncomp = inm._num_arrays * inm.num_pol
+
+        # per component, the complex real-DFT kmap (about the size of the real
+        # map) that the kernels are accumulated into, its real transform, and
+        # the stacked output. the draws are only held for a few kernels at once
+        npix = 3 * np.prod(self._shape[-2:])
+        return ncomp * npix * np.dtype(self._dtype).itemsize
+
 
 @register()
 class HarmonicMixture:
@@ -1419,7 +2320,7 @@ class HarmonicMixture:
     def get_sim(self, split_num, sim_num, alm=True, do_mask_obs=True,
                 check_on_disk=True, check_mix_on_disk=True, generate=True,
                 generate_mix=True, keep_model=True, keep_ivar=True,
-                write=False, verbose=False):
+                write=False, writer=None, verbose=False):
         """A wrapper around the HarmonicMixture's noise_model.get_sim(...) 
         methods, such that simulations from each noise_model are stitched
         together with the specified profiles in harmonic space.
@@ -1460,6 +2361,9 @@ class HarmonicMixture:
             If a noise_model has generated a sim on-the-fly as a step in constructing
             the HarmonicMixture sim, whether to save that noise_model sim to disk,
             by default False.
+        writer : simio.SimWriter, optional
+            If write, hand the noise_model sims to this writer to be saved in the
+            background, by default None.
         verbose : bool, optional
             Possibly print possibly helpful messages, by default False.
 
@@ -1488,18 +2392,21 @@ class HarmonicMixture:
             else: # generate_mix == True and: generate == True or all sims exist on disk
                 pass
 
-        with bench.show(f'Generating noise sim for split {split_num}, map {sim_num}'):
+        with telemetry.span(
+            'get_mixture_sim', show=f'Generating noise sim for split {split_num}, map {sim_num}',
+            split_num=split_num, sim_num=sim_num
+            ):
             if alm:
                 sim = self._get_sim_alm(
                     split_num, sim_num, do_mask_obs=do_mask_obs,
                     check_on_disk=check_on_disk, generate=generate, keep_model=keep_model,
-                    keep_ivar=keep_ivar, write=write, verbose=verbose
+                    keep_ivar=keep_ivar, write=write, writer=writer, verbose=verbose
                     )
             else:
                 sim = self._get_sim(
                     split_num, sim_num, do_mask_obs=do_mask_obs,
                     check_on_disk=check_on_disk, generate=generate, keep_model=keep_model,
-                    keep_ivar=keep_ivar, write=write, verbose=verbose
+                    keep_ivar=keep_ivar, write=write, writer=writer, verbose=verbose
                     )
 
         # TODO: resolve File name too long error!
@@ -1560,28 +2467,73 @@ class HarmonicMixture:
             exist on-disk.
         """
         fn = self._get_sim_fn(split_num, sim_num, alm=alm, mask_obs=do_mask_obs)
-        if os.path.isfile(fn):
+        if simio.sim_exists(fn):
             if return_if_exists:
-                if alm:
-                    return utils.read_alm(fn)
-                else:
-                    return enmap.read_map(fn)
+                # a sim that cannot be read is treated as missing
+                sim = simio.read_sim(fn, alm=alm)
+                if sim is not None:
+                    return sim
             else:
                 return True
-        else:
-            if generate_mix:
-                print(f'Sim for split {split_num}, map {sim_num} not found on-disk, generating instead')
-                for noise_model in self._noise_models:
-                    _ = noise_model._check_sim_on_disk(
-                        split_num, sim_num, alm=True, do_mask_obs=do_mask_obs,
-                        return_if_exists=False, generate=generate,
-                    )
+
+        if generate_mix:
+            print(f'Sim for split {split_num}, map {sim_num} not found on-disk, generating instead')
+            for noise_model in self._noise_models:
+                _ = noise_model._check_sim_on_disk(
+                    split_num, sim_num, alm=True, do_mask_obs=do_mask_obs,
+                    return_if_exists=False, generate=generate,
+                )
                 
-                # if we've gotten here, then either generate is True or all base sims exist on disk
-                return False
-            else:
-                print(f'Sim for split {split_num}, map {sim_num} not found on-disk, please generate it first')
-                raise FileNotFoundError(fn)
+            # if we've gotten here, then either generate is True or all base sims exist on disk
+            return False
+        else:
+            print(f'Sim for split {split_num}, map {sim_num} not found on-disk, please generate it first')
+            raise FileNotFoundError(fn)
+
+    def get_missing_sims(self, split_nums, sim_nums, alm=True, do_mask_obs=True):
+        """Find which sims of this HarmonicMixture can not be read or stitched
+        from sims on-disk, i.e. the mixture sim does not exist and neither does
+        the (alm) sim of at least one component noise_model. The mixture and
+        component sims are all looked up at once, see simio.get_missing_sims.
+
+        Parameters
+        ----------
+        split_nums : iterable of int
+            The 0-based indices of the splits to look for.
+        sim_nums : iterable of int
+            The sim index numbers to look for, for each split.
+        alm : bool, optional
+            Whether the HarmonicMixture sims are stored as alms or maps, by 
+            default True. The component noise_model sims are always looked for
+            as alms.
+        do_mask_obs : bool, optional
+            Whether to look for masked HarmonicMixture and component 
+            noise_model sims, by default True.
+
+        Returns
+        -------
+        list of tuple
+            The (split_num, sim_num) pairs of the missing sims, ordered by 
+            split_num and then sim_num as passed.
+        """
+        sim_nums = list(sim_nums)
+        mix_fns = {}
+        comp_fns = {}
+        for split_num in split_nums:
+            for sim_num in sim_nums:
+                key = (split_num, sim_num)
+                mix_fns[key] = self._get_sim_fn(split_num, sim_num, alm=alm, mask_obs=do_mask_obs)
+                comp_fns[key] = [
+                    noise_model._get_sim_fn(split_num, sim_num, alm=True, mask_obs=do_mask_obs)
+                    for noise_model in self._noise_models
+                    ]
+
+        fns = list(mix_fns.values()) + [fn for key in comp_fns for fn in comp_fns[key]]
+        missing_fns = set(simio.get_missing_sims(fns))
+        return [
+            key for key in mix_fns if mix_fns[key] in missing_fns and \
+            any(fn in missing_fns for fn in comp_fns[key])
+            ]
 
     def _get_sim_fn(self, split_num, sim_num, alm=False, mask_obs=True):
         """Get a sim filename for split split_num, sim sim_num, and bool alm/mask_obs; return as <str>"""
@@ -1740,6 +2692,7 @@ class Interface:
         # get derived instance properties
         self._num_arrays = len(self._qids)
         self._num_splits = utils.get_nsplits_by_qid(self._qids[0], self._data_model)
+        self._num_pol = None
         self._use_default_mask = mask_est_name is None
 
         # Possibly store input data
@@ -1781,7 +2734,9 @@ class Interface:
             if i == 0:
                 main_shape, main_wcs = shape, wcs
             else:
-                with bench.show(f'Checking geometry compatibility between {qid} and {self._qids[0]}'):
+                with telemetry.span(
+                    'check-geometry', show=f'Checking geometry compatibility between {qid} and {self._qids[0]}'
+                    ):
                     assert(
                         shape == main_shape), 'qids do not share pixel shape -- this is required!'
                     assert wcsutils.is_compatible(
@@ -1809,7 +2764,7 @@ class Interface:
         mask : (ny, nx) enmap
             Sky mask. Dowgraded if requested.
         """
-        with bench.show('Generating harmonic-filter-estimate mask'):
+        with telemetry.span('mask-est', show='Generating harmonic-filter-estimate mask'):
 
             # first check for ivar compatibility and get map geometry
             full_shape, full_wcs = self._check_geometry()
@@ -1826,7 +2781,9 @@ class Interface:
                 if i == 0:
                     mask_est = mask
                 else:
-                    with bench.show(f'Checking mask compatibility between {qid} and {self._qids[0]}'):
+                    with telemetry.span(
+                        'check-mask', show=f'Checking mask compatibility between {qid} and {self._qids[0]}'
+                        ):
                         assert np.allclose(
                             mask, mask_est), 'qids do not share a common mask -- this is required!'
                         assert wcsutils.is_compatible(
@@ -1864,7 +2821,7 @@ class Interface:
         mask_obs = self._get_mask_obs_from_disk(downgrade=False)
         mask_obs_dg = True
 
-        with bench.show('Generating observed-pixels mask'):
+        with telemetry.span('mask-obs', show='Generating observed-pixels mask'):
             for qid in self._qids:
                 for s in range(self._num_splits):
                     # we want to do this split-by-split in case we can save
@@ -1978,7 +2935,10 @@ class Interface:
         ivars = self._empty(ivar=True, num_splits=1)
 
         for i, qid in enumerate(self._qids):
-            with bench.show(self._action_str(qid, split_num=split_num, ivar=True)):
+            with telemetry.span(
+                'load', show=self._action_str(qid, split_num=split_num, ivar=True),
+                qid=qid, split_num=split_num, ivar=True
+                ):
                 if self._calibrated:
                     mul = s_utils.get_mult_fact(self._data_model, qid, ivar=True)
                 else:
@@ -2051,7 +3011,10 @@ class Interface:
         cfacts = self._empty(ivar=True, num_splits=1)
 
         for i, qid in enumerate(self._qids):
-            with bench.show(self._action_str(qid, split_num=split_num, cfact=True)):
+            with telemetry.span(
+                'load', show=self._action_str(qid, split_num=split_num, cfact=True),
+                qid=qid, split_num=split_num, cfact=True
+                ):
                 if self._calibrated:
                     mul = s_utils.get_mult_fact(self._data_model, qid, ivar=True)
                 else:
@@ -2113,7 +3076,10 @@ class Interface:
                 )
     
         for i, qid in enumerate(self._qids):
-            with bench.show(self._action_str(qid, split_num=split_num)):
+            with telemetry.span(
+                'load', show=self._action_str(qid, split_num=split_num),
+                qid=qid, split_num=split_num
+                ):
                 if self._calibrated:
                     mul_imap = s_utils.get_mult_fact(self._data_model, qid, ivar=False)
                     mul_ivar = s_utils.get_mult_fact(self._data_model, qid, ivar=True)
@@ -2158,15 +3124,18 @@ class Interface:
                     for idx in np.ndindex(*ivar.shape[:-2]):
                         mask_bool *= ivar[idx].astype(bool)
                         
-                    self._inpaint(dmap, ivar_eff, mask_bool, qid=qid, split_num=split_num) 
+                    with telemetry.span('inpaint'):
+                        self._inpaint(dmap, ivar_eff, mask_bool, qid=qid, split_num=split_num) 
 
                 if self._kfilt_lbounds is not None:
-                    dmap = utils.filter_weighted(dmap, ivar_eff, filt)
+                    with telemetry.span('kfilt'):
+                        dmap = utils.filter_weighted(dmap, ivar_eff, filt)
 
                 if self._downgrade != 1:
-                    dmaps[i, 0] = utils.fourier_downgrade_cc_quad(
-                        dmap, self._downgrade
-                    )
+                    with telemetry.span('downgrade'):
+                        dmaps[i, 0] = utils.fourier_downgrade_cc_quad(
+                            dmap, self._downgrade
+                        )
                 else:
                     dmaps[i, 0] = dmap
     
@@ -2395,6 +3364,14 @@ class Interface:
     @property
     def num_splits(self):
         return self._num_splits
+
+    @property
+    def num_pol(self):
+        # read lazily from the map geometry on-disk, like in _empty
+        if self._num_pol is None:
+            shape, _ = s_utils.read_map_geometry(self._data_model, self._qids[0], 0, ivar=False)
+            self._num_pol = shape[0]
+        return self._num_pol
         
 
 class WavFiltTile(NoiseModel):
@@ -1,9 +1,25 @@
 #!/usr/bin/env python3
 from soapack import interfaces as sints
-from mnms import utils
+from pixell import enmap
+from mnms import utils, telemetry
+
+from concurrent import futures
+import threading
+import hashlib
+import fcntl
+import json
+import os
 
 config = sints.dconfig['mnms']
 
+def get_fdw_kernels_cache_path():
+    """Return the directory of cached FDWKernels: the 'fdw_kernels_path' entry
+    of the 'mnms' config block if present, otherwise the fdw_kernels 
+    subdirectory of 'covmat_path'."""
+    return config.get(
+        'fdw_kernels_path', os.path.join(config['covmat_path'], 'fdw_kernels')
+        )
+
 def get_sim_mask_fn(qid, data_model, use_default_mask=False, mask_version=None, mask_name=None, galcut=None, apod_deg=None):
     """Get filename of a mask.
 
@@ -182,7 +198,7 @@ def get_tiled_model_fn(qid, split_num, width_deg, height_deg, delta_ell_smooth,
     return fn
 
 def get_tiled_sim_fn(qid, width_deg, height_deg, delta_ell_smooth, lmax, split_num, sim_num, alm=False, 
-                     mask_obs=True, notes=None, **kwargs):
+                     mask_obs=True, notes=None, rng=None, **kwargs):
     """_summary_
 
     Parameters
@@ -205,6 +221,10 @@ def get_tiled_sim_fn(qid, width_deg, height_deg, delta_ell_smooth, lmax, split_n
         Whether filename ends in "map" (False) or "alm" (True)
     mask_obs : bool
         Is the sim masked by the mask_observed.
+    rng : str, optional
+        The random stream of the sim, by default None. If None, the sim was
+        drawn from the legacy stream, and the filename is that of mnms
+        versions before the stream was versioned.
 
     Returns
     -------
@@ -230,7 +250,13 @@ def get_tiled_sim_fn(qid, width_deg, height_deg, delta_ell_smooth, lmax, split_n
     else:
         notes = f'_{notes}'
 
-    fn += f'w{width_deg}_h{height_deg}_lsmooth{delta_ell_smooth}_{mask_obs_str}lmax{lmax}{notes}_set{split_num}_'
+    # only non-legacy streams are tagged
+    if rng is None:
+        rng = ''
+    else:
+        rng = f'_rng{rng}'
+
+    fn += f'w{width_deg}_h{height_deg}_lsmooth{delta_ell_smooth}_{mask_obs_str}lmax{lmax}{notes}{rng}_set{split_num}_'
 
     # prepare map num tags
     mapalm = 'alm' if alm else 'map'
@@ -373,7 +399,8 @@ def get_wav_sim_fn(qid, split_num, lamb, lmax, smooth_loc, fwhm_fact_pt1, fwhm_f
     fn += f'{mapalm}{str(sim_num).zfill(4)}.fits'
     return fn
 
-def get_fdw_model_fn(qid, split_num, lamb, n, p, fwhm_fact_pt1, fwhm_fact_pt2, lmax, notes=None, **kwargs):
+def get_fdw_model_fn(qid, split_num, lamb, n, p, fwhm_fact_pt1, fwhm_fact_pt2, lmax, notes=None,
+                     sqrt_method=None, **kwargs):
     """
     Determine filename for square-root covariance file.
 
@@ -395,6 +422,10 @@ def get_fdw_model_fn(qid, split_num, lamb, n, p, fwhm_fact_pt1, fwhm_fact_pt2, l
         Second point in building piecewise linear function of ell.
     lmax : int
         Max multipole.
+    sqrt_method : str, optional
+        The square root of the covariance, see fdw_noise.SQRT_METHODS, by 
+        default None. If None, the symmetric square root, and the filename is
+        that of mnms versions before the method was selectable.
 
     Returns
     -------
@@ -421,11 +452,17 @@ def get_fdw_model_fn(qid, split_num, lamb, n, p, fwhm_fact_pt1, fwhm_fact_pt2, l
     else:
         notes = f'_{notes}'
         
-    fn += f'lamb{lamb}_n{n}_p{p}{fwhm_str}_lmax{lmax}{notes}_set{split_num}.hdf5'
+    # only non-default methods are tagged
+    if sqrt_method is None:
+        sqrt_method = ''
+    else:
+        sqrt_method = f'_sqrt{sqrt_method}'
+        
+    fn += f'lamb{lamb}_n{n}_p{p}{fwhm_str}_lmax{lmax}{notes}{sqrt_method}_set{split_num}.hdf5'
     return fn
 
 def get_fdw_sim_fn(qid, split_num, lamb, n, p, fwhm_fact_pt1, fwhm_fact_pt2, lmax, sim_num, alm=False,
-                   mask_obs=True, notes=None, **kwargs):
+                   mask_obs=True, notes=None, sqrt_method=None, **kwargs):
     """
     Determine filename for simulated noise map.
 
@@ -453,6 +490,9 @@ def get_fdw_sim_fn(qid, split_num, lamb, n, p, fwhm_fact_pt1, fwhm_fact_pt2, lma
         Whether filename ends in "map" (False) or "alm" (True)
     mask_obs : bool
         Is the sim masked by the mask_observed.
+    sqrt_method : str, optional
+        The square root of the covariance of the model, by default None. See
+        get_fdw_model_fn.
 
     Returns
     -------
@@ -484,9 +524,425 @@ def get_fdw_sim_fn(qid, split_num, lamb, n, p, fwhm_fact_pt1, fwhm_fact_pt2, lma
     else:
         notes = f'_{notes}'
     
-    fn += f'lamb{lamb}_n{n}_p{p}{fwhm_str}_{mask_obs_str}lmax{lmax}{notes}_set{split_num}_'
+    # only non-default methods are tagged
+    if sqrt_method is None:
+        sqrt_method = ''
+    else:
+        sqrt_method = f'_sqrt{sqrt_method}'
+    
+    fn += f'lamb{lamb}_n{n}_p{p}{fwhm_str}_{mask_obs_str}lmax{lmax}{notes}{sqrt_method}_set{split_num}_'
 
     # prepare map num tags
     mapalm = 'alm' if alm else 'map'
     fn += f'{mapalm}{str(sim_num).zfill(4)}.fits'
     return fn
+
+def write_sim(fn, sim, alm=False, checksum=False):
+    """Write a sim to disk atomically. The sim is first written to a temporary
+    file in the same directory, which is renamed to fn once complete, so a
+    file at fn is never partially written. The sim is then recorded in the
+    SimManifest of its directory.
+
+    Parameters
+    ----------
+    fn : str
+        Full filename of the sim.
+    sim : array-like
+        The sim to write.
+    alm : bool, optional
+        Whether the sim is an alm (written with utils.write_alm) or a map
+        (written with enmap.write_map), by default False.
+    checksum : bool, optional
+        Record the sha256 checksum of the written file in the SimManifest, by
+        default False. This reads the whole file back after writing it, so it
+        is opt-in; otherwise, the checksum is recorded as None.
+    """
+    # keep the extension, since it sets the format of enmap.write_map
+    root, ext = os.path.splitext(fn)
+    tmp_fn = f'{root}.tmp{os.getpid()}_{threading.get_ident()}{ext}'
+    try:
+        with telemetry.span('write', fn=os.path.basename(fn)):
+            if alm:
+                utils.write_alm(tmp_fn, sim)
+            else:
+                enmap.write_map(tmp_fn, sim)
+        size = os.path.getsize(tmp_fn)
+        checksum = get_checksum(tmp_fn) if checksum else None
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+
+    # only record the sim once it is complete under its final name
+    get_sim_manifest(os.path.dirname(fn), create=True).record(
+        os.path.basename(fn), size, checksum
+        )
+
+def read_sim(fn, alm=False):
+    """Read a sim written by write_sim. If the sim cannot be read, e.g. it
+    was deleted or is corrupt, it is dropped from the SimManifest of its
+    directory, if any, so that it is no longer recorded as existing.
+
+    Parameters
+    ----------
+    fn : str
+        Full filename of the sim.
+    alm : bool, optional
+        Whether the sim is an alm (read with utils.read_alm) or a map (read
+        with enmap.read_map), by default False.
+
+    Returns
+    -------
+    enmap.ndmap or np.ndarray or None
+        The sim, or None if it could not be read.
+    """
+    try:
+        if alm:
+            return utils.read_alm(fn)
+        else:
+            return enmap.read_map(fn)
+    except (OSError, ValueError) as e:
+        print(f'Could not read sim {fn}, treating it as missing: {e!r}')
+        manifest = get_sim_manifest(os.path.dirname(fn))
+        if manifest is not None:
+            manifest.discard(fn)
+        return None
+
+class SimWriter:
+
+    def __init__(self, nthread=1, max_pending=2, checksum=False):
+        """Write sims to disk in background threads, so that generating the next
+        sim can overlap with writing the previous ones.
+
+        Parameters
+        ----------
+        nthread : int, optional
+            The number of writer threads, by default 1.
+        max_pending : int, optional
+            The maximum number of sims held by the writer at once (queued or being
+            written), by default 2. Submitting a sim blocks until there is room, 
+            which bounds the memory held by the writer.
+        checksum : bool, optional
+            Record the checksum of each written sim, by default False. See
+            write_sim.
+
+        Notes
+        -----
+        Sims are written atomically with write_sim. Submitted sims must not be
+        modified until they have been written, i.e. until flush or close return.
+        Errors raised while writing are re-raised by flush or close.
+
+        Examples
+        --------
+        >>> with simio.SimWriter() as writer:
+        >>>     for sim_num in range(100):
+        >>>         model.get_sim(0, sim_num, write=True, writer=writer)
+        """
+        self._executor = futures.ThreadPoolExecutor(max_workers=nthread)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+        self._checksum = checksum
+
+    def submit(self, fn, sim, alm=False):
+        """Queue a sim to be written to fn. See write_sim."""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(
+                write_sim, fn, sim, alm=alm, checksum=self._checksum
+                )
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+
+        # drop references to written sims, but keep any errors to raise later
+        self._futures = [f for f in self._futures if not f.done() or f.exception() is not None]
+        self._futures.append(future)
+
+    def flush(self):
+        """Block until all submitted sims are written. Raise the first error
+        encountered in writing, if any."""
+        fs, self._futures = self._futures, []
+        futures.wait(fs)
+        for f in fs:
+            f.result()
+
+    def close(self):
+        """Flush and shut down the writer threads."""
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# The sim manifest is a JSON-lines file in a sim directory, with one entry
+# per completed sim recording its basename, size, and (optionally) sha256 
+# checksum. It lets us find which sims exist with one read instead of one stat per sim.
+SIM_MANIFEST_NAME = 'sim_manifest.jsonl'
+
+# FITS files are always a whole number of these blocks
+FITS_BLOCK_SIZE = 2880
+
+def get_checksum(fn, chunk_size=2**24):
+    """Return the sha256 hexdigest of a file's contents."""
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class SimManifest:
+
+    def __init__(self, dirname):
+        """An index of the completed sims in a directory, stored in a 
+        JSON-lines file in that directory. Entries are only appended, under
+        an exclusive file lock, after a sim has been renamed to its final
+        filename (see write_sim), so partially written sims are never
+        recorded. If a sim is recorded more than once, the last entry wins,
+        and sims that are discarded (e.g. because they could not be read)
+        are recorded as removed.
+
+        Parameters
+        ----------
+        dirname : path-like
+            The directory of the sims.
+
+        Notes
+        -----
+        The parsed entries are kept in memory and only re-read if the
+        manifest file has changed size or modification time.
+
+        Use get_sim_manifest to get the (shared) manifest of a directory.
+        """
+        self._dirname = os.path.abspath(dirname)
+        self._fn = os.path.join(self._dirname, SIM_MANIFEST_NAME)
+        self._entries = {}
+        self._stat = None
+        self._lock = threading.Lock()
+
+    @property
+    def fn(self):
+        return self._fn
+
+    def exists(self):
+        return os.path.isfile(self._fn)
+
+    def _load(self):
+        """Re-read the manifest file if it has changed since last read."""
+        try:
+            st = os.stat(self._fn)
+        except FileNotFoundError:
+            self._entries, self._stat = {}, None
+            return
+        stat = (st.st_mtime_ns, st.st_size)
+        if stat == self._stat:
+            return
+
+        entries = {}
+        with open(self._fn, 'r') as f:
+            for line in f:
+                # skip a possibly incomplete last line
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get('removed', False):
+                    entries.pop(entry['fn'], None)
+                else:
+                    entries[entry['fn']] = entry
+        self._entries, self._stat = entries, stat
+
+    def entries(self):
+        """Return a dict of the entries in the manifest, keyed by basename."""
+        with self._lock:
+            self._load()
+            return dict(self._entries)
+
+    def __contains__(self, fn):
+        with self._lock:
+            self._load()
+            return os.path.basename(fn) in self._entries
+
+    def missing(self, fns):
+        """Return the filenames in fns that are not recorded in the manifest,
+        in the order of fns."""
+        with self._lock:
+            self._load()
+            return [fn for fn in fns if os.path.basename(fn) not in self._entries]
+
+    def _write(self, entries, truncate=False):
+        """Append entries to the manifest file under an exclusive lock,
+        first truncating it if truncate."""
+        with open(self._fn, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._write_locked(f, entries, truncate=truncate)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write_locked(f, entries, truncate=False):
+        """Write entries to the open, locked manifest file f."""
+        if truncate:
+            f.truncate(0)
+        f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def record(self, fn, size, checksum):
+        """Record a completed sim in the manifest.
+
+        Parameters
+        ----------
+        fn : path-like
+            The sim filename. Only the basename is recorded.
+        size : int
+            The size of the sim file in bytes.
+        checksum : str or None
+            The sha256 hexdigest of the sim file, see get_checksum.
+        """
+        entry = dict(fn=os.path.basename(fn), size=size, checksum=checksum)
+        self._write([entry])
+
+    def discard(self, fn):
+        """Record that a sim no longer exists, if it is in the manifest.
+
+        Parameters
+        ----------
+        fn : path-like
+            The sim filename. Only the basename is recorded.
+        """
+        if fn in self:
+            self._write([dict(fn=os.path.basename(fn), removed=True)])
+
+    def rebuild(self, checksum=False):
+        """Rewrite the manifest from the FITS files in its directory. Files
+        left over from interrupted writes, i.e. temporary files or files that
+        are not a whole number of FITS blocks, are not recorded.
+
+        Parameters
+        ----------
+        checksum : bool, optional
+            Compute the checksum of each file, by default False. Otherwise,
+            checksums are recorded as None.
+        """
+        self._write(self._scan(checksum=checksum), truncate=True)
+
+    def _scan(self, checksum=False):
+        """Return manifest entries for the complete sims in the directory."""
+        entries = []
+        for entry in sorted(os.scandir(self._dirname), key=lambda e: e.name):
+            name = entry.name
+            if not entry.is_file() or not name.endswith('.fits') or '.tmp' in name:
+                continue
+            size = entry.stat().st_size
+            if not _is_complete_size(size):
+                continue
+            entries.append(dict(
+                fn=name, size=size, checksum=get_checksum(entry.path) if checksum else None
+                ))
+        return entries
+
+    def verify(self):
+        """Check the recorded sims against the files on-disk. Return the
+        basenames of recorded sims that are missing, or whose size or
+        (recorded) checksum does not match."""
+        bad = []
+        for name, entry in self.entries().items():
+            fn = os.path.join(self._dirname, name)
+            if not os.path.isfile(fn) or os.path.getsize(fn) != entry['size']:
+                bad.append(name)
+            elif entry['checksum'] is not None and get_checksum(fn) != entry['checksum']:
+                bad.append(name)
+        return bad
+
+_sim_manifests = {}
+_sim_manifests_lock = threading.Lock()
+
+def get_sim_manifest(dirname, create=False):
+    """Return the SimManifest of a directory. Manifests are shared within
+    the process.
+
+    Parameters
+    ----------
+    dirname : path-like
+        The directory of the sims.
+    create : bool, optional
+        If the directory does not yet have a manifest, create it, by default
+        False. A new manifest records the sims already in the directory (see
+        SimManifest.rebuild).
+
+    Returns
+    -------
+    SimManifest or None
+        The manifest, or None if it does not exist and create is False.
+    """
+    dirname = os.path.abspath(dirname)
+    with _sim_manifests_lock:
+        if dirname not in _sim_manifests:
+            _sim_manifests[dirname] = SimManifest(dirname)
+        manifest = _sim_manifests[dirname]
+
+    if not manifest.exists():
+        if not create:
+            return None
+        # another process may be creating the manifest at the same time, 
+        # so check again under the lock of the manifest file
+        with open(manifest.fn, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.path.getsize(manifest.fn) == 0:
+                    manifest._write_locked(f, manifest._scan())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    return manifest
+
+def _is_complete_size(size):
+    """Return whether a FITS file of size bytes may be complete, i.e. it is a
+    nonzero, whole number of FITS blocks."""
+    return size > 0 and size % FITS_BLOCK_SIZE == 0
+
+def _is_complete_file(fn):
+    """Return whether fn is a file that may be a complete FITS file."""
+    try:
+        return os.path.isfile(fn) and _is_complete_size(os.path.getsize(fn))
+    except OSError:
+        return False
+
+def sim_exists(fn):
+    """Return whether the sim at fn exists. If its directory has a
+    SimManifest, the sim exists if it is recorded in the manifest, without
+    touching the file, or else if it is a complete file, e.g. a sim not
+    written by write_sim. Otherwise, fall back to checking for the file.
+
+    Notes
+    -----
+    A recorded sim may since have been deleted; see read_sim, which drops
+    sims that cannot be read from the manifest."""
+    manifest = get_sim_manifest(os.path.dirname(fn))
+    if manifest is not None:
+        return fn in manifest or _is_complete_file(fn)
+    else:
+        return os.path.isfile(fn)
+
+def get_missing_sims(fns):
+    """Return the filenames in fns of sims that do not exist (see sim_exists),
+    in the order of fns. Uses at most one manifest read per directory, and
+    only checks the files of sims not recorded in it."""
+    missing = set()
+    by_dir = {}
+    for fn in fns:
+        by_dir.setdefault(os.path.dirname(fn), []).append(fn)
+    for dirname, dir_fns in by_dir.items():
+        manifest = get_sim_manifest(dirname)
+        if manifest is not None:
+            missing.update(fn for fn in manifest.missing(dir_fns) if not _is_complete_file(fn))
+        else:
+            missing.update(fn for fn in dir_fns if not os.path.isfile(fn))
+    return [fn for fn in fns if fn in missing]
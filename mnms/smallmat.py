@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+from mnms import utils
+
+from concurrent import futures
+import numpy as np
+
+# Batched operations on many small (e.g. per-pixel) symmetric matrices, each
+# stored as its flattened upper triangle along axis 0 in the diagonal-major
+# order of utils.to_flat_triu. Each operation is a short sequence of
+# vectorized array operations over the trailing (e.g. pixel) axes, and is
+# threaded over chunks of the trailing axes.
+
+# number of matrices per thread task. the eigendecomposition of a chunk
+# promotes it to float64 and expands it to the full matrices
+CHUNKSIZE = 2**16
+
+def _get_flat_triu_idxs(ncomp):
+    """Return an (ncomp, ncomp) array giving the position of each matrix
+    element in the flattened upper triangle"""
+    idxs = np.empty((ncomp, ncomp), dtype=int)
+    rows, cols = utils.triu_indices(ncomp)
+    idxs[rows, cols] = np.arange(len(rows))
+    idxs[cols, rows] = np.arange(len(rows))
+    return idxs
+
+def _map_chunks(func, A, nthread=0):
+    """Apply func inplace to chunks of the trailing axes of A, which are
+    flattened, concurrently. Return A."""
+    out = A
+    if not A.flags['C_CONTIGUOUS']:
+        A = np.ascontiguousarray(A)
+    _A = A.reshape(A.shape[0], -1)
+
+    # perform multithreaded execution
+    if nthread == 0:
+        nthread = utils.get_cpu_count()
+    executor = futures.ThreadPoolExecutor(max_workers=nthread)
+
+    def _fill(start, stop):
+        func(_A[:, start:stop])
+
+    fs = [
+        executor.submit(_fill, start, start + CHUNKSIZE)
+        for start in range(0, _A.shape[1], CHUNKSIZE)
+        ]
+    for f in fs:
+        f.result()
+
+    if out is not A:
+        out[...] = A
+    return out
+
+def eigpow(A, e, inplace=True, nthread=0):
+    """Raise each symmetric matrix in A to the power e. Eigenvalues that are
+    not positive are set to 0 in the output.
+
+    Parameters
+    ----------
+    A : (ncomp*(ncomp+1)/2, ...) np.ndarray
+        Flattened upper triangles of the matrices, see utils.to_flat_triu.
+    e : scalar
+        The power.
+    inplace : bool, optional
+        Overwrite A with the result, by default True.
+    nthread : int, optional
+        The number of threads, by default 0.
+        If 0, use output of utils.get_cpu_count().
+
+    Returns
+    -------
+    (ncomp*(ncomp+1)/2, ...) np.ndarray
+        Flattened upper triangles of the symmetric matrix powers.
+
+    Notes
+    -----
+    1x1 and 2x2 matrices are done in closed form. Larger matrices are 
+    eigendecomposed with numpy. Both are done in double precision, one chunk
+    at a time, and the result is cast back to the precision of A.
+    """
+    ncomp = utils.triangular_idx(A.shape[0])
+    if not inplace:
+        A = A.copy()
+
+    def f(w):
+        # like the eigendecomposition, clip the eigenvalues
+        out = np.zeros_like(w)
+        np.power(w, e, out=out, where=w > 0)
+        return out
+
+    if ncomp == 1:
+        def _eigpow(a):
+            a[:] = f(a)
+
+    elif ncomp == 2:
+        # for A = [[a, b], [b, d]] with eigenvalues m +/- r,
+        # A**e = (f(m + r) + f(m - r))/2 * I + (f(m + r) - f(m - r))/2r * (A - m*I)
+        def _eigpow(a):
+            _a = a.astype(np.float64)
+            m = (_a[0] + _a[1]) / 2
+            h = (_a[0] - _a[1]) / 2
+            r = np.hypot(h, _a[2])
+            fp, fm = f(m + r), f(m - r)
+            c0 = (fp + fm) / 2
+            c1 = np.divide(fp - fm, 2*r, out=np.zeros_like(r), where=r > 0)
+            a[0] = c0 + c1*h
+            a[1] = c0 - c1*h
+            a[2] = c1*_a[2]
+
+    else:
+        idxs = _get_flat_triu_idxs(ncomp)
+        rows, cols = utils.triu_indices(ncomp)
+        def _eigpow(a):
+            mat = np.moveaxis(a[idxs].astype(np.float64), (0, 1), (-2, -1))
+            w, v = np.linalg.eigh(mat)
+            mat = np.einsum('...ab, ...b, ...cb -> ...ac', v, f(w), v)
+            a[:] = np.moveaxis(mat[..., rows, cols], -1, 0)
+
+    return _map_chunks(_eigpow, A, nthread=nthread)
+
+def cholesky(A, inplace=True, nthread=0):
+    """Find the upper-triangular factor R of each symmetric positive
+    semidefinite matrix in A, such that A = R.T @ R.
+
+    Parameters
+    ----------
+    A : (ncomp*(ncomp+1)/2, ...) np.ndarray
+        Flattened upper triangles of the matrices, see utils.to_flat_triu.
+    inplace : bool, optional
+        Overwrite A with the result, by default True.
+    nthread : int, optional
+        The number of threads, by default 0.
+        If 0, use output of utils.get_cpu_count().
+
+    Returns
+    -------
+    (ncomp*(ncomp+1)/2, ...) np.ndarray
+        Flattened upper triangles of the factors, in the precision of A. Each
+        is a square root of the corresponding matrix (R.T @ R = A), though
+        not a symmetric one, and is much faster to find than with eigpow.
+
+    Notes
+    -----
+    The factorization is done in double precision, one chunk at a time. 
+    Matrices that are zero along the diagonal are zero in the same row of 
+    R. Matrices that are singular (or indefinite) to within the precision 
+    of A are instead factored by a QR decomposition of their symmetric 
+    square root, i.e. as with eigpow, which clips negative eigenvalues.
+    """
+    ncomp = utils.triangular_idx(A.shape[0])
+    if not inplace:
+        A = A.copy()
+    idxs = _get_flat_triu_idxs(ncomp)
+    rows, cols = utils.triu_indices(ncomp)
+    tol = 10 * ncomp * np.finfo(A.dtype).eps
+
+    def _cholesky(a):
+        # each element of _a is only read before it is overwritten with R
+        _a = a.astype(np.float64)
+        bad = np.zeros(_a.shape[1:], dtype=bool)
+        for j in range(ncomp):
+            ajj = _a[idxs[j, j]].copy()
+            d = ajj.copy()
+            for k in range(j):
+                d -= _a[idxs[k, j]]**2
+            good = d > tol * ajj
+            bad |= np.logical_and(ajj > 0, ~good)
+            np.sqrt(d, out=d, where=good)
+            d[~good] = 0
+            _a[idxs[j, j]] = d
+
+            inv_d = np.divide(1, d, out=np.zeros_like(d), where=good)
+            for i in range(j+1, ncomp):
+                s = _a[idxs[j, i]].copy()
+                for k in range(j):
+                    s -= _a[idxs[k, j]] * _a[idxs[k, i]]
+                _a[idxs[j, i]] = s * inv_d
+
+        if np.any(bad):
+            # the symmetric square root S = Q @ R, so A = S.T @ S = R.T @ R
+            mat = a[:, bad].astype(np.float64)
+            mat = eigpow(mat, 0.5, nthread=1)
+            mat = np.moveaxis(mat[idxs], (0, 1), (-2, -1))
+            mat = np.linalg.qr(mat, mode='r')
+            _a[:, bad] = np.moveaxis(mat[..., rows, cols], -1, 0)
+        a[:] = _a
+
+    return _map_chunks(_cholesky, A, nthread=nthread)
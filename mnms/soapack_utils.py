@@ -1,7 +1,9 @@
 from pixell import enmap
 from soapack.interfaces import DR6v3
+import numpy as np
 
 import re
+import os
 
 # helper functions to add features to soapack data models
 
@@ -151,3 +153,148 @@ def get_mult_fact(data_model, qid, ivar=False):
         return 1/data_model.get_gain(qid)**2
     else:
         return data_model.get_gain(qid)
+
+class FakeDataModel:
+
+    def __init__(self, data_path, qids=('fake_pa0',), num_splits=4,
+                 box_deg=[[-15, 15], [15, -15]], res_arcmin=2., ncomp=3,
+                 noise_uK_arcmin=30., ell_knee=2000., alpha_knee=-3.,
+                 dtype=np.float32, seed=0, name='fake', noise_seed_index=999,
+                 overwrite=False):
+        """A stand-in for a soapack.DataModel that generates random data splits,
+        ivars, and a mask on a CAR geometry, for testing and benchmarking 
+        without real data on disk. Products are written to data_path the
+        first time they are needed and are a deterministic function of the 
+        constructor arguments.
+
+        Parameters
+        ----------
+        data_path : path-like
+            Directory to hold the generated products.
+        qids : iterable of str, optional
+            The array 'qids' to generate products for, by default ('fake_pa0',).
+            Each qid's noise is independent.
+        num_splits : int, optional
+            The number of data splits per qid, by default 4.
+        box_deg : (2, 2) iterable, optional
+            The [[dec_from, ra_from], [dec_to, ra_to]] corners of the map in
+            degrees, by default [[-15, 15], [15, -15]].
+        res_arcmin : float, optional
+            The pixel size in arcmin, by default 2.
+        ncomp : int, optional
+            The number of polarization components of each map, by default 3.
+        noise_uK_arcmin : float, optional
+            The mean white-noise level of the coadd temperature map, by 
+            default 30. Polarization noise is sqrt(2) higher.
+        ell_knee : float, optional
+            The knee of the 1/f part of the noise power, by default 2000.
+        alpha_knee : float, optional
+            The slope of the 1/f part of the noise power, by default -3.
+        dtype : np.dtype, optional
+            The dtype of the products, by default np.float32.
+        seed : int, optional
+            Seeds the products, by default 0.
+        name : str, optional
+            The data model name used in product filenames, by default 'fake'.
+        noise_seed_index : int, optional
+            Stands in for soapack.interfaces.noise_seed_indices[name] when 
+            seeding sims, by default 999.
+        overwrite : bool, optional
+            Regenerate products even if they are already in data_path, by
+            default False.
+
+        Notes
+        -----
+        The noise of each split is an isotropic white plus 1/f spectrum, 
+        modulated by the split's smoothly-varying depth; the 1/f part is
+        flat below ell_knee/4. The outer ~1 degree
+        of each ivar map is zero, and the mask is an apodized version of the
+        observed region.
+        """
+        import pandas as pd
+
+        self.apath = str(data_path)
+        self.name = name
+        self.dtype = dtype
+        self.noise_seed_index = noise_seed_index
+        self.adf = pd.DataFrame({'#qid': list(qids), 'nsplits': num_splits})
+
+        self._qids = list(qids)
+        self._num_splits = num_splits
+        self._box = np.deg2rad(box_deg)
+        self._res = np.deg2rad(res_arcmin / 60)
+        self._ncomp = ncomp
+        self._noise_uK_arcmin = noise_uK_arcmin
+        self._ell_knee = ell_knee
+        self._alpha_knee = alpha_knee
+        self._seed = seed
+
+        os.makedirs(self.apath, exist_ok=True)
+        for i, qid in enumerate(self._qids):
+            fns = [self.get_map_fname(qid, s, ivar) for s in range(num_splits) for ivar in (False, True)]
+            fns.append(self.get_binary_apodized_mask_fname(qid))
+            if overwrite or not all(os.path.isfile(fn) for fn in fns):
+                self._write_products(i, qid)
+
+    def get_map_fname(self, qid, split_num=0, ivar=False, **kwargs):
+        """Return the filename of a split map or ivar. The coadd filename
+        follows from replacing '_set{split_num}_' with '_coadd_'."""
+        mstr = 'ivar' if ivar else 'map'
+        return os.path.join(self.apath, f'{qid}_set{split_num}_{mstr}.fits')
+
+    def get_binary_apodized_mask_fname(self, qid, version=None, galcut=None, apod_deg=None):
+        """Return the filename of the mask. The other arguments are ignored."""
+        return os.path.join(self.apath, f'{qid}_mask.fits')
+
+    def get_gain(self, qid):
+        return 1.
+
+    def _write_products(self, qidx, qid):
+        """Generate and write the split maps and ivars, their coadds, and the 
+        mask, for one qid."""
+        rng = np.random.default_rng([self._seed, qidx])
+        shape, wcs = enmap.geometry(self._box, res=self._res, proj='car')
+        pad = int(np.ceil(np.deg2rad(1) / self._res))
+
+        # the observed region is apodized over its outer degree
+        obs = enmap.zeros(shape, wcs, dtype=self.dtype)
+        obs[pad:-pad, pad:-pad] = 1
+        mask = enmap.apod(obs, pad)
+        mask *= obs
+        enmap.write_map(self.get_binary_apodized_mask_fname(qid), mask)
+
+        # coadd ivar in 1/uK^2 per pixel, with a smooth random depth pattern
+        pix_arcmin2 = enmap.pixsizemap(shape, wcs) * (180 * 60 / np.pi)**2
+        depth = enmap.enmap(rng.standard_normal(shape), wcs)
+        depth = enmap.smooth_gauss(depth, np.deg2rad(3))
+        depth = 1 + 0.5 * depth / np.abs(depth).max()
+        ivar = depth * pix_arcmin2 / self._noise_uK_arcmin**2 * obs
+
+        # the noise power in units of per-pixel white-noise variance. the 1/f
+        # part is flat below ell_knee/4 so it doesn't swamp the white noise
+        ell = np.arange(int(np.pi / self._res) + 1)
+        ps = 1 + (np.maximum(ell, self._ell_knee / 4) / self._ell_knee)**self._alpha_knee
+        ps = np.einsum('ab, l -> abl', np.eye(self._ncomp), ps * enmap.pixsize(shape, wcs))
+        pol_fact = np.sqrt([1] + [2] * (self._ncomp - 1)).reshape(-1, 1, 1)
+
+        cmap = enmap.zeros((self._ncomp, *shape), wcs, dtype=self.dtype)
+        cvar = enmap.zeros((1, *shape), wcs, dtype=self.dtype)
+        for s in range(self._num_splits):
+            ivar_s = ivar * rng.uniform(0.8, 1.2) / self._num_splits
+            ivar_s = ivar_s.astype(self.dtype)[None]
+
+            noise = enmap.rand_map(
+                (self._ncomp, *shape), wcs, ps, scalar=True,
+                seed=int(rng.integers(2**32))
+                )
+            std = np.divide(1, np.sqrt(ivar_s), where=ivar_s > 0, out=np.zeros_like(ivar_s))
+            imap = (noise * std * pol_fact).astype(self.dtype)
+
+            enmap.write_map(self.get_map_fname(qid, s, ivar=False), imap)
+            enmap.write_map(self.get_map_fname(qid, s, ivar=True), ivar_s)
+            cmap += imap * ivar_s
+            cvar += ivar_s
+
+        cmap = np.divide(cmap, cvar, where=cvar > 0, out=np.zeros_like(cmap))
+        enmap.write_map(self.get_map_fname(qid, 0, ivar=False).replace('_set0_', '_coadd_'), cmap)
+        enmap.write_map(self.get_map_fname(qid, 0, ivar=True).replace('_set0_', '_coadd_'), cvar)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+from contextlib import contextmanager
+from collections import deque
+import threading
+import resource
+import time
+import json
+import os
+
+# Named, nestable timing spans for the stages of building models and drawing
+# sims, e.g. 'load', 'inpaint', 'kfilt', 'downgrade', 'ell-filter', 'k2wav',
+# 'outer-product', 'smooth', 'eigpow', 'draw', 'synth', and 'write'. Spans are
+# disabled by default and cost one attribute lookup when disabled. Enable them
+# with enable(...), or by setting the MNMS_TELEMETRY environment variable to
+# a JSON-lines filename (or to 1, to only keep the records in memory). A span
+# given a show message also prints its wall time and message when it ends,
+# whether or not telemetry is enabled.
+
+# the maximum number of spans kept in memory; the oldest are dropped. spans
+# written to a file are not kept in memory
+MAX_RECORDS = 100_000
+
+_enabled = False
+_file = None
+_records = deque(maxlen=MAX_RECORDS)
+_lock = threading.Lock()
+_local = threading.local()
+
+def enable(fname=None):
+    """Start recording spans.
+
+    Parameters
+    ----------
+    fname : path-like, optional
+        If provided, append each span to this file as a line of JSON when it
+        ends, instead of keeping it in memory, by default None. The file is
+        kept open until disable is called.
+    """
+    global _enabled, _file
+    with _lock:
+        if _file is not None:
+            _file.close()
+        # line-buffered, so that each span is one append to the file, even if
+        # other processes append to it too
+        _file = open(fname, 'a', buffering=1) if fname is not None else None
+    _enabled = True
+
+def disable():
+    """Stop recording spans, and close the file of enable, if any. Already-
+    recorded spans are kept."""
+    global _enabled, _file
+    _enabled = False
+    with _lock:
+        if _file is not None:
+            _file.close()
+        _file = None
+
+def is_enabled():
+    return _enabled
+
+def clear():
+    """Forget all recorded spans."""
+    with _lock:
+        _records.clear()
+
+def get_records():
+    """Return a list of the spans recorded in memory, i.e. while enabled 
+    without a file, in the order they ended. At most the last MAX_RECORDS
+    spans are kept. Spans written to a file can be read with read_records.
+    Each span is a dict with keys:
+
+    name : the span name.
+    path : the '/'-joined names of the enclosing spans in this thread,
+        ending with this span's name.
+    depth : the number of enclosing spans.
+    wall : wall-clock time in seconds.
+    cpu : process CPU time in seconds, summed over all threads.
+    peak_rss_delta : growth in bytes of the process peak resident memory,
+        i.e. of the process-wide ru_maxrss high-water mark, during the span.
+        This is not the peak memory of the span itself: it is 0 for a span 
+        that stays below an earlier peak, and includes allocations by other
+        threads running concurrently.
+    pid, thread : the process and thread ids.
+    attrs : the keyword arguments passed to span.
+    """
+    with _lock:
+        return list(_records)
+
+def _get_maxrss():
+    """Return the peak resident memory of this process in bytes"""
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _to_line(record):
+    return json.dumps(record, default=str) + '\n'
+
+@contextmanager
+def span(name, show=None, **attrs):
+    """Time the enclosed block as a span called name, if telemetry is enabled.
+
+    Parameters
+    ----------
+    name : str
+        The name of the span.
+    show : str, optional
+        If provided, print the wall time of the block followed by this message
+        when it ends, even if telemetry is disabled, by default None.
+    attrs : dict, optional
+        JSON-serializable information to record with the span, e.g. a split
+        number.
+
+    Examples
+    --------
+    >>> with telemetry.span('eigpow', kernel=(3, 1)):
+    >>>     smallmat.eigpow(...)
+    """
+    enabled = _enabled
+    if not enabled and show is None:
+        yield
+        return
+
+    if enabled:
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(name)
+        c0, r0 = time.process_time(), _get_maxrss()
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - t0
+        if show is not None:
+            print(f'{wall:.3f} {show}')
+        if enabled:
+            record = dict(
+                name=name, path='/'.join(stack), depth=len(stack) - 1,
+                wall=wall, cpu=time.process_time() - c0,
+                peak_rss_delta=_get_maxrss() - r0, pid=os.getpid(),
+                thread=threading.get_ident(), attrs=attrs
+                )
+            stack.pop()
+            _record(record)
+
+def _record(record):
+    """Keep the ended span record in memory, or write it to the file"""
+    # serialize outside the lock
+    line = _to_line(record) if _file is not None else None
+    with _lock:
+        if _file is None:
+            _records.append(record)
+        else:
+            _file.write(line if line is not None else _to_line(record))
+
+def read_records(fname):
+    """Return the spans in a JSON-lines file written by enabled telemetry."""
+    with open(fname, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize(records=None):
+    """Aggregate spans by path.
+
+    Parameters
+    ----------
+    records : list of dict, optional
+        The spans to aggregate, by default None. If None, use get_records().
+
+    Returns
+    -------
+    dict
+        For each path, sorted so that spans follow their parents, a dict 
+        with the number of spans ('count'), their total 'wall' and 'cpu' 
+        times, and the max 'peak_rss_delta'.
+    """
+    if records is None:
+        records = get_records()
+
+    summary = {}
+    for record in sorted(records, key=lambda r: r['path']):
+        s = summary.setdefault(
+            record['path'], dict(count=0, wall=0., cpu=0., peak_rss_delta=0)
+            )
+        s['count'] += 1
+        s['wall'] += record['wall']
+        s['cpu'] += record['cpu']
+        s['peak_rss_delta'] = max(s['peak_rss_delta'], record['peak_rss_delta'])
+    return summary
+
+def format_summary(records=None):
+    """Return the output of summarize as a table string."""
+    summary = summarize(records)
+
+    width = max([len('span')] + [len(p) for p in summary])
+    lines = [f'{"span":<{width}} {"count":>7} {"wall [s]":>10} {"cpu [s]":>10} {"peak rss [GB]":>14}']
+    for path, s in summary.items():
+        lines.append(
+            f'{path:<{width}} {s["count"]:>7d} {s["wall"]:>10.3f} {s["cpu"]:>10.3f} ' + \
+            f'{s["peak_rss_delta"]/1e9:>14.3f}'
+            )
+    return '\n'.join(lines)
+
+_env = os.environ.get('MNMS_TELEMETRY')
+if _env:
+    enable(fname=None if _env == '1' else _env)
@@ -5,6 +5,11 @@ import astropy.io.fits as pyfits
 import numpy as np
 # from numba import jit, njit
 from math import ceil
+from concurrent import futures
+from collections import OrderedDict
+import functools
+import copy
+import threading
 
 import warnings
 
@@ -14,27 +19,45 @@ PIX_PAD_DFACT = 2
 PIX_CROSSFADE_DFACT = 4
 TILE_SIZE_DFACT = np.lcm.reduce([PIX_PAD_DFACT, PIX_CROSSFADE_DFACT])
 
+# the maximum number of crossfade and border windows to keep, see _get_crossfade
+MAX_WINDOWS = 32
+
+# the maximum number of tiling plans to keep, see get_tiling_plan
+MAX_PLANS = 32
+
 # # super clever trick from the NumPy docs!
 # NDARRAY_FUNCTIONS = {}
 
-class tiled_ndmap(enmap.ndmap):
-
-    def __new__(cls, imap, width_deg=4., height_deg=4., tiled=False, ishape=None, unmasked_tiles=None, *args, **kwargs):
-        
-        # need to do this so we go up to ndmap __new__ and set wcs etc, then come back here 
-        obj = super().__new__(cls, np.asarray(imap), imap.wcs) 
-        
-        # get ishape 
-        if tiled:
-            assert ishape is not None, 'Tiled tiled_ndmap instances must have an ishape'
-        else:
-            if ishape is not None:
-                assert ishape[-2:] == imap.shape[-2:], 'You may be passing bad args, imap shape and ishape are not compatible'
-            ishape = imap.shape
-        ishape = ishape[-2:]
+class TilingPlan:
+    """The tiling of a map geometry, holding everything about the tiles that
+    does not depend on the map data: the tile layout, the extract and insert
+    pixboxes, the apodization window and the geometry of each tile, and,
+    optionally, the unmasked tiles and their f_sky under a mask.
+
+    Parameters
+    ----------
+    ishape : iterable of int
+        The shape of the (untiled) map; only the last two axes are used.
+    wcs : astropy.wcs.WCS
+        The wcs of the map.
+    width_deg : scalar, optional
+        The characteristic tile width in degrees, by default 4.
+    height_deg : scalar, optional
+        The characteristic tile height in degrees, by default 4.
+
+    Notes
+    -----
+    Plans are immutable. The windows and tile geometries are computed when
+    first needed, and are shared by all plans of the same tiling, e.g. by
+    the masked plans returned by get_masked_plan. Use get_tiling_plan to
+    share plans across tiled_ndmap instances of the same tiling.
+    """
+
+    def __init__(self, ishape, wcs, width_deg=4., height_deg=4.):
+        ishape = tuple(int(n) for n in ishape[-2:])
 
         # the degrees per pixel, from the wcs
-        pix_deg_x, pix_deg_y = np.abs(imap.wcs.wcs.cdelt)
+        pix_deg_x, pix_deg_y = np.abs(wcs.wcs.cdelt)
 
         # gets size in pixels of tile, rounded down to nearest 4 pixels, because want pads
         # and crossfade sizes to divide evenly in pixel number
@@ -55,19 +78,163 @@ class tiled_ndmap(enmap.ndmap):
         # the number of tiles in each direction, rounded up to nearest integer
         numy, numx = np.ceil(np.asarray(ishape)/(pix_height, pix_width)).astype(int)
 
+        self.ishape = ishape
+        self.wcs = wcs
+        self.width_deg = float(width_deg)
+        self.height_deg = float(height_deg)
+
+        self.pix_width = pix_width
+        self.pix_height = pix_height
+        self.pix_pad_x = pix_pad_x
+        self.pix_pad_y = pix_pad_y
+        self.pix_cross_x = pix_cross_x
+        self.pix_cross_y = pix_cross_y
+        self.numx = numx
+        self.numy = numy
+
+        # the extract pixboxes start with the input map and extend in each direction 
+        # based on the padding. the insert pixboxes assume a "canvas" of shape
+        # original_map + the crossfade padding, hence start in the bottom left corner
+        # rather than "beyond the bottom left" corner like the extract pixboxes
+        i, j = np.divmod(np.arange(numy*numx), numx) # i counts up rows, j counts across columns
+        starts = np.stack([i*pix_height, j*pix_width], axis=-1)
+        self.epixboxes = np.stack([
+            starts - [pix_pad_y, pix_pad_x], starts + [pix_height + pix_pad_y, pix_width + pix_pad_x]
+            ], axis=1)
+        self.ipixboxes = np.stack([
+            starts, starts + [pix_height + 2*pix_cross_y, pix_width + 2*pix_cross_x]
+            ], axis=1)
+        self.epixboxes.setflags(write=False)
+        self.ipixboxes.setflags(write=False)
+
+        # the tiles that are unmasked under the mask of the plan, if any
+        self.unmasked_tiles = np.arange(numy*numx)
+
+        # lazily computed, and shared by copies of this plan
+        self._apods = {}
+        self._tile_geometries = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        """The key of this tiling in get_tiling_plan."""
+        return _get_tiling_plan_key(self.ishape, self.wcs, self.width_deg, self.height_deg)
+
+    @property
+    def tile_shape(self):
+        """The shape of each extracted tile."""
+        return (self.pix_height + 2*self.pix_pad_y, self.pix_width + 2*self.pix_pad_x)
+
+    def get_apod(self, dtype=np.float64):
+        """Return the (read-only) apodization window of the extracted tiles."""
+        dtype = np.dtype(dtype)
+        with self._lock:
+            apod = self._apods.get(dtype)
+            if apod is None:
+                apod = enmap.apod(
+                    np.ones(self.tile_shape), width=(self.pix_cross_y, self.pix_cross_x)
+                    ).astype(dtype)
+                apod.setflags(write=False)
+                self._apods[dtype] = apod
+        return apod
+
+    def get_tile_geometry(self, tile_idx):
+        """Return the (shape, wcs) geometry of an extracted tile."""
+        tile_idx = int(tile_idx)
+        with self._lock:
+            geometry = self._tile_geometries.get(tile_idx)
+        if geometry is None:
+            geometry = utils.slice_geometry_by_pixbox(
+                self.ishape, self.wcs, self.epixboxes[tile_idx]
+                )
+            with self._lock:
+                self._tile_geometries[tile_idx] = geometry
+        return geometry
+
+    def get_masked_plan(self, unmasked_tiles):
+        """Return a copy of this plan with the given unmasked tiles. The copy
+        shares the windows and tile geometries of this plan."""
+        plan = copy.copy(self)
+        plan.unmasked_tiles = np.array(unmasked_tiles, dtype=int)
+        plan.unmasked_tiles.setflags(write=False)
+        return plan
+
+def _get_tiling_plan_key(ishape, wcs, width_deg, height_deg):
+    return (
+        tuple(int(n) for n in ishape[-2:]), float(width_deg), float(height_deg),
+        tuple(wcs.wcs.ctype), tuple(wcs.wcs.crval), tuple(wcs.wcs.cdelt), tuple(wcs.wcs.crpix)
+        )
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+def get_tiling_plan(ishape, wcs, width_deg=4., height_deg=4.):
+    """Get the cached TilingPlan for this tiling of the geometry (ishape, wcs),
+    building it if it does not exist. See TilingPlan for the parameters.
+
+    Returns
+    -------
+    TilingPlan
+        The plan, with all tiles unmasked, shared by all callers in the process.
+    """
+    key = _get_tiling_plan_key(ishape, wcs, width_deg, height_deg)
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is None:
+            plan = TilingPlan(ishape, wcs, width_deg=width_deg, height_deg=height_deg)
+            _plans[key] = plan
+            if len(_plans) > MAX_PLANS:
+                _plans.popitem(last=False)
+        else:
+            _plans.move_to_end(key)
+    return plan
+
+class tiled_ndmap(enmap.ndmap):
+
+    def __new__(cls, imap, width_deg=4., height_deg=4., tiled=False, ishape=None, unmasked_tiles=None,
+                plan=None, *args, **kwargs):
+        
+        # need to do this so we go up to ndmap __new__ and set wcs etc, then come back here 
+        obj = super().__new__(cls, np.asarray(imap), imap.wcs) 
+        
+        # get ishape 
+        if tiled:
+            assert ishape is not None, 'Tiled tiled_ndmap instances must have an ishape'
+        else:
+            if ishape is not None:
+                assert ishape[-2:] == imap.shape[-2:], 'You may be passing bad args, imap shape and ishape are not compatible'
+            ishape = imap.shape
+        ishape = ishape[-2:]
+
+        # get the tiling. a plan that does not match the tiling of this map
+        # (e.g. passed along with other tiled_info) is replaced
+        if plan is None or plan.key != _get_tiling_plan_key(ishape, imap.wcs, width_deg, height_deg):
+            plan = get_tiling_plan(ishape, imap.wcs, width_deg=width_deg, height_deg=height_deg)
+
         obj.width_deg = float(width_deg)
         obj.height_deg = float(height_deg)
         obj.tiled = tiled
         obj.ishape = ishape
-
-        obj.pix_width = pix_width
-        obj.pix_height = pix_height
-        obj.pix_pad_x = pix_pad_x
-        obj.pix_pad_y = pix_pad_y
-        obj.pix_cross_x = pix_cross_x
-        obj.pix_cross_y = pix_cross_y
-        obj.numx = numx
-        obj.numy = numy
+        obj.plan = plan
+
+        obj.pix_width = plan.pix_width
+        obj.pix_height = plan.pix_height
+        obj.pix_pad_x = plan.pix_pad_x
+        obj.pix_pad_y = plan.pix_pad_y
+        obj.pix_cross_x = plan.pix_cross_x
+        obj.pix_cross_y = plan.pix_cross_y
+        obj.numx = plan.numx
+        obj.numy = plan.numy
+        numx, numy = obj.numx, obj.numy
 
         # build the unmasked tiles
         if unmasked_tiles is not None:
@@ -97,6 +264,7 @@ class tiled_ndmap(enmap.ndmap):
         self.height_deg = getattr(obj, "height_deg", None)
         self.tiled = getattr(obj, "tiled", None)
         self.ishape = getattr(obj, "ishape", None)
+        self.plan = getattr(obj, "plan", None)
         
         # derived tiled_ndmap attrs
         self.pix_width = getattr(obj, "pix_width", None)
@@ -180,12 +348,12 @@ class tiled_ndmap(enmap.ndmap):
     #     arr = utils.from_flat_triu(self, axis1=axis1, axis2=axis2, flat_triu_axis=flat_triu_axis) 
     #     return self.sametiles(enmap.ndmap(np.asarray(arr), self.wcs))
 
+    # the apodization window of the extracted tiles. the default window is
+    # cached by the plan and read-only
     def apod(self, width=None):
         if width is None:
-            width = (self.pix_cross_y, self.pix_cross_x)
-        return enmap.apod(np.ones((
-            self.pix_height + 2*self.pix_pad_y,
-            self.pix_width + 2*self.pix_pad_x)), width=width).astype(self.dtype)
+            return self.plan.get_apod(self.dtype)
+        return enmap.apod(np.ones(self.plan.tile_shape), width=width).astype(self.dtype)
 
     def set_unmasked_tiles(self, mask, is_mask_tiled=False, min_sq_f_sky=MIN_SQ_F_SKY, return_sq_f_sky=False):
         assert wcsutils.is_compatible(self.wcs, mask.wcs), 'Current wcs and mask wcs are not compatible'
@@ -212,50 +380,57 @@ class tiled_ndmap(enmap.ndmap):
         unmasked_tiles = np.nonzero(sq_f_sky >= min_sq_f_sky)[0]
         self.unmasked_tiles = unmasked_tiles
         self.num_tiles = len(unmasked_tiles)
+        self.plan = self.plan.get_masked_plan(unmasked_tiles)
 
         if return_sq_f_sky:
             return sq_f_sky[unmasked_tiles]
         else:
             return None
 
-    def _crossfade(self):
-        return utils.linear_crossfade(self.pix_height+2*self.pix_cross_y, self.pix_width+2*self.pix_cross_x,
-                                                2*self.pix_cross_y, 2*self.pix_cross_x)
+    def _crossfade(self, power=1.0):
+        return _get_crossfade(self.pix_height+2*self.pix_cross_y, self.pix_width+2*self.pix_cross_x,
+                              2*self.pix_cross_y, 2*self.pix_cross_x, power=power)
 
-    # generator for the extract pixbox. this starts with the input map and extends in each direction based on the padding
+    # the extract pixbox. this starts with the input map and extends in each direction based on the padding
     def _get_epixbox(self, tile_idx):
-        i, j = divmod(tile_idx, self.numx) # i counts up rows, j counts across columns
-        sy = i*self.pix_height
-        sx = j*self.pix_width
-        return np.asarray([[sy - self.pix_pad_y, sx - self.pix_pad_x],
-        [sy + self.pix_height + self.pix_pad_y, sx + self.pix_width + self.pix_pad_x]])
+        return self.plan.epixboxes[tile_idx]
 
-    # generator for the insert pixbox. this starts assuming a "canvas" of shape original_map + the crossfade
+    # the insert pixbox. this starts assuming a "canvas" of shape original_map + the crossfade
     # padding, hence starts in the bottom left corner rather than "beyond the bottom left" corner like the 
     # extract pixboxes
     def _get_ipixbox(self, tile_idx):
-        i, j = divmod(tile_idx, self.numx) # i counts up rows, j counts across columns
-        sy = i*self.pix_height 
-        sx = j*self.pix_width
-        return np.asarray([[sy, sx],
-        [sy + self.pix_height + 2*self.pix_cross_y, sx + self.pix_width + 2*self.pix_cross_x]])
-
-    # for each tile, extract the pixbox and place it in a tiled structure
-    def to_tiled(self):
+        return self.plan.ipixboxes[tile_idx]
+
+    # for each tile, extract the pixbox and place it in a tiled structure. tiles inside the
+    # map are copied directly from a view of the map, only tiles that wrap around or hang
+    # off the map edges need extract_pixbox
+    def to_tiled(self, nthread=0):
         assert self.tiled is False,'Can only slice out tiles if object not yet tiled'
         
         # create dummy array to fill with extracted tiles
         oshape_y = self.pix_height + 2*self.pix_pad_y
         oshape_x = self.pix_width + 2*self.pix_pad_x
         oshape = (self.num_tiles,) + self.shape[:-2] + (oshape_y, oshape_x) # add tiles axis to first axis
-        omap = np.zeros(oshape, dtype=self.dtype)
+        omap = np.empty(oshape, dtype=self.dtype)
         
         # extract_pixbox doesn't play nicely with ishape assertion in constructor so
         # cast to ndmap first
         imap = self.to_ndmap() 
-        for i, n in enumerate(self.unmasked_tiles):
+
+        def _extract(i, n):
             p = self._get_epixbox(n)
-            omap[i] = enmap.extract_pixbox(imap, p, cval=0.)
+            if np.all(p[0] >= 0) and np.all(p[1] <= self.ishape[-2:]):
+                omap[i] = imap[..., p[0,0]:p[1,0], p[0,1]:p[1,1]]
+            else:
+                omap[i] = enmap.extract_pixbox(imap, p, cval=0.)
+
+        # perform multithreaded execution
+        if nthread == 0:
+            nthread = utils.get_cpu_count()
+        executor = futures.ThreadPoolExecutor(max_workers=nthread)
+        fs = [executor.submit(_extract, i, n) for i, n in enumerate(self.unmasked_tiles)]
+        for f in fs:
+            f.result()
         
         omap = enmap.ndmap(omap, self.wcs)
         return self.sametiles(omap, tiled=True)
@@ -264,44 +439,106 @@ class tiled_ndmap(enmap.ndmap):
     # we make a "canvas" to place the fullsize cropped tiles in, then slice the canvas down to the 
     # proper size of the original data (avoids wrapping bug). 
     # also need to divide out the global "border" since we don't want any crossfade original in the 
-    # final map
-    def from_tiled(self, power=1.0, return_as_enmap=True):
+    # final map.
+    # the tiles are added concurrently into disjoint bands of canvas rows, one band per row of tiles,
+    # so no two threads write the same pixel. each band adds its tiles in order, so the stitched map
+    # does not depend on the number of threads
+    def from_tiled(self, power=1.0, return_as_enmap=True, pixbox=None, nthread=0):
         assert self.tiled is True, 'Can only stitch tiles if object is already tiled'
 
-        # get empty "canvas" we will place tiles on
+        # get empty "canvas" we will place tiles on. if stitching only a pixbox
+        # of the original map, the canvas is just the pixbox (offset by the 
+        # crossfade padding), and only the tiles overlapping it are placed
         oshape_y = self.numy * self.pix_height + 2*self.pix_cross_y
         oshape_x = self.numx * self.pix_width + 2*self.pix_cross_x
-        oshape = self.shape[1:-2] + (oshape_y, oshape_x) # get rid of first (tiles) axis, and tile ny, nx
+        if pixbox is None:
+            pixbox = np.array([[0, 0], self.ishape[-2:]])
+            cbox = np.array([[0, 0], [oshape_y, oshape_x]])
+        else:
+            pixbox = self._check_pixbox(pixbox)
+            cbox = pixbox + [self.pix_cross_y, self.pix_cross_x]
+        oshape = self.shape[1:-2] + tuple(cbox[1] - cbox[0]) # get rid of first (tiles) axis, and tile ny, nx
         omap = np.zeros(oshape, dtype=self.dtype)
         
-        # set some more quantities before iterating
         # to speed things up, don't want to construct new tiled_ndmap for each imap[i], so cast to array
-        # then crop and and crossfade before stitching
+        # then crop and crossfade each tile while stitching
         imap = np.asarray(self)
         imap = utils.crop_center(imap, self.pix_height + 2*self.pix_cross_y, self.pix_width + 2*self.pix_cross_x)
-        imap *= self._crossfade()**power
-
-        # place all the unmasked tiles, 0 for the rest
-        for i, n in enumerate(self.unmasked_tiles):
-            p = self._get_ipixbox(n)
-            omap[..., p[0,0]:p[1,0], p[0,1]:p[1,1]] += imap[i]
-
-        # correct for crossfade around borders
-        border = utils.linear_crossfade(oshape_y, oshape_x, 2*self.pix_cross_y, 2*self.pix_cross_x)**power
-        border[border == 0] += 1e-14 # add tiny numbers to 0's in border to avoid runtime warning
-        omap /= border
+        crossfade = self._crossfade(power=power)
+        ipixboxes = self.plan.ipixboxes[self.unmasked_tiles]
+
+        def _stitch(band):
+            # place all the unmasked tiles overlapping the band, 0 for the rest
+            blo = np.maximum([band[0], cbox[0,1]], cbox[0])
+            bhi = np.minimum([band[1], cbox[1,1]], cbox[1])
+            if np.any(bhi <= blo):
+                return
+            overlap = np.all(
+                np.minimum(ipixboxes[:, 1], bhi) > np.maximum(ipixboxes[:, 0], blo), axis=-1
+                )
+            for i in np.nonzero(overlap)[0]:
+                p = ipixboxes[i]
+                lo = np.maximum(p[0], blo)
+                hi = np.minimum(p[1], bhi)
+                tsel = np.s_[lo[0]-p[0,0]:hi[0]-p[0,0], lo[1]-p[0,1]:hi[1]-p[0,1]]
+                tile = np.multiply(imap[i, ..., tsel[0], tsel[1]], crossfade[tsel], dtype=omap.dtype)
+                omap[..., lo[0]-cbox[0,0]:hi[0]-cbox[0,0], lo[1]-cbox[0,1]:hi[1]-cbox[0,1]] += tile
+
+        # the last band includes the crossfade padding at the bottom of the canvas
+        bands = [[i*self.pix_height, (i+1)*self.pix_height] for i in range(self.numy)]
+        bands[-1][1] = oshape_y
+
+        # perform multithreaded execution
+        if nthread == 0:
+            nthread = utils.get_cpu_count()
+        executor = futures.ThreadPoolExecutor(max_workers=nthread)
+        fs = [executor.submit(_stitch, band) for band in bands]
+        for f in fs:
+            f.result()
+
+        # correct for crossfade around borders. the border is 1 away from the
+        # canvas edges, so only the edge strips need to be divided
+        fys, fxs = _get_crossfade_1d(oshape_y, oshape_x, 2*self.pix_cross_y, 2*self.pix_cross_x)
+        fys = fys[cbox[0,0]:cbox[1,0]]
+        fxs = fxs[cbox[0,1]:cbox[1,1]]
+        ysels = _get_edge_slices(fys)
+        xsels = _get_edge_slices(fxs)
+        inner_ysel = slice(ysels[0].stop, ysels[1].start)
+        for ysel, xsel in [(ysels[0], slice(None)), (ysels[1], slice(None)),
+                           (inner_ysel, xsels[0]), (inner_ysel, xsels[1])]:
+            border = fys[ysel, None] * fxs[None, xsel]
+            border = border**power
+            border[border == 0] += 1e-14 # add tiny numbers to 0's in border to avoid runtime warning
+            omap[..., ysel, xsel] /= border
 
         # cutout footprint of original map
-        omap = enmap.ndmap(omap[..., self.pix_cross_y:self.pix_cross_y + self.ishape[-2],
-                                self.pix_cross_x:self.pix_cross_x + self.ishape[-1]], self.wcs) 
+        _, owcs = utils.slice_geometry_by_pixbox(self.ishape, self.wcs, pixbox)
+        omap = enmap.ndmap(omap[..., pixbox[0,0]-cbox[0,0]+self.pix_cross_y:pixbox[1,0]-cbox[0,0]+self.pix_cross_y,
+                                pixbox[0,1]-cbox[0,1]+self.pix_cross_x:pixbox[1,1]-cbox[0,1]+self.pix_cross_x], owcs) 
         if return_as_enmap:
             return omap
         else:
             return self.sametiles(omap, tiled=False)
 
+    def _check_pixbox(self, pixbox):
+        pixbox = np.asarray(pixbox, dtype=int)
+        assert pixbox.shape == (2, 2), 'pixbox must be [[y0, x0], [y1, x1]]'
+        assert np.all(pixbox[0] >= 0) and np.all(pixbox[1] <= self.ishape[-2:]) and \
+            np.all(pixbox[0] < pixbox[1]), \
+            f'pixbox {pixbox.tolist()} must be a nonempty region of the map of shape {self.ishape[-2:]}'
+        return pixbox
+
+    def get_overlapping_tiles(self, pixbox):
+        """Return the unmasked tiles that contribute to the stitched map in
+        the region pixbox = [[y0, x0], [y1, x1]] of the original map."""
+        pixbox = self._check_pixbox(pixbox)
+        cbox = pixbox + [self.pix_cross_y, self.pix_cross_x]
+        p = self.plan.ipixboxes[self.unmasked_tiles]
+        overlap = np.all(np.minimum(p[:, 1], cbox[1]) > np.maximum(p[:, 0], cbox[0]), axis=-1)
+        return self.unmasked_tiles[overlap]
+
     def get_tile_geometry(self, tile_idx):
-        p = self._get_epixbox(tile_idx)
-        return utils.slice_geometry_by_pixbox(self.ishape, self.wcs, p)
+        return self.plan.get_tile_geometry(tile_idx)
 
     def get_tile(self, tile_idx):        
         if self.tiled:
@@ -316,6 +553,31 @@ class tiled_ndmap(enmap.ndmap):
     def write(self, fname, extra=None):
         write_tiled_ndmap(fname, self, extra=extra)
 
+# the crossfade and border windows only depend on the tiling geometry, and
+# are needed for every stitched map, so they are cached. the cached arrays
+# are shared, so they are made read-only
+@functools.lru_cache(maxsize=MAX_WINDOWS)
+def _get_crossfade_1d(cNy, cNx, npix_y, npix_x):
+    fys, fxs = utils.linear_crossfade_1d(cNy, cNx, npix_y, npix_x=npix_x)
+    fys.setflags(write=False)
+    fxs.setflags(write=False)
+    return fys, fxs
+
+@functools.lru_cache(maxsize=MAX_WINDOWS)
+def _get_crossfade(cNy, cNx, npix_y, npix_x, power=1.0):
+    fys, fxs = _get_crossfade_1d(cNy, cNx, npix_y, npix_x)
+    crossfade = (fys[:,None] * fxs[None,:])**power
+    crossfade.setflags(write=False)
+    return crossfade
+
+def _get_edge_slices(f):
+    """Return the slices of the leading and trailing elements of the 1d window
+    f that are not 1. The slices are empty if there are none."""
+    inner = np.nonzero(f == 1)[0]
+    if len(inner) == 0:
+        return slice(0, len(f)), slice(len(f), len(f))
+    return slice(0, inner[0]), slice(inner[-1]+1, len(f))
+
 # you can change no parameters (default) or pass specific parameters to change as kwargs
 def sametiles(arr, tiled_imap, samedtype=True, **kwargs):
     if samedtype:
@@ -333,7 +595,8 @@ def tiled_info(tiled_imap, pop=None):
         height_deg=tiled_imap.height_deg, 
         tiled=tiled_imap.tiled,
         ishape=tiled_imap.ishape,
-        unmasked_tiles=tiled_imap.unmasked_tiles
+        unmasked_tiles=tiled_imap.unmasked_tiles,
+        plan=tiled_imap.plan
     )
     if pop is not None:
         for key in pop:
@@ -342,8 +605,51 @@ def tiled_info(tiled_imap, pop=None):
 
 ### I/O ###
 
+# lossless FITS tile compressions for write_tiled_ndmap. 'gzip' is gzip of 
+# the byte-shuffled data, without the (lossy) float quantization of FITS
+FITS_COMPRESSION = {'gzip': 'GZIP_2'}
+
+# quantizations for write_tiled_ndmap. FITS has no half-precision floats, 
+# and stores scaled integers with a single BSCALE
+FITS_QUANTIZE = ('int16',)
+
 # adapted from enmap.write_fits, but with added stuff for tiled_ndmap objects
-def write_tiled_ndmap(fname, imap, extra_header=None, extra_hdu=None):
+def write_tiled_ndmap(fname, imap, extra_header=None, extra_hdu=None,
+                      compression=None, quantize=None):
+    """Write a tiled_ndmap to a FITS file. The map is in HDU 0 unless
+    compressed, the unmasked tiles follow it, and then any extra_hdu.
+
+    Parameters
+    ----------
+    fname : path-like
+        Destination on-disk for file.
+    imap : tiled_ndmap
+        The map to write.
+    extra_header : dict, optional
+        Extra header cards, by default None.
+    extra_hdu : dict, optional
+        Extra arrays, each written to its own HDU, by default None.
+    compression : str, optional
+        Write the map with this lossless FITS tile compression, one of 
+        FITS_COMPRESSION, by default None. The map is then in HDU 1.
+    quantize : str, optional
+        Write the map with this lossy quantization, one of FITS_QUANTIZE, by
+        default None. The maximum absolute error is recorded in the header
+        card 'QERRMAX'.
+
+    Notes
+    -----
+    read_tiled_ndmap (and any FITS reader) reads compressed and quantized
+    files transparently.
+    """
+    if compression is not None and compression not in FITS_COMPRESSION:
+        raise ValueError(
+            f'compression must be None or one of {list(FITS_COMPRESSION)}, got {compression}'
+            )
+    if quantize is not None and quantize not in FITS_QUANTIZE:
+        raise ValueError(
+            f'quantize must be None or one of {list(FITS_QUANTIZE)}, got {quantize}'
+            )
 
     # get our basic wcs header
     header = imap.wcs.to_header(relax=True)
@@ -357,7 +663,18 @@ def write_tiled_ndmap(fname, imap, extra_header=None, extra_hdu=None):
     header['ISHAPE_Y'] = imap.ishape[-2]
     header['ISHAPE_X'] = imap.ishape[-1]
     header['TILED'] = imap.tiled
-    header['HDU1'] = 'UNMASKED_TILES'
+
+    # a compressed map is in its own extension after an empty primary HDU
+    map_hdu = 0 if compression is None else 1
+    if map_hdu > 0:
+        header['MAPHDU'] = map_hdu
+    header[f'HDU{map_hdu+1}'] = 'UNMASKED_TILES'
+
+    data = np.asarray(imap)
+    if quantize is not None:
+        data, scale, max_abs_err = utils.quantize(data, quantize)
+        header['QUANTIZE'] = quantize
+        header['QERRMAX'] = max_abs_err
 
     # add extra headers
     if extra_header is not None:
@@ -367,10 +684,24 @@ def write_tiled_ndmap(fname, imap, extra_header=None, extra_hdu=None):
     # add header for extra arrays
     if extra_hdu is not None:
         for i, key in enumerate(extra_hdu.keys()):
-            header[f'HDU{i+2}'] = key # HDU0, HDU1 taken by default
+            header[f'HDU{i+map_hdu+2}'] = key # map, unmasked tiles taken by default
     
-    # build primary hdu, add unmasked tiles
-    hdus = pyfits.HDUList([pyfits.PrimaryHDU(imap, header)])
+    # build map hdu, add unmasked tiles
+    if compression is None:
+        mhdu = pyfits.PrimaryHDU(data, header)
+        hdus = pyfits.HDUList([mhdu])
+    else:
+        pheader = header.copy()
+        for key in ['NAXIS', *[f'NAXIS{i+1}' for i in range(imap.ndim)]]:
+            del pheader[key]
+        mhdu = pyfits.CompImageHDU(
+            data, header, compression_type=FITS_COMPRESSION[compression],
+            quantize_level=0
+            )
+        hdus = pyfits.HDUList([pyfits.PrimaryHDU(header=pheader), mhdu])
+    if quantize is not None:
+        mhdu.header['BSCALE'] = scale.item()
+        mhdu.header['BZERO'] = 0
     hdus.append(pyfits.ImageHDU(imap.unmasked_tiles))
 
     # add any other hdus
@@ -389,13 +720,14 @@ def read_tiled_ndmap(fname, extra_header=None, extra_hdu=None):
         fl = hdus[0]
         
         # get tiled_ndmap constructor arguments
-        imap = enmap.read_map(fname)
+        map_hdu = fl.header.get('MAPHDU', 0)
+        imap = enmap.read_map(fname, hdu=map_hdu)
         width_deg = fl.header['WIDTH_DEG'] 
         height_deg = fl.header['HEIGHT_DEG']
         ishape_y = fl.header['ISHAPE_Y']
         ishape_x = fl.header['ISHAPE_X']
         tiled = fl.header['TILED']
-        unmasked_tiles = hdus[1].data # unmasked_tiles stored here by default
+        unmasked_tiles = hdus[map_hdu+1].data # unmasked_tiles stored here by default
 
         # get extras
         extra_header_dict = {}
@@ -408,12 +740,14 @@ def read_tiled_ndmap(fname, extra_header=None, extra_hdu=None):
             inv_header = {v: k for k, v in fl.header.items()}
             for key in extra_hdu:
                 hdustr = inv_header[key]
-                i = int(hdustr.strip()[-1])
+                i = int(hdustr.strip()[3:])
                 extra_hdu_dict[key] = hdus[i].data
 
     # leave context of hdus
+    plan = get_tiling_plan((ishape_y, ishape_x), imap.wcs, width_deg=width_deg, height_deg=height_deg)
+    plan = plan.get_masked_plan(unmasked_tiles)
     omap = tiled_ndmap(imap, width_deg=width_deg, height_deg=height_deg, ishape=(ishape_y, ishape_x), tiled=tiled,
-                        unmasked_tiles=unmasked_tiles)
+                        unmasked_tiles=unmasked_tiles, plan=plan)
     
     # return
     if extra_header_dict == {} and extra_hdu_dict == {}:
@@ -1,11 +1,12 @@
 from pixell import enmap
-from mnms import covtools, utils
+from mnms import covtools, smallmat, utils, telemetry
 from mnms.tiled_ndmap import tiled_ndmap
 
 import numpy as np
 
 def get_tiled_noise_covsqrt(imap, ivar=None, mask_obs=None, mask_est=None, width_deg=4.,
-                            height_deg=4., delta_ell_smooth=400, lmax=None, rfft=True, nthread=0, verbose=False):
+                            height_deg=4., delta_ell_smooth=400, lmax=None, rfft=True, target_gb=2,
+                            nthread=0, verbose=False):
     """Generate a tiled noise model 'sqrt-covariance' matrix that captures spatially-varying
     noise correlation directions across the sky, as well as map-depth anistropies using
     the mapmaker inverse-variance maps.
@@ -33,6 +34,10 @@ def get_tiled_noise_covsqrt(imap, ivar=None, mask_obs=None, mask_est=None, width
     rfft : bool, optional
         Whether to generate tile shapes prepared for rfft's as opposed to fft's. For real 
         imaps this reduces computation time and memory usage, by default True.
+    target_gb : float, optional
+        The approximate memory budget of the working arrays, by default 2. The tiles
+        are extracted, transformed, smoothed and square-rooted in batches that fit in
+        the budget, so only the output holds all the tiles at once.
     nthread : int, optional
         The number of threads, by default 0.
         If 0, use output of get_cpu_count().
@@ -42,11 +47,12 @@ def get_tiled_noise_covsqrt(imap, ivar=None, mask_obs=None, mask_est=None, width
     Returns
     -------
     (mnms.tiled_ndmap.tiled_ndmap instance, ndarray)
-        1. A tiled ndmap of shape (num_tiles, num_comp, num_comp, ny, nx), containing the 'sqrt-
-        covariance' information in each tiled region of this split (difference) map. Only tiles
-        that are 'unmasked' are measured. The number of correlated components in each tile
+        1. A tiled ndmap of shape (num_tiles, num_comp*(num_comp+1)/2, ny, nx), containing the 
+        'sqrt-covariance' information in each tiled region of this split (difference) map. Only
+        tiles that are 'unmasked' are measured. The number of correlated components in each tile
         is equal to the number of array 'qids' * number of Stokes polarizations. Each 'pixel' is
-        the Fourier-space 'sqrt' power in that mode.
+        the Fourier-space 'sqrt' power in that mode. The 'sqrt-covariance' is symmetric, so only
+        its upper triangle is stored, flattened in the order of utils.to_flat_triu.
         2. An ndarray of shape
         (num_arrays, num_splits=1, num_pol, num_arrays, num_splits=1, num_pol, nell)
         correlated 'sqrt_ell' used to flatten the input map in harmonic space. 
@@ -109,112 +115,164 @@ def get_tiled_noise_covsqrt(imap, ivar=None, mask_obs=None, mask_est=None, width
 
     # measure correlated pseudo spectra for filtering
     # imap is also masked, as part of the filtering.
-    alm = utils.map2alm(imap * mask_est, lmax=lmax)
-    sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', 0.5, mask_est=mask_est)
-    inv_sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', -0.5, mask_est=mask_est)
+    with telemetry.span('ell-filter'):
+        alm = utils.map2alm(imap * mask_est, lmax=lmax)
+        sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', 0.5, mask_est=mask_est)
+        inv_sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', -0.5, mask_est=mask_est)
 
-    imap = utils.ell_filter_correlated(
-        imap * mask_obs, 'map', inv_sqrt_cov_ell, lmax=lmax
-        )
+        imap = utils.ell_filter_correlated(
+            imap * mask_obs, 'map', inv_sqrt_cov_ell, lmax=lmax
+            )
 
-    # get the tiled data, apod window
+    # get the tiling and apod window. the tiles are extracted one batch at a time
     imap = tiled_ndmap(imap, width_deg=width_deg, height_deg=height_deg)
     sq_f_sky = imap.set_unmasked_tiles(mask_obs, return_sq_f_sky=True)
-    imap = imap.to_tiled()
     apod = imap.apod()
     mask_obs=None
     mask_est=None
 
     # get component shapes
+    num_tiles = len(imap.unmasked_tiles)
     ncomp = num_arrays * num_pol
-    nspec = utils.triangular(ncomp)
+    tile_shape = apod.shape
     if verbose:
         print(
-            f'Number of Unmasked Tiles: {len(imap.unmasked_tiles)}\n' + \
+            f'Number of Unmasked Tiles: {num_tiles}\n' + \
             f'Number of Arrays: {num_arrays}\n' + \
             f'Number of Splits: {num_splits}\n' + \
             f'Number of Pols.: {num_pol}\n' + \
-            f'Tile shape: {imap.shape[-2:]}'
+            f'Tile shape: {tile_shape}'
             )
 
-    # get all the 2D power spectra for this split; note kmap 
-    # has shape (num_tiles, num_arrays, num_pol, ny, nx) after this operation.
-    # NOTE: imap already masked by ell_flatten, so don't reapply (tiled) mask here
-    kmap = enmap.fft(imap[..., 0, :, :, :]*apod, normalize='phys', nthread=nthread)
-
-    # we can 'delete' imap (really, just keep the 1st tile for wcs, tiled_info)
-    imap = imap[0]
+    if delta_ell_smooth < 0:
+        raise ValueError('delta_ell_smooth must be >= 0')
+    elif delta_ell_smooth == 0 and verbose:
+        print('Not smoothing')
 
     # allocate output map, which has 'real' fft tile shape if rfft
     if rfft:
-        nkx = imap.shape[-1]//2 + 1
+        nkx = tile_shape[-1]//2 + 1
     else:
-        nkx = imap.shape[-1]
-    omap = np.empty((len(imap.unmasked_tiles), ncomp, ncomp, imap.shape[-2], nkx), imap.dtype)
-
-    # cycle through the tiles    
-    for i, n in enumerate(imap.unmasked_tiles):
-        # get power spectrum for this tile
-        smap = np.einsum('mayx, nbyx -> manbyx', kmap[i], np.conj(kmap[i])).real
-
-        # ewcs per tile is necessary for delta_ell_smooth to operate over correct number of Fourier pixels
-        _, ewcs = imap.get_tile_geometry(n)
-
-        # iterate over spectra
-        for j in range(nspec):
-            # get array, pol indices
-            comp1, comp2 = utils.triu_pos(j, ncomp)
-            map_index_1, pol_index_1 = divmod(comp1, num_pol)
-            map_index_2, pol_index_2 = divmod(comp2, num_pol)
-                        
-            # whether we are on the main diagonal
-            diag = comp1 == comp2
-
-            # get this 2D PS and apply correct geometry for this tile
-            power = smap[map_index_1, pol_index_1, map_index_2, pol_index_2]
-            power = enmap.ndmap(power, wcs=ewcs)
-            
-            # smooth the 2D PS
+        nkx = tile_shape[-1]
+    # the spectra are the flattened upper triangle of each tile's power, so 
+    # that the first ncomp spectra are the main diagonal. the output keeps 
+    # them in that packed form
+    rows, cols = utils.triu_indices(ncomp)
+    omap = np.empty((num_tiles, len(rows), tile_shape[-2], nkx), imap.dtype)
+
+    batch_size = _get_covsqrt_batch_size(target_gb, ncomp, tile_shape, imap.dtype)
+    if verbose:
+        print(f'Number of Tiles per Batch: {batch_size}')
+
+    for start in range(0, num_tiles, batch_size):
+        batch = np.s_[start:start + batch_size]
+        batch_tiles = imap.unmasked_tiles[batch]
+
+        # get the 2D Fourier transforms of this batch of tiles; note kmap 
+        # has shape (num_batch_tiles, num_arrays, num_pol, ny, nx) after this operation.
+        # NOTE: imap already masked by ell_flatten, so don't reapply (tiled) mask here
+        tmap = imap.sametiles(imap, unmasked_tiles=batch_tiles).to_tiled(nthread=nthread)
+        with telemetry.span('fft'):
+            kmap = enmap.fft(tmap[..., 0, :, :, :]*apod, normalize='phys', nthread=nthread)
+        kmap = kmap.reshape(len(batch_tiles), ncomp, *kmap.shape[-2:])
+        tmap = None
+
+        # ewcs per tile is necessary for delta_ell_smooth to operate over correct number
+        # of Fourier pixels. tiles with the same Fourier-space geometry (i.e., in the same
+        # row of tiles) are processed together
+        groups = {}
+        for i, n in enumerate(batch_tiles):
+            _, ewcs = imap.get_tile_geometry(n)
+            ly, lx = enmap.laxes(tile_shape, ewcs)
+            groups.setdefault((ly.tobytes(), lx.tobytes()), (ewcs, []))[1].append(i)
+
+        for ewcs, tiles in groups.values():
+            # get power spectra for these tiles
+            with telemetry.span('outer-product'):
+                _kmap = kmap[tiles]
+                smap = np.einsum(
+                    'tayx, tayx -> tayx', _kmap[:, rows], np.conj(_kmap[:, cols])
+                    ).real
+                smap = enmap.ndmap(smap, wcs=ewcs)
+                _kmap = None
+
+            # smooth the 2D PS, on and off the main diagonal
             if delta_ell_smooth > 0:
-                power = covtools.smooth_ps_grid_uniform(
-                    power, delta_ell_smooth, diag=diag, fill=True, fill_lmax_est_width=300
-                    )
-            
-            # skip smoothing if delta_ell_smooth=0 is passed as arg
-            elif delta_ell_smooth == 0:
-                if verbose:
-                    print('Not smoothing')
-            else:
-                raise ValueError('delta_ell_smooth must be >= 0')    
-            
+                with telemetry.span('smooth'):
+                    for sel, diag in ((np.s_[:, :ncomp], True), (np.s_[:, ncomp:], False)):
+                        if smap[sel].size == 0:
+                            continue
+                        smap[sel] = covtools.smooth_ps_grid_uniform(
+                            smap[sel], delta_ell_smooth, diag=diag, fill=True, 
+                            fill_lmax_est_width=300, nthread=nthread
+                            )
+
             # update output 2D PS map
-            omap[i, comp1, comp2] = power[..., :nkx]
-            if not diag: # symmetry
-                omap[i, comp2, comp1] = power[..., :nkx]
+            tiles = np.asarray(tiles) + start
+            omap[tiles] = smap[..., :nkx]
+            smap = None
+        kmap = None
 
         # correct for f_sky from mask and apod windows
-        omap[i] /= sq_f_sky[i]
+        omap[batch] /= sq_f_sky[batch, None, None, None]
+
+        # take covsqrt of current power, with the flattened upper triangle first
+        with telemetry.span('eigpow'):
+            smallmat.eigpow(np.moveaxis(omap[batch], 1, 0), 0.5, nthread=nthread)
+
+    return imap.sametiles(omap, tiled=True), sqrt_cov_ell
+
+def _get_covsqrt_batch_size(target_gb, ncomp, tile_shape, dtype):
+    """Return the number of tiles to estimate at once in get_tiled_noise_covsqrt
+    such that their working arrays take up about target_gb of memory"""
+    npix = np.prod(tile_shape)
+    itemsize = np.dtype(dtype).itemsize
+
+    # the extracted tiles, their complex FFTs and the copy of each group of 
+    # them, about 3 copies of the spectra while they are smoothed, and the 
+    # contiguous copy of the spectra for their eigendecomposition, which is 
+    # itself done in bounded chunks (see smallmat)
+    tile_nbytes = itemsize * npix * (ncomp * (1 + 2 + 2) + 4 * utils.triangular(ncomp))
+    return max(1, int(target_gb * 1e9 // tile_nbytes))
+
+def pack_covsqrt(covsqrt):
+    """Flatten the upper triangle of a tiled covsqrt of full, symmetric matrices.
+
+    Parameters
+    ----------
+    covsqrt : mnms.tiled_ndmap.tiled_ndmap
+        A tiled ndmap of shape (num_tiles, num_comp, num_comp, ny, nx).
 
-    # take covsqrt of current power (and can safely delete kmap, smap)
-    kmap=None
-    smap=None
-    omap = utils.chunked_eigpow(omap, 0.5, axes=(-4,-3))
+    Returns
+    -------
+    mnms.tiled_ndmap.tiled_ndmap
+        A tiled ndmap of shape (num_tiles, num_comp*(num_comp+1)/2, ny, nx), in
+        the order of utils.to_flat_triu.
+    """
+    assert covsqrt.ndim == 5, 'Covsqrt must have 5 dims: (num_unmasked_tiles, comp1, comp2, ny, nx)'
+    return covsqrt.sametiles(utils.to_flat_triu(np.asarray(covsqrt), axis1=1))
 
-    return imap.sametiles(omap), sqrt_cov_ell
+# the name of the counter-based random stream of the sims (as opposed to the
+# legacy stream), used to tag their filenames, see simio.get_tiled_sim_fn.
+# change it if the draws of the stream change
+RNG_NAME = 'philox'
 
 def get_tiled_noise_sim(covsqrt, ivar=None, sqrt_cov_ell=None, rfft=True,
-                        num_arrays=None, nthread=0, seed=None, verbose=True):
+                        num_arrays=None, pixbox=None, legacy_rng=False, nthread=0, seed=None,
+                        verbose=True):
     """Get a noise sim from a tiled noise model of a given data split. The sim is *not* masked, 
     but is only nonzero in regions of unmasked tiles. 
 
     Parameters
     ----------
     covsqrt : mnms.tiled_ndmap.tiled_ndmap
-        A tiled ndmap of shape (num_tiles, num_comp, num_comp, ny, nx), containing the 'sqrt-
-        covariance' information in each tiled region of this split (difference) map. Only tiles
-        that are 'unmasked' are measured. The number of correlated components in each tile
-        is equal to the number of array 'qids' * number of Stokes polarizations. Each 'pixel' is
-        the Fourier-space 'sqrt' power in that mode.
+        A tiled ndmap of shape (num_tiles, num_comp*(num_comp+1)/2, ny, nx), containing the 
+        flattened upper triangle of the 'sqrt-covariance' information in each tiled region of
+        this split (difference) map, see get_tiled_noise_covsqrt. Only tiles that are 'unmasked'
+        are measured. The number of correlated components in each tile is equal to the number 
+        of array 'qids' * number of Stokes polarizations. Each 'pixel' is the Fourier-space 
+        'sqrt' power in that mode. Full matrices of shape (num_tiles, num_comp, num_comp, ny, nx)
+        are also supported.
     ivar : array-like, optional
         Data inverse-variance maps, by default None. Used modulate noise sim in final step.
         Also used to infer num_arrays.
@@ -228,6 +286,12 @@ def get_tiled_noise_sim(covsqrt, ivar=None, sqrt_cov_ell=None, rfft=True,
         match the value of the 'rfft' kwarg passed to get_tiled_noise_covsqrt, by default True.
     num_arrays : int, optional
         If ivar is None, the number of correlated arrays in num_comp, by default None.
+    pixbox : (2, 2) array-like, optional
+        Only simulate the region [[y0, x0], [y1, x1]] of the full map, by default None.
+        See get_tiled_noise_sims.
+    legacy_rng : bool, optional
+        Draw from the random stream of mnms versions before the counter-based
+        draws, by default False. See get_tiled_noise_sims.
     nthread : int, optional
         The number of threads, by default 0.
         If 0, use output of get_cpu_count().
@@ -243,10 +307,87 @@ def get_tiled_noise_sim(covsqrt, ivar=None, sqrt_cov_ell=None, rfft=True,
         imap split. It has the correct power for the noise in the data proper, not in the
         difference map. It is not masked, but is only nonzero in regions of unmasked tiles. 
     """
+    return get_tiled_noise_sims(
+        covsqrt, [seed], ivar=ivar, sqrt_cov_ell=sqrt_cov_ell, rfft=rfft,
+        num_arrays=num_arrays, pixbox=pixbox, legacy_rng=legacy_rng, nthread=nthread,
+        verbose=verbose
+        )[0]
+
+def get_tiled_noise_sims(covsqrt, seeds, ivar=None, sqrt_cov_ell=None, rfft=True,
+                         num_arrays=None, pixbox=None, legacy_rng=False, nthread=0,
+                         verbose=True):
+    """Get a stack of noise sims from a tiled noise model of a given data split, one
+    for each seed in seeds. The random draws of all the sims are multiplied by the
+    covsqrt in one batched operation, so the covsqrt is only streamed through once. 
+    Each sim is identical to the output of get_tiled_noise_sim for the same seed.
+
+    Parameters
+    ----------
+    covsqrt : mnms.tiled_ndmap.tiled_ndmap
+        A tiled ndmap of shape (num_tiles, num_comp*(num_comp+1)/2, ny, nx), containing the 
+        flattened upper triangle of the 'sqrt-covariance' information in each tiled region of
+        this split (difference) map. Full matrices of shape (num_tiles, num_comp, num_comp, ny, nx)
+        are also supported, but are first flattened.
+    seeds : iterable of list
+        Lists of integers to be passed to np.random seeding utilities, one per sim.
+    ivar : array-like, optional
+        Data inverse-variance maps, by default None. Used modulate noise sim in final step.
+        Also used to infer num_arrays. If pixbox is provided, must be in the pixbox geometry.
+    sqrt_cov_ell : ndarray, optional
+        An ndarray of shape
+        (num_arrays, num_splits=1, num_pol, num_arrays, num_splits=1, num_pol, nell)
+        correlated 'sqrt_ell' used to unflatten the simulated map in harmonic space,
+        by default None. Also sets the bandlimit of the filtering operation.
+    rfft : bool, optional
+        Whether to use rfft's as opposed to fft's when going from Fourier to map space. Should
+        match the value of the 'rfft' kwarg passed to get_tiled_noise_covsqrt, by default True.
+    num_arrays : int, optional
+        If ivar is None, the number of correlated arrays in num_comp, by default None.
+    pixbox : (2, 2) array-like, optional
+        Only simulate the region [[y0, x0], [y1, x1]] of the full map, by default None.
+        Only the tiles overlapping the region are drawn, transformed and stitched.
+    legacy_rng : bool, optional
+        Draw from the random stream of mnms versions before the counter-based
+        draws, by default False. Only needed to reproduce sims made by those
+        versions.
+    nthread : int, optional
+        The number of threads, by default 0.
+        If 0, use output of get_cpu_count().
+    verbose : bool, optional
+        Print possibly helpful messages, by default False.
+
+    Returns
+    -------
+    ndmap
+        A shape (num_sims, num_arrays, num_splits=1, num_pol, ny, nx) stack of noise sims,
+        where (ny, nx) is the shape of the pixbox if provided.
+
+    Notes
+    -----
+    Only the draws and the covsqrt multiplication are batched. The FFT backends
+    vectorize over the transforms in a batch, which changes the rounding of a
+    transform depending on its position in the batch, so each sim is still
+    transformed and filtered on its own to stay bit-identical to a single sim.
+
+    The random draws of each tile and component come from their own counter-based
+    stream, keyed by the seed, the index of the tile in the full tiling, and the
+    component (see utils.keyed_normal). Thus, only the unmasked tiles are drawn,
+    and a sim does not depend on the mask nor on the number of threads. The
+    legacy stream instead draws in chunks of the full tiling, of which only
+    the chunks containing unmasked tiles are drawn.
+
+    Before filtering by sqrt_cov_ell, a sim of a pixbox is identical to the 
+    same region of the full sim. The filter is nonlocal, so a filtered sim of
+    a pixbox is only accurate away from the pixbox edges.
+    """
     # check that covsqrt is a tiled tiled_ndmap instance    
     assert covsqrt.tiled, 'Covsqrt must be tiled'
-    assert covsqrt.ndim == 5, 'Covsqrt must have 5 dims: (num_unmasked_tiles, comp1, comp2, ny, nx)'
-    assert covsqrt.shape[-4] == covsqrt.shape[-3], 'Covsqrt correlated subspace must be square'
+    assert covsqrt.ndim in (4, 5), \
+        'Covsqrt must have 4 dims: (num_unmasked_tiles, flat_triu_comp, ny, nx) or 5 dims: ' + \
+        '(num_unmasked_tiles, comp1, comp2, ny, nx)'
+    if covsqrt.ndim == 5:
+        assert covsqrt.shape[-4] == covsqrt.shape[-3], 'Covsqrt correlated subspace must be square'
+        covsqrt = pack_covsqrt(covsqrt)
 
     # get ivar, and num_arrays if necessary
     if ivar is not None:
@@ -259,23 +400,31 @@ def get_tiled_noise_sim(covsqrt, ivar=None, sqrt_cov_ell=None, rfft=True,
         assert isinstance(num_arrays, int), \
             'If ivar not passed, must explicitly pass num_arrays as an python int'
 
+    # only keep the tiles that overlap the pixbox
+    if pixbox is not None:
+        tiles = covsqrt.get_overlapping_tiles(pixbox)
+        sel = np.isin(covsqrt.unmasked_tiles, tiles)
+        covsqrt = covsqrt.sametiles(covsqrt[sel], unmasked_tiles=tiles)
+
     # get preshape information
+    num_sims = len(seeds)
     num_unmasked_tiles = covsqrt.num_tiles
-    num_comp = covsqrt.shape[-4]
+    num_comp = utils.triangular_idx(covsqrt.shape[-3])
     num_pol = num_comp // num_arrays
     if verbose:
         print(
+            f'Number of Sims: {num_sims}\n' + \
             f'Number of Unmasked Tiles: {num_unmasked_tiles}\n' + \
             f'Number of Arrays: {num_arrays}\n' + \
             f'Number of Pols.: {num_pol}\n' + \
             f'Tile shape: {covsqrt.shape[-2:]}'
             )
 
-    # get random numbers in the right shape. To make random draws independent of mask, we draw numbers into
-    # the full number of tiles, and then slice the unmasked tiles (even though this is a little slower)
+    # get random numbers in the right shape. To make random draws independent of mask, each unmasked
+    # tile is keyed by its index in the full tiling. The legacy stream instead draws numbers into the 
+    # full number of tiles, and then keeps the unmasked tiles (only drawing the parts of the full draw
+    # that contain them)
     rshape = (covsqrt.numy*covsqrt.numx, num_comp, *covsqrt.shape[-2:])
-    if verbose:
-        print(f'Seed: {seed}')
 
     if rfft:
         # this is because both the real and imaginary parts are unit standard normal
@@ -283,57 +432,78 @@ def get_tiled_noise_sim(covsqrt, ivar=None, sqrt_cov_ell=None, rfft=True,
     else:
         mult = 1
 
-    omap = utils.concurrent_normal(
-        size=rshape, loc=0, scale=mult, dtype=covsqrt.dtype, 
-        complex=True, seed=seed, nchunks=100, nthread=nthread
+    # the sims are stacked after the tile axis, since the tile axis is the one
+    # we flatten over in the einsum
+    omap = np.empty(
+        (num_unmasked_tiles, num_sims, *rshape[1:]), dtype=np.result_type(1j, covsqrt.dtype)
         )
-    omap = omap[covsqrt.unmasked_tiles]
+    for i, seed in enumerate(seeds):
+        if verbose:
+            print(f'Seed: {seed}')
+        with telemetry.span('draw'):
+            if legacy_rng:
+                omap[:, i] = utils.concurrent_normal(
+                    size=rshape, loc=0, scale=mult, dtype=covsqrt.dtype, 
+                    complex=True, seed=seed, nchunks=100, nthread=nthread,
+                    rows=covsqrt.unmasked_tiles
+                    )
+            else:
+                keys = [(t, c) for t in covsqrt.unmasked_tiles for c in range(num_comp)]
+                omap[:, i] = utils.keyed_normal(
+                    keys, size=rshape[-2:], loc=0, scale=mult, dtype=covsqrt.dtype,
+                    complex=True, seed=seed, nthread=nthread
+                    ).reshape(num_unmasked_tiles, *rshape[1:])
 
     if rfft:
         # because reality condition will suppress power in only the first column
         # (for all but the 0-freq compoonent)
         omap[..., 1:, 0] *= np.sqrt(2)
 
-    # multiply random draws by the covsqrt to get the sim
-    omap = utils.concurrent_einsum(
-        '...abyx, ...byx -> ...ayx', covsqrt, omap, flatten_axes=[0], nthread=nthread
-        )
-    omap = enmap.samewcs(omap, covsqrt)
-
-    # go back to map space. we assume covsqrt is an rfft produced by utils.rfft,
-    # in which case the 'halved' axis is the last (x) axis. therefore, we must
-    # tell utils.irfft what the original size of this axis was
-    if rfft:
-        omap = utils.irfft(
-            omap, normalize='phys', nthread=nthread, n=covsqrt.pix_width + 2*covsqrt.pix_pad_x
-            )
-    else:
-        omap = enmap.ifft(
-            omap, normalize='phys', nthread=nthread
-            ).real
-    omap = omap.reshape((num_unmasked_tiles, num_arrays, num_pol, *omap.shape[-2:]))
-    omap = covsqrt.sametiles(omap)
-    
-    # stitch tiles
-    omap = omap.from_tiled(power=0.5)
-
-    # filter maps
-    if sqrt_cov_ell is not None:
-        # extract the particular split from sqrt_cov_ell
-        assert (num_arrays, 1, num_pol, num_arrays, 1, num_pol) == sqrt_cov_ell.shape[:-1], \
-            'sqrt_cov_ell shape does not match (num_arrays, num_splits=1, num_pol, num_arrays, num_splits=1, num_pol, ...)'
-        
-        # determine lmax from sqrt_cov_ell, and build the lfilter
-        lmax = sqrt_cov_ell.shape[-1] - 1
+    # multiply random draws by the covsqrt to get the sims
+    with telemetry.span('synth'):
+        omap = utils.symv_flat_triu(np.asarray(covsqrt)[:, None], omap, nthread=nthread)
+
+    sims = []
+    for i in range(num_sims):
+        # go back to map space. we assume covsqrt is an rfft produced by utils.rfft,
+        # in which case the 'halved' axis is the last (x) axis. therefore, we must
+        # tell utils.irfft what the original size of this axis was
+        with telemetry.span('synth'):
+            smap = enmap.samewcs(np.ascontiguousarray(omap[:, i]), covsqrt)
+            if rfft:
+                smap = utils.irfft(
+                    smap, normalize='phys', nthread=nthread, n=covsqrt.pix_width + 2*covsqrt.pix_pad_x
+                    )
+            else:
+                smap = enmap.ifft(
+                    smap, normalize='phys', nthread=nthread
+                    ).real
+            smap = smap.reshape((num_unmasked_tiles, num_arrays, num_pol, *smap.shape[-2:]))
+            smap = covsqrt.sametiles(smap)
         
-        # do the filtering
-        omap = utils.ell_filter_correlated(omap, 'map', sqrt_cov_ell, lmax=lmax)
+            # stitch tiles
+            smap = smap.from_tiled(power=0.5, pixbox=pixbox, nthread=nthread)
+
+        # filter maps
+        if sqrt_cov_ell is not None:
+            # extract the particular split from sqrt_cov_ell
+            assert (num_arrays, 1, num_pol, num_arrays, 1, num_pol) == sqrt_cov_ell.shape[:-1], \
+                'sqrt_cov_ell shape does not match (num_arrays, num_splits=1, num_pol, num_arrays, num_splits=1, num_pol, ...)'
+            
+            # determine lmax from sqrt_cov_ell, and build the lfilter
+            lmax = sqrt_cov_ell.shape[-1] - 1
+            
+            # do the filtering
+            with telemetry.span('ell-filter'):
+                smap = utils.ell_filter_correlated(smap, 'map', sqrt_cov_ell, lmax=lmax)
 
-    # add axis for split (1)
-    omap = omap.reshape((num_arrays, 1, num_pol, *omap.shape[-2:]))
+        # add axis for split (1)
+        smap = smap.reshape((num_arrays, 1, num_pol, *smap.shape[-2:]))
 
-    # if ivar is not None, unwhiten the imap data using ivar
-    if ivar is not None:
-        np.divide(omap, np.sqrt(ivar), out=omap, where=ivar!=0)
+        # if ivar is not None, unwhiten the imap data using ivar
+        if ivar is not None:
+            np.divide(smap, np.sqrt(ivar), out=smap, where=ivar!=0)
 
-    return omap
+        sims.append(smap)
+        
+    return enmap.samewcs(np.array(sims), sims[0])
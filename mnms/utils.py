@@ -1,4 +1,6 @@
-from pixell import enmap, curvedsky, fft as enfft, sharp
+from mnms import fft_plans
+
+from pixell import enmap, curvedsky, sharp, fft as enfft
 import healpy as hp
 from enlib import array_ops
 from soapack import interfaces as sints
@@ -15,6 +17,7 @@ import yaml
 import pkgutil
 from concurrent import futures
 import multiprocessing
+import functools
 import os
 import hashlib
 
@@ -107,7 +110,7 @@ def get_default_mask_version():
 
 def get_nsplits_by_qid(qid, data_model):
     """Get the number of splits in the raw data corresponding to this array 'qid'"""
-    return int(data_model.adf[data_model.adf['#qid']==qid]['nsplits'])
+    return int(data_model.adf[data_model.adf['#qid']==qid]['nsplits'].item())
 
 def slice_geometry_by_pixbox(ishape, iwcs, pixbox):
     pb = np.asarray(pixbox)
@@ -331,6 +334,71 @@ def from_flat_triu(arr, axis1=0, axis2=None, flat_triu_axis=None):
     arr = unflatten_axis(arr, (ncomp, ncomp), axis=(axis1, axis2), pos=flat_triu_axis)
     return triu_to_symm(arr, axis1=axis1, axis2=axis2)
 
+def symv_flat_triu(a, x, triangular=False, nthread=0):
+    """Multiply vectors by symmetric matrices stored as their flattened upper
+    triangles, without expanding the matrices.
+
+    Parameters
+    ----------
+    a : (..., ncomp*(ncomp+1)/2, ny, nx) array-like
+        The flattened upper triangles of the matrices of each pixel, in the
+        order of to_flat_triu.
+    x : (..., ncomp, ny, nx) array-like
+        The vectors of each pixel. The preceding dimensions of a and x are
+        broadcast against each other.
+    triangular : bool, optional
+        Whether the matrices are upper-triangular, R, rather than symmetric,
+        by default False. If True, multiply by their transposes, R.T.
+    nthread : int, optional
+        The number of threads, by default 0.
+        If 0, use output of get_cpu_count().
+
+    Returns
+    -------
+    (..., ncomp, ny, nx) np.ndarray
+        The products, with the dtype of a times x.
+
+    Notes
+    -----
+    The products are accumulated in the order of to_flat_triu, so the result
+    for a given element is the same regardless of the broadcast dimensions
+    and the number of threads. The rows (axis -2) are split among the threads.
+    """
+    ncomp = x.shape[-3]
+    nspec = ncomp*(ncomp+1)//2
+    assert a.shape[-3] == nspec, f'a must have {nspec} flattened elements, got {a.shape[-3]}'
+    rows, cols = triu_indices(ncomp)
+
+    preshape = np.broadcast_shapes(a.shape[:-3], x.shape[:-3])
+    omap = np.zeros((*preshape, *x.shape[-3:]), dtype=np.result_type(a, x))
+
+    def _symv(start, stop):
+        _a = np.asarray(a[..., start:stop, :])
+        _x = x[..., start:stop, :]
+        _o = omap[..., start:stop, :]
+        buf = np.empty_like(_o[..., 0, :, :])
+        for k, (i, j) in enumerate(zip(rows, cols)):
+            if triangular:
+                _o[..., j, :, :] += np.multiply(_a[..., k, :, :], _x[..., i, :, :], out=buf)
+            else:
+                _o[..., i, :, :] += np.multiply(_a[..., k, :, :], _x[..., j, :, :], out=buf)
+                if i != j:
+                    _o[..., j, :, :] += np.multiply(_a[..., k, :, :], _x[..., i, :, :], out=buf)
+
+    # perform multithreaded execution
+    if nthread == 0:
+        nthread = get_cpu_count()
+    ny = x.shape[-2]
+    chunksize = max(1, -(-ny // nthread))
+    executor = futures.ThreadPoolExecutor(max_workers=nthread)
+    fs = [
+        executor.submit(_symv, start, start + chunksize)
+        for start in range(0, ny, chunksize)
+        ]
+    for f in fs:
+        f.result()
+    return omap
+
 # get a logical mask that can be used to index an array, eg to build a mask
 # out of conditions.
 # if not keep_prepend_dims, perform op over all dims up to map dims; else
@@ -471,6 +539,12 @@ def rolling_average(x, N):
     return (cumsum[N:] - cumsum[:-N]) / float(N)
 
 def linear_crossfade(cNy,cNx,npix_y,npix_x=None, dtype=np.float32):
+    fys, fxs = linear_crossfade_1d(cNy, cNx, npix_y, npix_x=npix_x, dtype=dtype)
+    return fys[:,None] * fxs[None,:]
+
+# the separable factors of linear_crossfade, for when only a window of the
+# crossfade is needed
+def linear_crossfade_1d(cNy,cNx,npix_y,npix_x=None, dtype=np.float32):
     if npix_x is None:
         npix_x = npix_y
     fys = np.ones(cNy, dtype=dtype)
@@ -481,7 +555,7 @@ def linear_crossfade(cNy,cNx,npix_y,npix_x=None, dtype=np.float32):
         
     fxs[:npix_x] = np.linspace(0.,1.,npix_x)
     fxs[cNx-npix_x:] = np.linspace(0.,1.,npix_x)[::-1]
-    return fys[:,None] * fxs[None,:]
+    return fys, fxs
 
 @numba.njit(parallel=True)
 def _parallel_bin(smap, bin_rmap, weights, nbins):
@@ -1753,15 +1827,17 @@ def get_fwhm_fact_func_from_pts(pt1, pt2, pt0_y=2.):
     assert pt1[1] >= pt0_y and pt2[1] >= pt1[1], \
         'y values must be increasing'
 
-    # build function
-    def f(l):
-        assert l >= 0, 'l must be positive semi-definite'
-        if 0 <= l and l < pt1[0]:
-            return pt0_y + (pt1[1] - pt0_y) / pt1[0] * l
-        else:
-            return pt1[1] + (pt2[1] - pt1[1]) / (pt2[0] - pt1[0]) * (l - pt1[0])
-    
-    return f
+    # build function. use a partial of a module-level function, rather than
+    # a closure, so that it can be pickled (e.g. for process pools)
+    return functools.partial(_fwhm_fact_piecewise_linear, pt1=pt1, pt2=pt2, pt0_y=pt0_y)
+
+def _fwhm_fact_piecewise_linear(l, pt1, pt2, pt0_y):
+    """See get_fwhm_fact_func_from_pts"""
+    assert l >= 0, 'l must be positive semi-definite'
+    if 0 <= l and l < pt1[0]:
+        return pt0_y + (pt1[1] - pt0_y) / pt1[0] * l
+    else:
+        return pt1[1] + (pt2[1] - pt1[1]) / (pt2[0] - pt1[0]) * (l - pt1[0])
 
 # from pixell/fft.py
 def get_cpu_count():
@@ -1773,7 +1849,7 @@ def get_cpu_count():
     return nthread
 
 def concurrent_normal(size=1, loc=0., scale=1., nchunks=100, nthread=0,
-                        seed=None, dtype=np.float32, complex=False):
+                        seed=None, dtype=np.float32, complex=False, rows=None):
     """Draw standard normal (real or complex) random variates concurrently.
 
     Parameters
@@ -1799,12 +1875,17 @@ def concurrent_normal(size=1, loc=0., scale=1., nchunks=100, nthread=0,
         type.
     complex : bool, optional
         If True, return a complex random variate, by default False.
+    rows : iterable of int, optional
+        Only return these indices along the first axis of 'size', by default
+        None. The output is identical to indexing the full draw by rows, but
+        only the subdraws that overlap the rows are made.
 
     Returns
     -------
     ndarray
         Real or complex standard normal random variates in shape 'size'
-        with each real and/or complex part having dtype 'dtype'. 
+        (or (len(rows), *size[1:]) if rows is provided) with each real and/or
+        complex part having dtype 'dtype'. 
     """
     # get size per chunk draw
     totalsize = np.prod(size, dtype=int)
@@ -1813,6 +1894,24 @@ def concurrent_normal(size=1, loc=0., scale=1., nchunks=100, nthread=0,
     # get seeds
     ss = np.random.SeedSequence(seed)
     rngs = [np.random.default_rng(s) for s in ss.spawn(nchunks)]
+
+    # get the chunks to draw: all of them, or those overlapping the rows
+    if rows is None:
+        chunks = np.arange(nchunks)
+    else:
+        rows = np.asarray(rows, dtype=int)
+        rowsize = totalsize // size[0]
+        row_starts = rows * rowsize
+        first_chunks = row_starts // chunksize
+        last_chunks = (row_starts + rowsize - 1) // chunksize
+        chunks = np.unique(np.concatenate(
+            [np.arange(f, l+1) for f, l in zip(first_chunks, last_chunks)] +
+            [np.zeros(0, dtype=int)]
+            ))
+        if len(chunks) == 0:
+            dtype = np.result_type(dtype, 1j) if complex else dtype
+            return np.empty((0, *size[1:]), dtype=dtype)
+    nchunks = len(chunks)
     
     # define working objects
     out = np.empty((nchunks, chunksize), dtype=dtype)
@@ -1827,11 +1926,11 @@ def concurrent_normal(size=1, loc=0., scale=1., nchunks=100, nthread=0,
     def _fill(arr, start, stop, rng):
         rng.standard_normal(out=arr[start:stop], dtype=dtype)
     
-    fs = [executor.submit(_fill, out, i, i+1, rngs[i]) for i in range(nchunks)]
+    fs = [executor.submit(_fill, out, i, i+1, rngs[c]) for i, c in enumerate(chunks)]
     futures.wait(fs)
 
     if complex:
-        fs = [executor.submit(_fill, out_imag, i, i+1, rngs[i]) for i in range(nchunks)]
+        fs = [executor.submit(_fill, out_imag, i, i+1, rngs[c]) for i, c in enumerate(chunks)]
         futures.wait(fs)
 
         # if not concurrent, casting to complex takes 80% of the time for a complex draw.
@@ -1858,8 +1957,94 @@ def concurrent_normal(size=1, loc=0., scale=1., nchunks=100, nthread=0,
             )
 
     # return
-    out = out.reshape(-1)[:totalsize]
-    return out.reshape(size)
+    if rows is None:
+        out = out.reshape(-1)[:totalsize]
+        return out.reshape(size)
+    
+    # each row is contiguous within its consecutive chunks
+    out = out.reshape(-1)
+    starts = np.searchsorted(chunks, first_chunks) * chunksize + \
+        row_starts - first_chunks * chunksize
+    return np.array(
+        [out[start:start + rowsize] for start in starts], dtype=out.dtype
+        ).reshape((len(rows), *size[1:]))
+
+def keyed_normal(keys, size=1, loc=0., scale=1., nthread=0, seed=None,
+                 dtype=np.float32, complex=False):
+    """Draw standard normal (real or complex) random variates concurrently,
+    from an independent counter-based (Philox) stream for each key.
+
+    Parameters
+    ----------
+    keys : iterable of int or iterable of tuple of int
+        The keys of the draws. Each key draws 'size' variates from its own
+        stream, which only depends on the seed and the key.
+    size : int or iterable, optional
+        The shape to draw random numbers into per key, by default 1.
+    loc : int or float, optional
+        The location (mean) of the distribution, by default 0.
+    scale : int or float, optional
+        The scale (standard deviation) of the distribution, by default 1.
+    nthread : int, optional
+        Number of concurrent threads, by default 0. If 0, the result
+        of get_cpu_count().
+    seed : int or iterable-of-ints, optional
+        Random seed to pass to np.random.SeedSequence, by default None.
+    dtype : np.dtype, optional
+        Data type of output if real, or of each real and complex,
+        component, by default np.float32. Must be a 4- or 8-byte
+        type.
+    complex : bool, optional
+        If True, return a complex random variate, by default False.
+
+    Returns
+    -------
+    ndarray
+        Real or complex standard normal random variates in shape
+        (len(keys), *size) with each real and/or complex part having dtype
+        'dtype'.
+
+    Notes
+    -----
+    Unlike concurrent_normal, the draw of a key does not depend on which
+    other keys are drawn, nor on the number of threads. Each key seeds its
+    generator with np.random.SeedSequence(seed, spawn_key=key), i.e. the
+    stream of a key is the spawned child of the seed with that key. The real
+    and imaginary parts of a complex draw are drawn in that order from the
+    same stream.
+    """
+    keys = [tuple(np.atleast_1d(key).tolist()) for key in keys]
+    size = tuple(np.atleast_1d(size).tolist())
+    out = np.empty(
+        (len(keys), *size), dtype=np.result_type(dtype, 1j) if complex else dtype
+        )
+    if seed is None:
+        # all keys must share the entropy of the seed
+        seed = np.random.SeedSequence().entropy
+
+    # perform multithreaded execution
+    if nthread == 0:
+        nthread = get_cpu_count()
+    executor = futures.ThreadPoolExecutor(max_workers=nthread)
+
+    def _fill(i):
+        ss = np.random.SeedSequence(seed, spawn_key=keys[i])
+        rng = np.random.Generator(np.random.Philox(ss))
+        if complex:
+            draw = rng.standard_normal(size=(2, *size), dtype=dtype)
+            out[i].real = draw[0]
+            out[i].imag = draw[1]
+        else:
+            rng.standard_normal(out=out[i], dtype=dtype)
+        if scale != 1:
+            out[i] *= scale
+        if loc != 0:
+            out[i] += loc
+
+    fs = [executor.submit(_fill, i) for i in range(len(keys))]
+    for f in fs:
+        f.result()
+    return out
 
 def concurrent_op(op, a, b, *args, flatten_axes=[-2,-1], 
                   nchunks=100, nthread=0, **kwargs):
@@ -2012,6 +2197,40 @@ def concurrent_einsum(subscripts, a, b, *args, flatten_axes=[-2, -1],
     out = np.moveaxis(out, range(len(oshape_axes)), flatten_axes)
     return out
 
+def concurrent_outer_flat_triu(a, nthread=0):
+    """Form the outer product of an array with itself along axis 0, keeping
+    only its flattened upper triangle (see to_flat_triu). Each element of 
+    the triangle is computed concurrently.
+
+    Parameters
+    ----------
+    a : (ncomp, ...) ndarray
+        The array.
+    nthread : int, optional
+        The number of threads, by default 0.
+        If 0, use output of get_cpu_count().
+
+    Returns
+    -------
+    (ncomp*(ncomp+1)/2, ...) ndarray
+        The upper triangle of np.einsum('a..., b... -> ab...', a, a),
+        flattened in diagonal-major order.
+    """
+    rows, cols = triu_indices(a.shape[0])
+    out = np.empty((len(rows), *a.shape[1:]), dtype=a.dtype)
+
+    # perform multithreaded execution
+    if nthread == 0:
+        nthread = get_cpu_count()
+    executor = futures.ThreadPoolExecutor(max_workers=nthread)
+
+    def _fill(i):
+        np.multiply(a[rows[i]], a[cols[i]], out=out[i])
+
+    fs = [executor.submit(_fill, i) for i in range(len(rows))]
+    futures.wait(fs)
+    return out
+
 def eigpow(A, e, axes=[-2, -1]):
     """A hack around enlib.array_ops.eigpow which upgrades the data
     precision to at least double precision if necessary prior to
@@ -2110,10 +2329,19 @@ def rfft(emap, omap=None, nthread=0, normalize='ortho', adjoint_ifft=False):
     (..., ny, nx//2+1) ndmap
         Half of the full FFT, sufficient to recover a real-valued
         function.
+
+    Notes
+    -----
+    With an FFTW engine, the transform is planned once per shape, dtype and
+    nthread, see fft_plans.get_plan. Other engines plan internally, and are
+    called directly.
     """
-    res  = enmap.samewcs(
-        enfft.rfft(emap, omap, axes=[-2, -1], nthread=nthread), emap
-        )
+    if fft_plans.has_plans():
+        plan = fft_plans.get_plan(emap.shape, emap.dtype, nthread=nthread)
+        res = plan(emap, omap)
+    else:
+        res = enfft.rfft(emap, omap, nthread=nthread, axes=[-2, -1])
+    res  = enmap.samewcs(res, emap)
 
     # array size norms
     if normalize == 'forward':
@@ -2162,10 +2390,19 @@ def irfft(emap, omap=None, n=None, nthread=0, normalize='ortho', adjoint_fft=Fal
     -------
     (..., ny, nx) ndmap
         A real-valued real-space map.
+
+    Notes
+    -----
+    With an FFTW engine, the transform is planned once per shape, dtype, n
+    and nthread, see fft_plans.get_plan. Other engines plan internally, and
+    are called directly.
     """
-    res  = enmap.samewcs(
-        enfft.irfft(emap, omap, n=n, axes=[-2, -1], nthread=nthread, normalize=False), emap
-        )
+    if fft_plans.has_plans():
+        plan = fft_plans.get_plan(emap.shape, emap.dtype, n=n, inverse=True, nthread=nthread)
+        res = plan(emap, omap)
+    else:
+        res = enfft.irfft(emap, omap, n=n, nthread=nthread, axes=[-2, -1])
+    res  = enmap.samewcs(res, emap)
     
     # array size norms
     if normalize == 'backward':
@@ -2241,6 +2478,72 @@ def read_alm(fn):
     
     return real + 1j*imag
 
+# opt-in lossy storage of model files. each array is divided by a scale
+# before casting, so that it fills the range of the reduced-precision type:
+# float16 keeps a relative precision of 2**-11 (down to ~6e-5 of the scale),
+# and int16 an absolute precision of half a step of 1/32767 of the scale
+QUANTIZE_DTYPES = {'float16': np.float16, 'int16': np.int16}
+
+def quantize(imap, quantize, axes=None):
+    """Quantize a real array to a reduced-precision type.
+
+    Parameters
+    ----------
+    imap : array-like
+        Real array to quantize.
+    quantize : str
+        One of the keys of QUANTIZE_DTYPES.
+    axes : int or iterable of int, optional
+        Axes over which each scale is shared, by default None. If None, one
+        scale is shared by the whole array.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray, float
+        The quantized array, the scale (broadcasting against the quantized
+        array) by which to multiply it to recover imap, and the maximum
+        absolute error of the recovered array.
+    """
+    if quantize not in QUANTIZE_DTYPES:
+        raise ValueError(f'quantize must be one of {list(QUANTIZE_DTYPES)}, got {quantize}')
+    imap = np.asarray(imap)
+    assert np.isrealobj(imap), 'Can only quantize real arrays'
+
+    dtype = QUANTIZE_DTYPES[quantize]
+    scale = np.max(np.abs(imap), axis=axes, keepdims=True).astype(np.float64)
+    if quantize == 'int16':
+        scale /= np.iinfo(dtype).max
+    scale[scale == 0] = 1
+
+    qmap = imap / scale
+    if np.issubdtype(dtype, np.integer):
+        np.rint(qmap, out=qmap)
+    qmap = qmap.astype(dtype)
+
+    max_abs_err = np.max(np.abs(dequantize(qmap, scale, imap.dtype) - imap), initial=0)
+    return qmap, scale, float(max_abs_err)
+
+def dequantize(qmap, scale, dtype=np.float32):
+    """Recover an array quantized by quantize.
+
+    Parameters
+    ----------
+    qmap : array-like
+        The quantized array.
+    scale : array-like
+        The scale of the quantized array.
+    dtype : np.dtype, optional
+        The dtype of the recovered array, by default np.float32.
+
+    Returns
+    -------
+    np.ndarray
+        The recovered array.
+    """
+    omap = np.asarray(qmap).astype(dtype)
+    omap *= np.asarray(scale, dtype=dtype)
+    return omap
+
 def hash_qid(qid, ndigits=9):
     """Turn a qid string into an ndigit hash, using hashlib.sha256 hashing"""
     return int(hashlib.sha256(qid.encode('utf-8')).hexdigest(), 16) % 10**ndigits
@@ -2278,7 +2581,11 @@ def get_seed(split_num, sim_num, data_model, *qids, n_max_qids=4, ndigits=9):
     seed = [0 for i in range(3 + n_max_qids)]
     seed[0] = split_num
     seed[1] = sim_num
-    seed[2] = sints.noise_seed_indices[data_model.name]
+    try:
+        seed[2] = sints.noise_seed_indices[data_model.name]
+    except KeyError:
+        # data models not known to soapack, e.g. soapack_utils.FakeDataModel
+        seed[2] = data_model.noise_seed_index
     for i in range(len(qids)):
         seed[i+3] = hash_qid(qids[i], ndigits=ndigits)
     return seed
@@ -1,7 +1,7 @@
 import numpy as np
 
 from pixell import enmap, curvedsky, sharp
-from mnms import utils
+from mnms import utils, telemetry
 from optweight import noise_utils, type_utils, alm_c_utils, operators, wlm_utils
 from optweight import mat_utils, wavtrans, map_utils
 import healpy as hp
@@ -204,18 +204,19 @@ def estimate_sqrt_cov_wav_from_enmap(imap, mask_obs, lmax, mask_est, lamb=1.3,
 
     # Need separate alms for the smaller mask and the total observed mask.
     ainfo = sharp.alm_info(lmax)
-    alm = utils.map2alm(imap * mask_est, ainfo=ainfo)
+    with telemetry.span('ell-filter'):
+        alm = utils.map2alm(imap * mask_est, ainfo=ainfo)
 
-    # Determine correlated pseudo spectra for filtering.
-    sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', 0.5, mask_est=mask_est)
-    inv_sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', -0.5, mask_est=mask_est)
+        # Determine correlated pseudo spectra for filtering.
+        sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', 0.5, mask_est=mask_est)
+        inv_sqrt_cov_ell = utils.get_ps_mat(alm, 'harmonic', -0.5, mask_est=mask_est)
 
-    # Re-use buffer from first alm for second alm.
-    # Apply inverse N_ell^0.5 filter.
-    alm_obs = utils.map2alm(imap * mask_obs, alm=alm, ainfo=ainfo)
-    alm_obs = utils.ell_filter_correlated(
-        alm_obs, 'harmonic', inv_sqrt_cov_ell, ainfo=ainfo, lmax=lmax
-        )
+        # Re-use buffer from first alm for second alm.
+        # Apply inverse N_ell^0.5 filter.
+        alm_obs = utils.map2alm(imap * mask_obs, alm=alm, ainfo=ainfo)
+        alm_obs = utils.ell_filter_correlated(
+            alm_obs, 'harmonic', inv_sqrt_cov_ell, ainfo=ainfo, lmax=lmax
+            )
 
     # Get wavelet kernels and estimate wavelet covariance.
     lmin = 10
@@ -228,11 +229,13 @@ def estimate_sqrt_cov_wav_from_enmap(imap, mask_obs, lmax, mask_est, lamb=1.3,
     wav_template = wavtrans.Wav.from_enmap(imap.shape, imap.wcs, w_ell, 1,
                                            preshape=imap.shape[:-2],
                                            dtype=type_utils.to_real(alm_obs.dtype))
-    cov_wav = noise_utils.estimate_cov_wav(alm_obs, ainfo, w_ell, [0, 2], diag=False,
-                                           features=features, minfo_features=minfo_features,
-                                           wav_template=wav_template, fwhm_fact=fwhm_fact)
-    sqrt_cov_wav = mat_utils.wavmatpow(cov_wav, 0.5, return_diag=True, axes=[[0,1], [2,3]],
-                                        inplace=True)
+    with telemetry.span('outer-product'):
+        cov_wav = noise_utils.estimate_cov_wav(alm_obs, ainfo, w_ell, [0, 2], diag=False,
+                                               features=features, minfo_features=minfo_features,
+                                               wav_template=wav_template, fwhm_fact=fwhm_fact)
+    with telemetry.span('eigpow'):
+        sqrt_cov_wav = mat_utils.wavmatpow(cov_wav, 0.5, return_diag=True, axes=[[0,1], [2,3]],
+                                            inplace=True)
 
     return sqrt_cov_wav, sqrt_cov_ell, w_ell
 
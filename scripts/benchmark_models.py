@@ -0,0 +1,145 @@
+from mnms import noise_models as nm, soapack_utils as s_utils, telemetry
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import json
+import time
+from concurrent import futures
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                 description='Time get_model and get_sim on '
+                                 'synthetic data from soapack_utils.FakeDataModel')
+parser.add_argument('--models', dest='models', nargs='+', type=str,
+                    default=['tile', 'wav', 'fdw', 'mix'], choices=['tile', 'wav', 'fdw', 'mix'],
+                    help='benchmark these models; mix is a HarmonicMixture of tile '
+                    'and fdw, split at half the lmax')
+
+parser.add_argument('--downgrade', dest='downgrade', nargs='+', type=int, default=[1, 2, 4],
+                    help='benchmark each model at each of these downgrade factors')
+
+parser.add_argument('--nsims', dest='nsims', type=int, default=2,
+                    help='draw this many sims per model')
+
+parser.add_argument('--map', dest='alm', default=True,
+                    action='store_false', help='Generate simulated maps instead of alms.')
+
+parser.add_argument('--data-path', dest='data_path', type=str, default=None,
+                    help='keep the synthetic data in this directory, reusing it '
+                    'if already generated; if not provided, use a temporary directory')
+
+parser.add_argument('--nqids', dest='nqids', type=int, default=1,
+                    help='number of synthetic arrays to model jointly')
+
+parser.add_argument('--nsplits', dest='nsplits', type=int, default=2,
+                    help='number of synthetic splits per array')
+
+parser.add_argument('--size-deg', dest='size_deg', type=float, default=30.,
+                    help='side length of the synthetic square patch in degrees. fdw '
+                    'kernels extend to ell=10800, and need at least --size-deg 40 '
+                    '--res-arcmin 0.5 to not be empty')
+
+parser.add_argument('--res-arcmin', dest='res_arcmin', type=float, default=2.,
+                    help='pixel size of the synthetic data in arcmin')
+
+parser.add_argument('--seed', dest='seed', type=int, default=0,
+                    help='seed of the synthetic data')
+
+parser.add_argument('--n', dest='n', type=int, default=36,
+                    help='fdw: approx. bandlimit (in radians per azimuthal radian) of the '
+                    'directional kernels.')
+
+parser.add_argument('--p', dest='p', type=int, default=2,
+                    help='fdw: the locality parameter of each azimuthal kernel.')
+
+parser.add_argument('--output', dest='output', type=str, default=None,
+                    help='append the results of each benchmark to this file as JSON lines')
+args = parser.parse_args()
+
+def get_model(name, data_model, qids, downgrade):
+    kwargs = dict(data_model=data_model, downgrade=downgrade, mask_version=data_model.name)
+    if name == 'tile':
+        return nm.TiledNoiseModel(*qids, **kwargs)
+    elif name == 'wav':
+        return nm.WaveletNoiseModel(*qids, **kwargs)
+    elif name == 'fdw':
+        return nm.FDWNoiseModel(*qids, n=args.n, p=args.p, **kwargs)
+    elif name == 'mix':
+        models = [get_model('tile', data_model, qids, downgrade),
+                  get_model('fdw', data_model, qids, downgrade)]
+        lmax = models[-1]._sim_inm._lmax
+        return nm.HarmonicMixture(models, [lmax // 2], [2 * (lmax // 20)])
+
+def benchmark(name, data_model, qids, downgrade):
+    """Build the model of split 0 and draw nsims sims from it, returning the
+    timings and peak memory. Runs in a fresh process, so the peak memory is
+    that of this benchmark alone."""
+    telemetry.enable()
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    model = get_model(name, data_model, qids, downgrade)
+
+    t0 = time.perf_counter()
+    model.get_model(0, check_on_disk=False, keep_model=True, keep_ivar=True, write=False)
+    t_model = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for i in range(args.nsims):
+        if name == 'mix':
+            sim = model.get_sim(
+                0, i, alm=args.alm, check_on_disk=False, check_mix_on_disk=False,
+                write=False
+                )
+        else:
+            sim = model.get_sim(0, i, alm=args.alm, check_on_disk=False, write=False)
+    t_sim = (time.perf_counter() - t0) / args.nsims
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return dict(
+        model=name, downgrade=downgrade, nqids=len(qids), sim_shape=list(sim.shape),
+        model_time=t_model, sim_time=t_sim, sims_per_hour=3600 / t_sim,
+        sim_msamples_per_sec=sim.size / t_sim / 1e6, peak_rss_gb=rss / 1e9,
+        baseline_rss_gb=rss0 / 1e9, stages=telemetry.summarize()
+        )
+
+# Workers re-import this script, so only run the benchmarks when it is run
+# directly
+if __name__ == '__main__':
+    qids = [f'fake_pa{i}' for i in range(args.nqids)]
+    box = [[-args.size_deg / 2, args.size_deg / 2], [args.size_deg / 2, -args.size_deg / 2]]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_path = args.data_path if args.data_path is not None else tmpdir
+        data_model = s_utils.FakeDataModel(
+            data_path, qids=qids, num_splits=args.nsplits, box_deg=box,
+            res_arcmin=args.res_arcmin, seed=args.seed
+            )
+
+        results = []
+        ctx = multiprocessing.get_context('spawn')
+        for name in args.models:
+            for downgrade in args.downgrade:
+                # fdw models are estimated at half the downgrade factor
+                if name in ['fdw', 'mix'] and downgrade < 2:
+                    print(f'Skipping {name} at downgrade {downgrade}, must be at least 2')
+                    continue
+
+                print(f'Benchmarking {name} at downgrade {downgrade}')
+                with futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                    try:
+                        res = pool.submit(benchmark, name, data_model, qids, downgrade).result()
+                    except Exception as e:
+                        print(f'Benchmark of {name} at downgrade {downgrade} failed: {e!r}')
+                        continue
+                results.append(res)
+
+                if args.output is not None:
+                    with open(args.output, 'a') as f:
+                        f.write(json.dumps(res) + '\n')
+
+    print(f'{"model":>6} {"dg":>3} {"model [s]":>10} {"sim [s]":>9} {"sims/hr":>9} '
+          f'{"Msamp/s":>8} {"peak [GB]":>10}')
+    for res in results:
+        print(f'{res["model"]:>6} {res["downgrade"]:>3d} {res["model_time"]:>10.2f} '
+              f'{res["sim_time"]:>9.2f} {res["sims_per_hour"]:>9.1f} '
+              f'{res["sim_msamples_per_sec"]:>8.2f} {res["peak_rss_gb"]:>10.3f}')
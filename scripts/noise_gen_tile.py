@@ -52,6 +52,10 @@ parser.add_argument('--split', nargs='+', dest='split', type=int,
 parser.add_argument('--no-auto-split', dest='auto_split', default=True, 
                     action='store_false', help='if passed, do not simulate every '
                     'split for this array')
+
+parser.add_argument('--nproc', dest='nproc', type=int, default=1,
+                    help='build the models of this many splits at once, in '
+                    'separate processes')
 args = parser.parse_args()
 
 if args.data_model:
@@ -72,6 +76,11 @@ else:
     splits = np.atleast_1d(args.split)
 assert np.all(splits >= 0)
 
-# Iterate over models
-for s in splits:
-    model.get_model(s, verbose=True)
\ No newline at end of file
+# Iterate over models. The worker processes of get_models re-import this
+# script, so only build models when it is run directly
+if __name__ == '__main__':
+    if args.nproc > 1:
+        model.get_models(splits, nproc=args.nproc, verbose=True)
+    else:
+        for s in splits:
+            model.get_model(s, verbose=True)
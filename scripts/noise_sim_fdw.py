@@ -1,6 +1,7 @@
-from mnms import noise_models as nm
+from mnms import noise_models as nm, simio
 from soapack import interfaces as sints
 import argparse
+import contextlib
 import numpy as np
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -81,6 +82,11 @@ parser.add_argument('--maps-step', dest='maps_step', type=int, default=1,
 
 parser.add_argument('--map', dest='alm', default=True, 
                     action='store_false', help='Generate simulated maps instead of alms.')
+
+parser.add_argument('--write-threads', dest='write_threads', type=int, default=0,
+                    help='write sims to disk with this many background threads, '
+                    'overlapping writing with generating the next sim; if 0, write '
+                    'each sim before generating the next')
 args = parser.parse_args()
 
 if args.data_model:
@@ -111,8 +117,14 @@ else:
 assert np.all(maps >= 0)
 
 # Iterate over sims
-for s in splits:
-    for m in maps:
-        model.get_sim(s, m, alm=args.alm, write=True, verbose=True)
-    model.delete_model(s)
-    model.delete_ivar(s)
\ No newline at end of file
+if args.write_threads > 0:
+    write_context = simio.SimWriter(nthread=args.write_threads)
+else:
+    write_context = contextlib.nullcontext()
+
+with write_context as writer:
+    for s in splits:
+        for m in maps:
+            model.get_sim(s, m, alm=args.alm, write=True, writer=writer, verbose=True)
+        model.delete_model(s)
+        model.delete_ivar(s)
@@ -67,4 +67,52 @@ def test_concurrent_gaussian_filter():
     conc = utils.concurrent_gaussian_filter(
         a, (100, 100), flatten_axes=[0, 1, 2], mode=['constant', 'wrap']
     )
-    assert np.all(true == conc)
\ No newline at end of file
+    assert np.all(true == conc)
+
+def test_concurrent_outer_flat_triu():
+    a = np.random.randn(4,30,40)
+    true = utils.to_flat_triu(np.einsum('ayx, byx -> abyx', a, a), axis1=0, axis2=1)
+    conc = utils.concurrent_outer_flat_triu(a, nthread=3)
+    assert conc.shape == (10, 30, 40)
+    assert np.all(true == conc)
+
+def test_symv_flat_triu():
+    a = np.random.randn(2,1,6,30,40)
+    x = np.random.randn(5,3,30,40)
+    full = utils.from_flat_triu(a, axis1=2, axis2=3, flat_triu_axis=2)
+    true = np.einsum('...abyx, ...byx -> ...ayx', full, x)
+    conc = utils.symv_flat_triu(a, x, nthread=3)
+    assert conc.shape == (2, 5, 3, 30, 40)
+    assert np.allclose(true, conc, rtol=0, atol=1e-12)
+    assert np.array_equal(conc, utils.symv_flat_triu(a, x, nthread=1))
+
+    # the transposes of upper-triangular matrices
+    rows, cols = utils.triu_indices(3)
+    full = np.zeros_like(full)
+    full[..., rows, cols, :, :] = a
+    true = np.einsum('...bayx, ...byx -> ...ayx', full, x)
+    conc = utils.symv_flat_triu(a, x, triangular=True, nthread=3)
+    assert np.allclose(true, conc, rtol=0, atol=1e-12)
+
+def test_concurrent_normal_rows():
+    size = (37, 3, 5, 6)
+    seed = 103_094
+    full = utils.concurrent_normal(size=size, seed=seed, complex=True, scale=5)
+    for rows in [[0], [5, 6, 7], [1, 30, 36], []]:
+        out = utils.concurrent_normal(size=size, seed=seed, complex=True, scale=5, rows=rows)
+        assert out.dtype == full.dtype
+        assert np.array_equal(out, full[rows])
+
+def test_keyed_normal():
+    keys = [(0, 0), (0, 1), (5, 0), (9, 2)]
+    seed = [103_094, 7]
+    full = utils.keyed_normal(keys, size=(30, 40), seed=seed, complex=True, scale=5, nthread=1)
+    assert full.shape == (4, 30, 40) and full.dtype == np.complex64
+
+    ss = np.random.SeedSequence(seed, spawn_key=(5, 0))
+    draw = np.random.Generator(np.random.Philox(ss)).standard_normal((2, 30, 40), dtype=np.float32)
+    assert np.array_equal(full[2], 5*(draw[0] + 1j*draw[1]))
+
+    # each key is independent of the others and of the threads
+    out = utils.keyed_normal(keys[::-2], size=(30, 40), seed=seed, complex=True, scale=5, nthread=3)
+    assert np.array_equal(out, full[::-2])
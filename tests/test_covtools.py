@@ -0,0 +1,17 @@
+from pixell import enmap
+from mnms import covtools
+import numpy as np
+
+def test_smooth_ps_grid_uniform_stack():
+    shape, wcs = enmap.geometry([0,0], shape=(120, 120), res=np.pi/180/30)
+    rng = np.random.default_rng(0)
+    ps = enmap.ndmap(rng.random((3, 4, *shape), dtype=np.float32), wcs)
+
+    # a stack of spectra is filled and smoothed as if one at a time
+    out = covtools.smooth_ps_grid_uniform(
+        ps.copy(), 400, diag=True, fill=True, fill_lmax_est_width=300, nthread=2
+        )
+    for idx in np.ndindex(ps.shape[:-2]):
+        assert np.array_equal(out[idx], covtools.smooth_ps_grid_uniform(
+            ps[idx].copy(), 400, diag=True, fill=True, fill_lmax_est_width=300
+            ))
@@ -0,0 +1,31 @@
+from mnms import soapack_utils as s_utils, utils
+import numpy as np
+
+def test_fake_data_model(tmp_path):
+    kwargs = dict(
+        qids=('pa0', 'pa1'), num_splits=2, box_deg=[[-3, 3], [3, -3]], res_arcmin=6.,
+        name='test_fake'
+        )
+    dm = s_utils.FakeDataModel(tmp_path / 'a', **kwargs)
+    
+    assert utils.get_nsplits_by_qid('pa1', dm) == 2
+    assert s_utils.read_map_geometry(dm, 'pa0', ivar=True)[0] == (1, 60, 60)
+    
+    imap = s_utils.read_map(dm, 'pa0', split_num=1)
+    ivar = s_utils.read_map(dm, 'pa0', split_num=1, ivar=True)
+    assert imap.shape == (3, 60, 60) and imap.dtype == np.float32
+    assert np.all(imap[:, ivar[0] == 0] == 0)
+
+    # the coadd is the ivar-weighted mean of the splits
+    imaps = [s_utils.read_map(dm, 'pa0', split_num=s) for s in range(2)]
+    ivars = [s_utils.read_map(dm, 'pa0', split_num=s, ivar=True) for s in range(2)]
+    cvar = s_utils.read_map(dm, 'pa0', coadd=True, ivar=True)
+    cmap = s_utils.read_map(dm, 'pa0', coadd=True)
+    assert np.allclose(cvar, ivars[0] + ivars[1])
+    assert np.allclose(cmap * cvar, imaps[0] * ivars[0] + imaps[1] * ivars[1], atol=1e-4)
+
+    # products are a deterministic function of the arguments
+    dm2 = s_utils.FakeDataModel(tmp_path / 'b', **kwargs)
+    assert np.all(s_utils.read_map(dm2, 'pa0', split_num=1) == imap)
+    assert not np.all(s_utils.read_map(dm2, 'pa1', split_num=1) == imap)
+    assert utils.get_seed(0, 0, dm, 'pa0')[2] == dm.noise_seed_index
@@ -1,6 +1,8 @@
 from pixell import enmap
 from mnms import utils, fdw_noise
 import numpy as np 
+import h5py
+import pytest
 
 def test_wav_admissibility():
     shape = (2, 700, 700)
@@ -34,4 +36,336 @@ def test_wav_reconstruction():
     fa2 = fk.wav2k(wavs) 
     a2 = utils.irfft(fa2.copy(), n=shape[-1])
     assert np.max(np.abs(a2-a) < 5e-6)
-    assert np.mean(np.abs(a2-a) < 5e-7)
\ No newline at end of file
+    assert np.mean(np.abs(a2-a) < 5e-7)
+
+def test_wav_concurrent_kernels():
+    shape = (2, 700, 700)
+    _, wcs = enmap.geometry([0,0], shape=shape, res=np.pi/180/30)
+    fk = fdw_noise.FDWKernels(1.8, 10_000, 10, 5300, 4, 2, shape, wcs,
+                                nforw=[0, 2], pforw=[0, 2], dtype=np.float32)
+
+    # the set has both small and large kernels
+    sizes = [kern.size for kern in fk.kernels.values()]
+    assert min(sizes) < fdw_noise.MIN_THREADED_KERNEL_SIZE <= max(sizes)
+
+    rng = np.random.default_rng(0)
+    fa = utils.rfft(rng.standard_normal(shape, dtype=np.float32))
+    wavs = fk.k2wav(fa, nthread=1)
+    wavs4 = fk.k2wav(fa, nthread=4)
+    assert list(wavs4) == list(fk.kernels)
+    for kern_key in wavs:
+        assert np.array_equal(wavs[kern_key], wavs4[kern_key])
+    assert np.array_equal(fk.wav2k(wavs, nthread=1), fk.wav2k(wavs, nthread=4))
+
+def test_kernel_support():
+    shape = (2, 700, 700)
+    _, wcs = enmap.geometry([0,0], shape=shape, res=np.pi/180/30)
+    fk = fdw_noise.FDWKernels(1.8, 10_000, 10, 5300, 4, 2, shape, wcs,
+                                nforw=[0, 2], pforw=[0, 2], dtype=np.float32)
+    
+    rng = np.random.default_rng(0)
+    fa = utils.rfft(rng.standard_normal(shape, dtype=np.float32))
+    for kern in fk.kernels.values():
+        # only the nonzero elements of the kernel are stored
+        k_kernel = kern._k_kernel
+        assert len(kern._k_values) == np.count_nonzero(k_kernel)
+
+        # the same kernel, stored densely
+        kern2 = fdw_noise.Kernel(k_kernel, index=kern.index, sels=kern._sels)
+        assert np.array_equal(kern2._k_kernel, k_kernel)
+
+        # analysis and synthesis only touch the support
+        _fa = np.empty((*shape[:-2], *k_kernel.shape), dtype=fa.dtype)
+        for sel in kern._sels:
+            _fa[sel] = k_kernel[sel] * fa[sel]
+        wmap = kern.k2wav(fa, nthread=1)
+        assert np.array_equal(wmap, utils.irfft(_fa, n=kern._n, normalize='backward'))
+        assert np.array_equal(
+            kern.wav2k(wmap, nthread=1),
+            utils.rfft(wmap, normalize='backward') * kern._k_kernel_conj
+            )
+        
+        fa2 = np.zeros_like(fa)
+        kern.add_support(fa2, kern.wav2k(wmap, support_only=True, nthread=1))
+        for sel in kern._sels:
+            assert np.array_equal(fa2[sel], kern.wav2k(wmap, nthread=1)[sel])
+
+def test_fdw_noise_sims():
+    shape = (2, 700, 700)
+    _, wcs = enmap.geometry([0,0], shape=shape, res=np.pi/180/30)
+    fk = fdw_noise.FDWKernels(1.8, 10_000, 10, 5300, 36, 2, shape, wcs,
+                                nforw=[0, 12, 12, 12, 12, 24, 24, 24, 24],
+                                nback=[18],
+                                pforw=[0, 12, 9, 6, 3, 24, 18, 12, 6],
+                                dtype=np.float32)
+
+    rng = np.random.default_rng(0)
+    a = rng.standard_normal(shape, dtype=np.float32)
+    wavs = fk.k2wav(utils.rfft(a))
+    sqrt_cov_wavs = {}
+    for idx, wmap in wavs.items():
+        sqrt_cov_wavs[idx] = rng.standard_normal(
+            (2, 2, *wmap.shape[-2:]), dtype=np.float32
+            )
+
+    seeds = [[0, 1, 2], [0, 1, 3], [4, 1, 2]]
+    sims = fdw_noise.get_fdw_noise_sims(fk, sqrt_cov_wavs, seeds, verbose=False)
+    assert sims.shape == (3, *shape)
+    for seed, sim in zip(seeds, sims):
+        assert np.array_equal(
+            sim, fdw_noise.get_fdw_noise_sim(fk, sqrt_cov_wavs, seed=seed, verbose=False)
+            )
+
+def test_fdw_noise_covsqrt_flat_triu():
+    shape = (2, 700, 700)
+    _, wcs = enmap.geometry([0,0], shape=shape, res=np.pi/180/30)
+    fk = fdw_noise.FDWKernels(1.8, 10_000, 10, 5300, 4, 2, shape, wcs, nforw=[0, 2], pforw=[0, 2],
+                                dtype=np.float32)
+
+    rng = np.random.default_rng(0)
+    a = enmap.ndmap(rng.standard_normal(shape, dtype=np.float32), wcs)
+    a[1] += a[0]
+    sqrt_cov_wavs = fdw_noise.get_fdw_noise_covsqrt(fk, a, rad_filt=False, verbose=False)
+
+    # only the upper triangle of each square-root covariance is kept
+    full_sqrt_cov_wavs = {}
+    for idx, wmap in sqrt_cov_wavs.items():
+        assert wmap.shape == (3, *wmap.shape[-2:])
+        full_sqrt_cov_wavs[idx] = utils.from_flat_triu(wmap, axis1=0, axis2=1, flat_triu_axis=0)
+        assert np.all(full_sqrt_cov_wavs[idx][0, 0] >= 0)
+
+    # the sims are the same as if drawn from the full matrices
+    seeds = [[0, 1, 2], [0, 1, 3]]
+    assert np.array_equal(
+        fdw_noise.get_fdw_noise_sims(fk, sqrt_cov_wavs, seeds, verbose=False),
+        fdw_noise.get_fdw_noise_sims(fk, full_sqrt_cov_wavs, seeds, verbose=False)
+        )
+
+def test_read_wavs_lazy(tmp_path):
+    _, wcs = enmap.geometry([0,0], shape=(10, 20), res=np.pi/180/30)
+    rng = np.random.default_rng(0)
+    wavs = {
+        (0, 0): enmap.ndmap(rng.standard_normal((2, 2, 10, 20), dtype=np.float32), wcs),
+        (1, 3): enmap.ndmap(rng.standard_normal((2, 2, 5, 10), dtype=np.float32), wcs)
+        }
+    sqrt_cov_ell = rng.standard_normal((2, 2, 100))
+    fn = str(tmp_path / 'wavs.hdf5')
+    fdw_noise.write_wavs(fn, wavs, extra_datasets={'sqrt_cov_ell': sqrt_cov_ell})
+
+    for mmap in [False, True]:
+        lazy_wavs, extra_datasets = fdw_noise.read_wavs(
+            fn, extra_datasets=['sqrt_cov_ell'], lazy=True, mmap=mmap
+            )
+        assert np.array_equal(extra_datasets['sqrt_cov_ell'], sqrt_cov_ell)
+        assert sorted(lazy_wavs) == sorted(wavs)
+        for key, wmap in lazy_wavs.items():
+            assert np.array_equal(wmap, wavs[key])
+            assert wmap.flags.writeable != mmap # mmap views are read-only
+        lazy_wavs.close()
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'lzf'])
+@pytest.mark.parametrize('quantize', [None, 'float16', 'int16'])
+def test_write_wavs_storage(tmp_path, compression, quantize):
+    _, wcs = enmap.geometry([0,0], shape=(10, 20), res=np.pi/180/30)
+    rng = np.random.default_rng(0)
+    wavs = {
+        (0, 0): enmap.ndmap(rng.standard_normal((3, 10, 20), dtype=np.float32), wcs),
+        (1, 3): enmap.ndmap(rng.standard_normal((3, 5, 10), dtype=np.float32), wcs)
+        }
+    wavs[(1, 3)][1] *= 100
+    sqrt_cov_ell = rng.standard_normal((2, 2, 100))
+    fn = str(tmp_path / 'wavs.hdf5')
+    fdw_noise.write_wavs(
+        fn, wavs, extra_datasets={'sqrt_cov_ell': sqrt_cov_ell}, compression=compression,
+        quantize=quantize
+        )
+
+    # the extra datasets are never quantized
+    for lazy in [False, True]:
+        read_wavs, extra_datasets = fdw_noise.read_wavs(
+            fn, extra_datasets=['sqrt_cov_ell'], lazy=lazy, mmap=lazy
+            )
+        assert np.array_equal(extra_datasets['sqrt_cov_ell'], sqrt_cov_ell)
+        for key, wmap in read_wavs.items():
+            assert wmap.dtype == np.float32
+            assert wmap.wcs is not None
+            if quantize is None:
+                assert np.array_equal(wmap, wavs[key])
+            else:
+                # each map has its own scale
+                err = np.abs(wmap - wavs[key])
+                scale = np.abs(wavs[key]).max(axis=(-2, -1), keepdims=True)
+                assert np.all(err <= 2**-11 * scale)
+                with h5py.File(fn, 'r') as hfile:
+                    dname = '_'.join(str(i) for i in key)
+                    assert hfile[dname].attrs['quantize_max_abs_err'] == err.max()
+
+    with pytest.raises(ValueError):
+        fdw_noise.write_wavs(fn, wavs, compression='bzip2')
+
+def test_fdw_noise_covsqrt_checkpoint(tmp_path):
+    shape = (1, 700, 700)
+    _, wcs = enmap.geometry([0,0], shape=shape, res=np.pi/180/30)
+    fk = fdw_noise.FDWKernels(1.8, 10_000, 10, 5300, 4, 2, shape, wcs, nforw=[0, 2], pforw=[0, 2],
+                                dtype=np.float32)
+
+    rng = np.random.default_rng(0)
+    a = enmap.ndmap(rng.standard_normal(shape, dtype=np.float32), wcs)
+    sqrt_cov_wavs = fdw_noise.get_fdw_noise_covsqrt(fk, a, rad_filt=False, verbose=False)
+
+    # interrupt a checkpoint after its first kernels
+    fn = str(tmp_path / 'model.hdf5')
+    fdw_noise.get_fdw_noise_covsqrt(
+        fk, a, rad_filt=False, checkpoint_fname=fn, verbose=False
+        )
+    assert fdw_noise.is_complete(fn)
+    with h5py.File(fn, 'a') as hfile:
+        for idx in list(fk.kernels)[3:]:
+            del hfile['_'.join(str(i) for i in idx)]
+        hfile.attrs['complete'] = False
+    assert not fdw_noise.is_complete(fn)
+    with pytest.raises(OSError):
+        fdw_noise.read_wavs(fn)
+
+    # resume it
+    resumed_sqrt_cov_wavs = fdw_noise.get_fdw_noise_covsqrt(
+        fk, a, rad_filt=False, checkpoint_fname=fn, verbose=False
+        )
+    assert fdw_noise.is_complete(fn)
+    assert list(resumed_sqrt_cov_wavs) == list(fk.kernels)
+    on_disk_sqrt_cov_wavs = fdw_noise.read_wavs(fn)
+    for idx, wmap in sqrt_cov_wavs.items():
+        assert np.array_equal(resumed_sqrt_cov_wavs[idx], wmap)
+        assert np.array_equal(on_disk_sqrt_cov_wavs[idx], wmap)
+
+def test_fdw_kernels_cache(tmp_path):
+    shape = (2, 700, 700)
+    _, wcs = enmap.geometry([0,0], shape=shape, res=np.pi/180/30)
+    args = (1.8, 10_000, 10, 5300, 4, 2, shape[-2:], wcs)
+    kwargs = dict(nforw=[0, 2], pforw=[0, 2], dtype=np.float32)
+
+    fk = fdw_noise.get_cached_fdw_kernels(tmp_path, *args, **kwargs)
+    fname = fdw_noise.get_kernels_cache_fname(tmp_path, *args, **kwargs)
+    assert fdw_noise.is_complete(fname)
+    assert fname != fdw_noise.get_kernels_cache_fname(tmp_path, *args[:4], 6, *args[5:], **kwargs)
+
+    # a second call loads identical kernels from the cache
+    fk2 = fdw_noise.get_cached_fdw_kernels(tmp_path, *args, **kwargs)
+    assert list(fk2.kernels) == list(fk.kernels)
+    for kern_key, kern in fk.kernels.items():
+        kern2 = fk2.kernels[kern_key]
+        assert np.array_equal(kern2._k_kernel, kern._k_kernel)
+        assert np.all(kern2._k_kernel.wcs.wcs.cdelt == kern._k_kernel.wcs.wcs.cdelt)
+        assert kern2._sels == kern._sels
+        assert fk2.lmaxs[kern_key] == fk.lmaxs[kern_key]
+        assert fk2.mean_sqs[kern_key] == fk.mean_sqs[kern_key]
+
+    rng = np.random.default_rng(0)
+    a = enmap.ndmap(rng.standard_normal(shape, dtype=np.float32), wcs)
+    sqrt_cov_wavs = fdw_noise.get_fdw_noise_covsqrt(fk, a, rad_filt=False, verbose=False)
+    sqrt_cov_wavs2 = fdw_noise.get_fdw_noise_covsqrt(fk2, a, rad_filt=False, verbose=False)
+    for kern_key in sqrt_cov_wavs:
+        assert np.array_equal(sqrt_cov_wavs2[kern_key], sqrt_cov_wavs[kern_key])
+
+def test_fdw_noise_roi_sims(tmp_path):
+    shape = (1, 700, 700)
+    _, wcs = enmap.geometry([0,0], shape=shape, res=np.pi/180/30)
+    kwargs = dict(nforw=[0, 2], pforw=[0, 2], dtype=np.float32)
+    fk = fdw_noise.FDWKernels(1.8, 10_000, 10, 5300, 4, 2, shape, wcs, **kwargs)
+
+    # noise with a gradient in depth
+    rng = np.random.default_rng(0)
+    a = enmap.ndmap(rng.standard_normal(shape, dtype=np.float32), wcs)
+    a *= np.linspace(0.5, 2, shape[-2], dtype=np.float32)[:, None]
+    sqrt_cov_wavs = fdw_noise.get_fdw_noise_covsqrt(fk, a, rad_filt=False, verbose=False)
+
+    # the low-ell kernels are empty in a small region
+    pixbox = np.array([[300, 250], [420, 370]])
+    pad = 90
+    rshape, rwcs = utils.slice_geometry_by_pixbox(shape, wcs, pixbox + [[-pad], [pad]])
+    with pytest.raises(AssertionError):
+        fdw_noise.FDWKernels(1.8, 10_000, 10, 5300, 4, 2, rshape, rwcs, **kwargs)
+    rfk = fdw_noise.FDWKernels(
+        1.8, 10_000, 10, 5300, 4, 2, rshape, rwcs, skip_empty=True, **kwargs
+        )
+    assert 0 < len(rfk.kernels) < len(fk.kernels)
+    assert set(rfk.kernels) <= set(fk.kernels)
+
+    # the kernels of the region are cached apart from the full kernels
+    args = (1.8, 10_000, 10, 5300, 4, 2, rshape, rwcs)
+    for i in range(2):
+        cached_rfk = fdw_noise.get_cached_fdw_kernels(tmp_path, *args, skip_empty=True, **kwargs)
+        assert list(cached_rfk.kernels) == list(rfk.kernels)
+    assert fdw_noise.get_kernels_cache_fname(tmp_path, *args, skip_empty=True, **kwargs) != \
+        fdw_noise.get_kernels_cache_fname(tmp_path, *args, **kwargs)
+
+    # the sims of the region have the same local power as the full sims
+    roi_sqrt_cov_wavs = fdw_noise.get_roi_sqrt_cov_wavs(fk, sqrt_cov_wavs, rfk)
+    seeds = [[0, i] for i in range(4)]
+    sims = fdw_noise.get_fdw_noise_sims(rfk, roi_sqrt_cov_wavs, seeds, verbose=False)
+    assert sims.shape == (4, 1, *rshape)
+    sims = sims[..., pad:-pad, pad:-pad]
+    full = fdw_noise.get_fdw_noise_sims(fk, sqrt_cov_wavs, seeds, verbose=False)
+    full = full[..., pixbox[0, 0]:pixbox[1, 0], pixbox[0, 1]:pixbox[1, 1]]
+    assert np.isclose(sims.var(), full.var(), rtol=0.1)
+
+    # including the depth gradient, in blocks of 30 rows
+    block_var = lambda m: m.reshape(4, 4, 30, 120).var(axis=(0, 2, 3))
+    assert np.allclose(block_var(sims), block_var(full), rtol=0.1)
+
+def test_fdw_noise_covsqrt_cholesky(tmp_path):
+    shape = (2, 700, 700)
+    _, wcs = enmap.geometry([0,0], shape=shape, res=np.pi/180/30)
+    fk = fdw_noise.FDWKernels(1.8, 10_000, 10, 5300, 4, 2, shape, wcs, nforw=[0, 2], pforw=[0, 2],
+                                dtype=np.float32)
+
+    rng = np.random.default_rng(0)
+    a = enmap.ndmap(rng.standard_normal(shape, dtype=np.float32), wcs)
+    a[1] += a[0]
+    sqrt_cov_wavs = fdw_noise.get_fdw_noise_covsqrt(
+        fk, a, rad_filt=False, sqrt_method='cholesky', verbose=False
+        )
+    assert fdw_noise.get_sqrt_method(sqrt_cov_wavs) == 'cholesky'
+
+    # the sims multiply by the transposes of the factors, as recorded
+    seeds = [[0, 1, 2], [0, 1, 3]]
+    sims = fdw_noise.get_fdw_noise_sims(fk, sqrt_cov_wavs, seeds, verbose=False)
+    full_sqrt_cov_wavs = fdw_noise.SqrtCovWavs({
+        idx: utils.from_flat_triu(wmap, axis1=0, axis2=1, flat_triu_axis=0) * \
+            np.triu(np.ones((2, 2), dtype=np.float32))[..., None, None]
+        for idx, wmap in sqrt_cov_wavs.items()
+        }, sqrt_method='cholesky')
+    assert np.array_equal(
+        sims, fdw_noise.get_fdw_noise_sims(fk, full_sqrt_cov_wavs, seeds, verbose=False)
+        )
+    assert not np.allclose(
+        sims, fdw_noise.get_fdw_noise_sims(fk, dict(sqrt_cov_wavs), seeds, verbose=False)
+        )
+
+    # and is read back from the model file, and from a checkpoint
+    fn = str(tmp_path / 'model.hdf5')
+    fdw_noise.write_wavs(fn, sqrt_cov_wavs)
+    ckpt_fn = str(tmp_path / 'checkpoint.hdf5')
+    fdw_noise.get_fdw_noise_covsqrt(
+        fk, a, rad_filt=False, sqrt_method='cholesky', checkpoint_fname=ckpt_fn, verbose=False
+        )
+    for fname in [fn, ckpt_fn]:
+        for lazy in [False, True]:
+            wavs = fdw_noise.read_wavs(fname, lazy=lazy)
+            assert fdw_noise.get_sqrt_method(wavs) == 'cholesky'
+            assert np.array_equal(
+                fdw_noise.get_fdw_noise_sims(fk, wavs, seeds, verbose=False), sims
+                )
+            if lazy:
+                wavs.close()
+
+    # a checkpoint of another method is started over
+    with h5py.File(ckpt_fn, 'a') as hfile:
+        hfile.attrs['complete'] = False
+    sqrt_cov_wavs = fdw_noise.get_fdw_noise_covsqrt(
+        fk, a, rad_filt=False, checkpoint_fname=ckpt_fn, verbose=False
+        )
+    assert fdw_noise.get_sqrt_method(fdw_noise.read_wavs(ckpt_fn)) == 'eigpow'
+
+    with pytest.raises(ValueError):
+        fdw_noise.get_fdw_noise_covsqrt(fk, a, rad_filt=False, sqrt_method='svd', verbose=False)
@@ -0,0 +1,100 @@
+from mnms import fft_plans, utils
+from pixell import enmap, fft as enfft
+import numpy as np
+import pytest
+
+from concurrent import futures
+
+@pytest.mark.parametrize('shape', [(2, 1, 64, 64), (3, 50, 51)])
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_fft_plan(shape, dtype):
+    rng = np.random.default_rng(0)
+    a = rng.standard_normal(shape).astype(dtype)
+
+    plan = fft_plans.get_plan(a.shape, a.dtype, nthread=1)
+    assert fft_plans.get_plan(a.shape, a.dtype, nthread=1) is plan
+    kmap = plan(a)
+    assert np.array_equal(kmap, enfft.rfft(a, axes=[-2, -1], nthread=1))
+
+    # transform through the pre-allocated buffers
+    plan.input_array[:] = a
+    assert plan() is plan.output_array
+    assert np.array_equal(plan.output_array, kmap)
+
+    iplan = fft_plans.get_plan(kmap.shape, kmap.dtype, n=shape[-1], inverse=True, nthread=1)
+    omap = iplan(kmap.copy())
+    assert omap.shape == shape and omap.dtype == dtype
+    assert np.array_equal(
+        omap, enfft.irfft(kmap.copy(), n=shape[-1], axes=[-2, -1], nthread=1)
+        )
+
+def test_rfft_irfft():
+    shape, wcs = enmap.geometry([0, 0], shape=(40, 41), res=np.pi/180/30)
+    imap = enmap.enmap(np.random.default_rng(1).standard_normal((2, *shape)), wcs)
+    for normalize in ['forward', 'backward', 'ortho', 'phys']:
+        kmap = utils.rfft(imap, normalize=normalize)
+        assert kmap.wcs is not None
+        omap = utils.irfft(kmap, n=shape[-1], normalize=normalize)
+        if normalize != 'backward':
+            assert np.allclose(omap, imap, rtol=0, atol=1e-12)
+
+def test_plan_cache():
+    fft_plans.clear_plans()
+    for i in range(fft_plans.MAX_PLANS + 1):
+        fft_plans.get_plan((4, i + 1), np.float32, nthread=1)
+    assert fft_plans.get_num_plans() == fft_plans.MAX_PLANS
+    fft_plans.clear_plans()
+    assert fft_plans.get_num_plans() == 0
+
+def test_wisdom(tmp_path):
+    fn = tmp_path / 'wisdom.pkl'
+    fft_plans.get_plan((8, 8), np.float64, nthread=1)
+    fft_plans.save_wisdom(fn)
+    loaded = fft_plans.load_wisdom(fn)
+    try:
+        import pyfftw
+    except ImportError:
+        assert not loaded
+
+def test_plan_cache_nbytes(monkeypatch):
+    fft_plans.clear_plans()
+    monkeypatch.setattr(fft_plans, 'MAX_PLAN_GB', 1e-4) # 100000 bytes
+
+    # each plan holds 32768 + 33792 bytes once its buffers are accessed
+    plans = []
+    for i in range(2):
+        plan = fft_plans.get_plan((64, 64 + 2 * i), np.float64, nthread=1)
+        plan.input_array, plan.output_array
+        plans.append(plan)
+    assert fft_plans.get_num_plans() == 2
+    assert fft_plans.get_plans_nbytes() > 1e5
+
+    # the next plan evicts the least recently used
+    fft_plans.get_plan((64, 64 + 2), np.float64, nthread=1)
+    fft_plans.get_plan((8, 8), np.float64, nthread=1)
+    assert fft_plans.get_num_plans() == 2
+    assert fft_plans.get_plan((64, 64 + 2), np.float64, nthread=1) is plans[1]
+    assert fft_plans.get_plan((64, 64), np.float64, nthread=1) is not plans[0]
+    fft_plans.clear_plans()
+
+def test_plan_threads():
+    rng = np.random.default_rng(2)
+    arrs = [rng.standard_normal((3, 32, 33)) for i in range(8)]
+    plan = fft_plans.get_plan(arrs[0].shape, arrs[0].dtype, nthread=1)
+
+    # threads transform arrays of the same shape at once, including
+    # misaligned views
+    arrs[1] = np.pad(arrs[1], ((0, 0), (0, 0), (1, 0)))[..., 1:]
+    with futures.ThreadPoolExecutor(max_workers=4) as executor:
+        kmaps = list(executor.map(plan, arrs))
+    for a, kmap in zip(arrs, kmaps):
+        assert np.array_equal(kmap, enfft.rfft(a, axes=[-2, -1], nthread=1))
+
+def test_rfft_engine_plans():
+    # only FFTW engines use the plan cache
+    fft_plans.clear_plans()
+    imap = np.random.default_rng(3).standard_normal((2, 16, 16))
+    kmap = utils.rfft(imap)
+    utils.irfft(kmap, n=16)
+    assert fft_plans.get_num_plans() == (2 if fft_plans.has_plans() else 0)
+    fft_plans.clear_plans()
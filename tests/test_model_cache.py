@@ -0,0 +1,41 @@
+from mnms import noise_models as nm
+import numpy as np
+
+def test_model_cache_lru():
+    cache = nm.ModelCache(max_gb=2.5e-6) # 2500 bytes
+    models = {f'model{i}': {'sqrt_cov_mat': np.zeros(100, dtype=np.float64)} for i in range(4)}
+
+    for key in ['model0', 'model1', 'model2']:
+        assert cache.put(key, models[key])
+    assert cache.nbytes == 2400
+
+    # use model0 so model1 is the least recently used
+    assert cache.get('model0') is models['model0']
+    assert cache.put('model3', models['model3'])
+    assert 'model1' not in cache
+    assert cache.get('model1') is None
+    assert cache.nbytes == 2400
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['evictions'] == 1
+
+def test_model_cache_too_big():
+    cache = nm.ModelCache(max_gb=1e-6)
+    assert not cache.put('model', {'sqrt_cov_mat': np.zeros(1000)})
+    assert len(cache) == 0
+    assert nm.get_nbytes({'a': np.zeros(10), 'b': [np.zeros(5), {'c': np.zeros(1)}]}) == 128
+
+def test_get_nbytes_memmap(tmp_path):
+    fn = tmp_path / 'arr.npy'
+    np.save(fn, np.zeros(100))
+    arr = np.load(fn, mmap_mode='r')
+
+    # memory-mapped arrays and their views are not in memory
+    assert nm.get_nbytes({'a': arr, 'b': arr[:10], 'c': np.asarray(arr)}) == 0
+    assert nm.get_nbytes({'a': arr, 'b': np.array(arr)}) == 800
+
+def test_model_cache_too_big_reported_once(capsys):
+    cache = nm.ModelCache(max_gb=1e-6)
+    for i in range(2):
+        assert not cache.put('model', {'sqrt_cov_mat': np.zeros(1000)})
+    assert capsys.readouterr().out.count('exceeds model cache budget') == 1
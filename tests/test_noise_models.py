@@ -0,0 +1,138 @@
+from mnms import noise_models as nm, soapack_utils as s_utils, simio
+import numpy as np
+import pytest
+
+from multiprocessing import shared_memory
+import os
+
+def get_tiled_model(tmp_path, monkeypatch):
+    for key in ['covmat_path', 'maps_path', 'mask_path']:
+        monkeypatch.setitem(simio.config, key, str(tmp_path / key))
+    dm = s_utils.FakeDataModel(
+        tmp_path / 'data', qids=('pa0',), num_splits=2, box_deg=[[-5, 5], [5, -5]],
+        res_arcmin=6., name='test_fake'
+        )
+    return nm.TiledNoiseModel('pa0', data_model=dm, mask_version='test_fake')
+
+def test_get_sims(tmp_path, monkeypatch):
+    model = get_tiled_model(tmp_path, monkeypatch)
+    model.get_model(0, check_on_disk=False, keep_model=True, write=False)
+
+    # draw in batches of 2
+    sim_nums = [3, 1, 4]
+    target_gb = 2.5 * model._get_sim_nbytes() / 1e9
+    assert model._get_sims_batch_size(target_gb) == 2
+
+    sims = model.get_sims(0, sim_nums, alm=False, check_on_disk=False, target_gb=target_gb)
+    assert sims.shape == (3, 1, 1, 3, 100, 100)
+    for i, sim_num in enumerate(sim_nums):
+        sim = model.get_sim(0, sim_num, alm=False, check_on_disk=False)
+        assert np.array_equal(sims[i], sim)
+
+    # sims written while iterating are read back
+    for sim_num, sim in model.iter_sims(0, sim_nums[:2], alm=False, write=True):
+        assert np.array_equal(sim, sims[sim_nums.index(sim_num)])
+    assert model.get_missing_sims([0], sim_nums, alm=False) == [(0, 4)]
+    assert np.array_equal(model.get_sims(0, sim_nums, alm=False, generate=True), sims)
+
+    # deleted sims are generated again
+    os.remove(model._get_sim_fn(0, 3, alm=False))
+    assert np.array_equal(model.get_sims(0, sim_nums, alm=False), sims)
+
+    # no sims is an empty stack
+    sims = model.get_sims(0, [], alm=False)
+    assert sims.shape == (0, 1, 1, 3, 100, 100)
+    assert model.get_sims(0, [], alm=True).shape[:4] == (0, 1, 1, 3)
+
+def test_tiled_sim_fn_rng(tmp_path, monkeypatch):
+    model = get_tiled_model(tmp_path, monkeypatch)
+    legacy_model = nm.TiledNoiseModel(
+        'pa0', data_model=model._sim_inm._data_model, mask_version='test_fake', legacy_rng=True
+        )
+
+    # only sims of the counter-based stream are tagged
+    fn = model._get_sim_fn(0, 1)
+    legacy_fn = legacy_model._get_sim_fn(0, 1)
+    assert fn != legacy_fn
+    assert fn.replace('_rngphilox', '') == legacy_fn
+
+def test_get_models(tmp_path, monkeypatch):
+    model = get_tiled_model(tmp_path, monkeypatch)
+
+    # record the shared memory blocks handed to the workers
+    names = []
+    to_shared_memory = nm._to_shared_memory
+    def _to_shared_memory(arr):
+        shm, spec = to_shared_memory(arr)
+        names.append(shm.name)
+        return shm, spec
+    monkeypatch.setattr(nm, '_to_shared_memory', _to_shared_memory)
+
+    # the ivar of split 0 is shared, that of split 1 is read by its worker
+    inm = model._model_inm
+    inm._keep_ivar(0, inm.get_ivar(0, inm.get_mask_obs()))
+    fns = model.get_models(nproc=2, check_on_disk=False)
+    assert len(names) == 3 # mask_est, mask_obs, ivar
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+    for split_num, fn in enumerate(fns):
+        assert os.path.isfile(fn)
+        nm_dict = model._check_model_on_disk(split_num, generate=False)
+        ref = get_tiled_model(tmp_path, monkeypatch).get_model(
+            split_num, check_on_disk=False, keep_model=False, write=False
+            )
+        for key in ['sqrt_cov_mat', 'sqrt_cov_ell']:
+            assert np.array_equal(nm_dict[key], ref[key])
+
+def test_get_model_target_gb(tmp_path, monkeypatch):
+    model = get_tiled_model(tmp_path, monkeypatch)
+    ref = model.get_model(0, check_on_disk=False, keep_model=False, write=False)
+
+    # the budget reaches the estimator, and does not change the model
+    budgets = []
+    get_tiled_noise_covsqrt = nm.tiled_noise.get_tiled_noise_covsqrt
+    def _get_tiled_noise_covsqrt(*args, **kwargs):
+        budgets.append(kwargs['target_gb'])
+        return get_tiled_noise_covsqrt(*args, **kwargs)
+    monkeypatch.setattr(nm.tiled_noise, 'get_tiled_noise_covsqrt', _get_tiled_noise_covsqrt)
+
+    nm_dict = model.get_model(0, check_on_disk=False, keep_model=False, write=False, target_gb=1e-4)
+    assert budgets == [1e-4]
+    for key in ['sqrt_cov_mat', 'sqrt_cov_ell']:
+        assert np.array_equal(nm_dict[key], ref[key])
+
+def test_mixture_missing_sims(tmp_path, monkeypatch):
+    model = get_tiled_model(tmp_path, monkeypatch)
+    other_model = nm.TiledNoiseModel(
+        'pa0', data_model=model._sim_inm._data_model, mask_version='test_fake', notes='other'
+        )
+    mixture = nm.HarmonicMixture([model, other_model], [100], [20])
+    assert mixture.get_missing_sims([0], [0, 1, 2]) == [(0, 0), (0, 1), (0, 2)]
+
+    def touch(fn):
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, 'wb') as f:
+            f.write(b' ' * simio.FITS_BLOCK_SIZE)
+
+    # sims are missing unless the mixture sim or all component sims exist
+    touch(model._get_sim_fn(0, 0, alm=True))
+    touch(other_model._get_sim_fn(0, 0, alm=True))
+    touch(model._get_sim_fn(0, 1, alm=True))
+    touch(mixture._get_sim_fn(0, 2, alm=True))
+    assert mixture.get_missing_sims([0], [0, 1, 2]) == [(0, 1)]
+
+def test_get_sim_pixbox(tmp_path, monkeypatch):
+    model = get_tiled_model(tmp_path, monkeypatch)
+    model.get_model(0, check_on_disk=False, keep_model=True, write=False)
+    pixbox = [[20, 30], [60, 80]]
+
+    # sims of a pixbox are never read from a full sim on-disk
+    model.get_sim(0, 1, alm=False, write=True)
+    with pytest.raises(ValueError):
+        model.get_sim(0, 1, alm=False, pixbox=pixbox)
+    sim = model.get_sim(0, 1, alm=False, check_on_disk=False, pixbox=pixbox)
+    assert sim.shape == (1, 1, 3, 40, 50)
+    os.remove(model._get_sim_fn(0, 1, alm=False))
+    assert np.array_equal(model.get_sim(0, 1, alm=False, check_on_disk=False, pixbox=pixbox), sim)
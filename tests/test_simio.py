@@ -0,0 +1,81 @@
+from mnms import simio, utils
+from pixell import enmap
+import numpy as np
+
+import os
+
+def test_sim_writer(tmp_path):
+    shape, wcs = enmap.geometry([[-1, -1], [1, 1]], res=np.deg2rad(0.1), deg=False)
+    sims = [enmap.ones((2, 3) + shape, wcs) * i for i in range(4)]
+    alm = np.arange(10, dtype=np.complex128).reshape(2, 5) * (1 + 1j)
+
+    with simio.SimWriter(nthread=2, max_pending=2) as writer:
+        for i, sim in enumerate(sims):
+            writer.submit(str(tmp_path / f'map{i}.fits'), sim)
+        writer.submit(str(tmp_path / 'alm.fits'), alm, alm=True)
+
+    for i, sim in enumerate(sims):
+        assert np.all(enmap.read_map(str(tmp_path / f'map{i}.fits')) == sim)
+    assert np.all(utils.read_alm(str(tmp_path / 'alm.fits')) == alm)
+
+    # no temporary files are left behind
+    assert sorted(os.listdir(tmp_path)) == \
+        ['alm.fits'] + [f'map{i}.fits' for i in range(4)] + [simio.SIM_MANIFEST_NAME]
+
+def test_sim_writer_error(tmp_path):
+    # a directory in the way of the sim makes the final rename fail
+    os.mkdir(tmp_path / 'map.fits')
+    writer = simio.SimWriter()
+    writer.submit(str(tmp_path / 'map.fits'), enmap.zeros((3, 3)))
+    try:
+        writer.close()
+    except OSError:
+        pass
+    else:
+        assert False, 'expected the write error to be raised'
+
+    # the temporary file is cleaned up
+    assert os.listdir(tmp_path) == ['map.fits']
+
+def test_sim_manifest(tmp_path):
+    shape, wcs = enmap.geometry([[-1, -1], [1, 1]], res=np.deg2rad(0.1), deg=False)
+    sim = enmap.ones((3,) + shape, wcs)
+    
+    # a preexisting sim, and a partially written one
+    enmap.write_map(str(tmp_path / 'map0.fits'), sim)
+    with open(tmp_path / 'map1.fits', 'wb') as f:
+        f.write(b'SIMPLE')
+    assert simio.get_sim_manifest(tmp_path) is None
+    assert simio.sim_exists(str(tmp_path / 'map1.fits'))
+
+    # the first write creates the manifest
+    simio.write_sim(str(tmp_path / 'map2.fits'), sim, checksum=True)
+    manifest = simio.get_sim_manifest(tmp_path)
+    assert manifest is not None
+    assert sorted(manifest.entries()) == ['map0.fits', 'map2.fits']
+    assert manifest.entries()['map2.fits']['checksum'] == simio.get_checksum(str(tmp_path / 'map2.fits'))
+
+    fns = [str(tmp_path / f'map{i}.fits') for i in range(4)]
+    assert simio.get_missing_sims(fns) == fns[1:2] + fns[3:]
+    assert not simio.sim_exists(fns[1])
+    assert manifest.verify() == []
+
+    os.remove(fns[2])
+    assert manifest.verify() == ['map2.fits']
+    manifest.rebuild()
+    assert simio.get_missing_sims(fns) == fns[1:]
+
+    # sims written outside write_sim are found on-disk
+    enmap.write_map(fns[3], sim)
+    assert simio.sim_exists(fns[3])
+    assert simio.get_missing_sims(fns) == fns[1:3]
+
+    # recorded sims that cannot be read are dropped from the manifest
+    simio.write_sim(fns[2], sim)
+    assert manifest.entries()['map2.fits']['checksum'] is None
+    os.remove(fns[2])
+    assert simio.sim_exists(fns[2])
+    assert simio.read_sim(fns[2]) is None
+    assert not simio.sim_exists(fns[2])
+    assert 'map2.fits' not in manifest.entries()
+    assert np.all(simio.read_sim(fns[0]) == sim)
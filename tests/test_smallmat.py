@@ -0,0 +1,41 @@
+from mnms import smallmat, utils
+import numpy as np
+import pytest
+
+def get_mats(ncomp, nsamp, npix=10_000, seed=0):
+    rng = np.random.default_rng(seed)
+    a = rng.standard_normal((ncomp, nsamp, npix))
+    a[..., :100] = 0 # masked pixels
+    return np.einsum('aip, bip -> abp', a, a) / nsamp
+
+def get_eigpow(mats, e):
+    w, v = np.linalg.eigh(np.moveaxis(mats, -1, 0))
+    w = np.where(w > 0, w, 0)
+    np.power(w, e, out=w, where=w > 0)
+    return np.moveaxis(np.einsum('pab, pb, pcb -> pac', v, w, v), 0, -1)
+
+@pytest.mark.parametrize('ncomp', [1, 2, 3, 5])
+@pytest.mark.parametrize('e', [0.5, -0.5])
+def test_eigpow(ncomp, e):
+    mats = get_mats(ncomp, 10)
+    out = smallmat.eigpow(utils.to_flat_triu(mats, axis1=0, axis2=1), e, nthread=2)
+    assert np.allclose(
+        out, utils.to_flat_triu(get_eigpow(mats, e), axis1=0, axis2=1), rtol=1e-6, atol=1e-8
+        )
+
+@pytest.mark.parametrize('ncomp', [1, 2, 4, 6])
+@pytest.mark.parametrize('nsamp', [3, 10])
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_cholesky(ncomp, nsamp, dtype):
+    # some of the matrices are singular
+    mats = get_mats(ncomp, nsamp)
+    a = utils.to_flat_triu(mats, axis1=0, axis2=1).astype(dtype)
+    out = smallmat.cholesky(a, inplace=False, nthread=2)
+    assert out.dtype == dtype
+
+    rows, cols = utils.triu_indices(ncomp)
+    r = np.zeros(mats.shape, dtype=dtype)
+    r[rows, cols] = out
+    assert np.allclose(
+        np.einsum('bap, bcp -> acp', r, r), mats, rtol=0, atol=100*np.finfo(dtype).eps*mats.max()
+        )
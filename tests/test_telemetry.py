@@ -0,0 +1,64 @@
+from mnms import telemetry
+
+import time
+
+def test_telemetry_spans(tmp_path):
+    fname = str(tmp_path / 'telemetry.jsonl')
+    telemetry.clear()
+    telemetry.enable(fname)
+    try:
+        with telemetry.span('get_model', split_num=0):
+            for i in range(2):
+                with telemetry.span('eigpow', kernel=i):
+                    time.sleep(0.01)
+    finally:
+        telemetry.disable()
+
+    # spans are recorded in the order they end, and only to the file
+    records = telemetry.read_records(fname)
+    assert [r['path'] for r in records] == ['get_model/eigpow'] * 2 + ['get_model']
+    assert [r['depth'] for r in records] == [1, 1, 0]
+    assert records[1]['attrs'] == {'kernel': 1}
+    assert records[2]['wall'] >= records[0]['wall'] + records[1]['wall']
+    assert telemetry.get_records() == []
+
+    # or only in memory
+    telemetry.enable()
+    try:
+        with telemetry.span('get_model', split_num=0):
+            for i in range(2):
+                with telemetry.span('eigpow', kernel=i):
+                    pass
+    finally:
+        telemetry.disable()
+    assert [r['path'] for r in telemetry.get_records()] == [r['path'] for r in records]
+    assert len(telemetry.read_records(fname)) == 3
+
+    summary = telemetry.summarize()
+    assert list(summary) == ['get_model', 'get_model/eigpow']
+    assert summary['get_model/eigpow']['count'] == 2
+
+    # nothing is recorded when disabled
+    with telemetry.span('get_model'):
+        pass
+    assert len(telemetry.get_records()) == 3
+    telemetry.clear()
+
+def test_telemetry_span_show(capsys):
+    telemetry.clear()
+
+    # the message is printed whether or not spans are recorded
+    with telemetry.span('get_model', show='Generating noise model'):
+        pass
+    assert capsys.readouterr().out.strip().endswith(' Generating noise model')
+    assert telemetry.get_records() == []
+
+    telemetry.enable()
+    try:
+        with telemetry.span('get_model', show='Generating noise model', split_num=0):
+            pass
+    finally:
+        telemetry.disable()
+    assert capsys.readouterr().out.strip().endswith(' Generating noise model')
+    assert telemetry.get_records()[0]['attrs'] == {'split_num': 0}
+    telemetry.clear()
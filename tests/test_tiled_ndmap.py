@@ -0,0 +1,118 @@
+from pixell import enmap
+from mnms import tiled_ndmap, utils
+import numpy as np
+import pickle
+import pytest
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+@pytest.mark.parametrize('quantize', [None, 'int16'])
+def test_write_tiled_ndmap_storage(tmp_path, compression, quantize):
+    shape, wcs = enmap.geometry([0,0], shape=(240, 480), res=np.pi/180/30)
+    rng = np.random.default_rng(0)
+    imap = enmap.ndmap(rng.standard_normal((2, *shape), dtype=np.float32), wcs)
+    imap = tiled_ndmap.tiled_ndmap(imap, width_deg=4, height_deg=4).to_tiled()
+    sqrt_cov_ell = rng.standard_normal((2, 2, 100))
+
+    fn = str(tmp_path / 'tiled.fits')
+    tiled_ndmap.write_tiled_ndmap(
+        fn, imap, extra_hdu={'SQRT_COV_ELL': sqrt_cov_ell}, compression=compression,
+        quantize=quantize
+        )
+    omap, extra_header, extra_hdu = tiled_ndmap.read_tiled_ndmap(
+        fn, extra_header=['TILED'], extra_hdu=['SQRT_COV_ELL']
+        )
+
+    assert extra_header['TILED']
+    assert np.array_equal(extra_hdu['SQRT_COV_ELL'], sqrt_cov_ell)
+    assert np.array_equal(omap.unmasked_tiles, imap.unmasked_tiles)
+    assert omap.ishape == imap.ishape
+    assert omap.dtype == np.float32
+    if quantize is None:
+        assert np.array_equal(omap, imap)
+    else:
+        assert np.max(np.abs(omap - imap)) <= np.max(np.abs(imap)) / 32767
+
+def test_from_tiled_pixbox():
+    shape, wcs = enmap.geometry([0,0], shape=(700, 900), res=np.pi/180/30)
+    rng = np.random.default_rng(0)
+    imap = enmap.ndmap(rng.standard_normal((2, *shape), dtype=np.float32), wcs)
+    mask = enmap.ones(shape, wcs)
+    mask[:200, :300] = 0
+    imap = tiled_ndmap.tiled_ndmap(imap, width_deg=4, height_deg=4)
+    imap.set_unmasked_tiles(mask)
+    imap = imap.to_tiled()
+
+    full = imap.from_tiled(power=0.5)
+    for pixbox in [[[100, 150], [400, 500]], [[650, 0], [700, 37]], [[0, 0], [700, 900]]]:
+        pixbox = np.array(pixbox)
+        sel = np.s_[..., pixbox[0, 0]:pixbox[1, 0], pixbox[0, 1]:pixbox[1, 1]]
+        omap = imap.from_tiled(power=0.5, pixbox=pixbox)
+        assert np.array_equal(omap, full[sel])
+        assert np.allclose(omap.posmap(), full[sel].posmap())
+
+        # only the overlapping tiles are needed
+        tiles = imap.get_overlapping_tiles(pixbox)
+        keep = np.isin(imap.unmasked_tiles, tiles)
+        omap = imap.sametiles(imap[keep], unmasked_tiles=tiles).from_tiled(power=0.5, pixbox=pixbox)
+        assert np.array_equal(omap, full[sel])
+
+def test_to_from_tiled():
+    # a full-sky map, so that the edge tiles wrap around in x
+    shape, wcs = enmap.fullsky_geometry(res=np.pi/180/2)
+    rng = np.random.default_rng(0)
+    imap = enmap.ndmap(rng.standard_normal((2, *shape), dtype=np.float32), wcs)
+    imap = tiled_ndmap.tiled_ndmap(imap, width_deg=20, height_deg=20)
+    tmap = imap.to_tiled(nthread=3)
+    for i, n in enumerate(tmap.unmasked_tiles):
+        p = imap._get_epixbox(n)
+        assert np.array_equal(tmap[i], enmap.extract_pixbox(imap.to_ndmap(), p, cval=0.))
+
+    # the crossfades sum to 1, and stitching does not modify the tiles
+    tiles = tmap.copy()
+    omap = tmap.from_tiled(nthread=1)
+    assert np.array_equal(tmap, tiles)
+    assert np.allclose(omap, np.asarray(imap), rtol=0, atol=1e-5)
+    assert np.array_equal(tmap.from_tiled(nthread=3), omap)
+
+def test_tiling_plan(tmp_path):
+    shape, wcs = enmap.geometry([0,0], shape=(240, 480), res=np.pi/180/30)
+    rng = np.random.default_rng(0)
+    imap = enmap.ndmap(rng.standard_normal((2, *shape), dtype=np.float32), wcs)
+    mask = enmap.ones(shape, wcs)
+    mask[:100, :150] = 0
+    imap = tiled_ndmap.tiled_ndmap(imap, width_deg=4, height_deg=4)
+    plan = imap.plan
+    assert tiled_ndmap.get_tiling_plan(shape, wcs, width_deg=4, height_deg=4) is plan
+
+    # the plan holds the tile layout and geometries
+    for n in range(imap.numy*imap.numx):
+        i, j = divmod(n, imap.numx)
+        sy, sx = i*imap.pix_height, j*imap.pix_width
+        assert np.array_equal(plan.epixboxes[n], [
+            [sy - imap.pix_pad_y, sx - imap.pix_pad_x],
+            [sy + imap.pix_height + imap.pix_pad_y, sx + imap.pix_width + imap.pix_pad_x]
+            ])
+        eshape, ewcs = imap.get_tile_geometry(n)
+        assert eshape[-2:] == plan.tile_shape
+        assert np.allclose(enmap.corners(eshape, ewcs), enmap.corners(
+            *utils.slice_geometry_by_pixbox(shape, wcs, plan.epixboxes[n])
+            ))
+
+    # masking gives a new plan that is carried by the tiled maps
+    imap.set_unmasked_tiles(mask)
+    assert imap.plan is not plan and imap.plan.get_apod(np.float32) is plan.get_apod(np.float32)
+    assert np.array_equal(imap.plan.unmasked_tiles, imap.unmasked_tiles)
+    tmap = imap.to_tiled()
+    assert tmap.plan is imap.plan
+
+    # and is stored with them
+    fn = str(tmp_path / 'tiled.fits')
+    tiled_ndmap.write_tiled_ndmap(fn, tmap, extra_hdu={'EXTRA': np.arange(3)})
+    omap, extra_hdu = tiled_ndmap.read_tiled_ndmap(fn, extra_hdu=['EXTRA'])
+    assert np.array_equal(extra_hdu['EXTRA'], np.arange(3))
+    assert np.array_equal(omap.plan.unmasked_tiles, tmap.unmasked_tiles)
+    assert np.array_equal(omap.plan.epixboxes, plan.epixboxes)
+
+    plan = pickle.loads(pickle.dumps(tmap.plan))
+    assert np.array_equal(plan.unmasked_tiles, tmap.unmasked_tiles)
+    assert np.array_equal(plan.get_apod(np.float32), tmap.apod())
@@ -0,0 +1,100 @@
+from pixell import enmap
+from mnms import tiled_ndmap, tiled_noise, utils
+import numpy as np
+
+def get_covsqrt(shape, wcs, mask, seed=0):
+    covsqrt = tiled_ndmap.tiled_ndmap(enmap.zeros(shape, wcs), width_deg=4, height_deg=4)
+    covsqrt.set_unmasked_tiles(mask)
+
+    rng = np.random.default_rng(seed)
+    ty, tx = covsqrt.pix_height + 2*covsqrt.pix_pad_y, covsqrt.pix_width + 2*covsqrt.pix_pad_x
+    return covsqrt.sametiles(
+        enmap.ndmap(rng.standard_normal((covsqrt.num_tiles, 2, 2, ty, tx//2 + 1), dtype=np.float32), wcs),
+        tiled=True
+        )
+
+def test_tiled_noise_sims_pixbox():
+    shape, wcs = enmap.geometry([0,0], shape=(400, 600), res=np.pi/180/30)
+    mask = enmap.ones(shape, wcs)
+    mask[:150, :200] = 0
+    covsqrt = get_covsqrt(shape, wcs, mask)
+
+    seeds = [[0, 1], [0, 2]]
+    full = tiled_noise.get_tiled_noise_sims(covsqrt, seeds, num_arrays=1, verbose=False)
+    pixbox = np.array([[100, 150], [300, 400]])
+    sims = tiled_noise.get_tiled_noise_sims(
+        covsqrt, seeds, num_arrays=1, pixbox=pixbox, verbose=False
+        )
+    sel = np.s_[..., pixbox[0, 0]:pixbox[1, 0], pixbox[0, 1]:pixbox[1, 1]]
+    assert np.array_equal(sims, full[sel])
+    assert np.allclose(sims.posmap(), full[sel].posmap())
+
+def test_tiled_noise_covsqrt_batches():
+    shape, wcs = enmap.geometry([[-0.15, -0.2], [0.15, 0.2]], res=np.pi/180/15, proj='car')
+    rng = np.random.default_rng(0)
+    imap = enmap.ndmap(rng.standard_normal((2, 1, 1, *shape), dtype=np.float32), wcs)
+    mask = enmap.ones(shape, wcs, dtype=np.float32)
+    mask[:40, :60] = 0
+
+    # one batch, and about one tile per batch
+    covsqrt, sqrt_cov_ell = tiled_noise.get_tiled_noise_covsqrt(
+        imap.copy(), mask_obs=mask, lmax=1000
+        )
+    covsqrt_batched, sqrt_cov_ell_batched = tiled_noise.get_tiled_noise_covsqrt(
+        imap.copy(), mask_obs=mask, lmax=1000, target_gb=1e-4
+        )
+    assert covsqrt.tiled and covsqrt.num_tiles > 1
+    assert np.array_equal(covsqrt.unmasked_tiles, covsqrt_batched.unmasked_tiles)
+    assert np.array_equal(covsqrt, covsqrt_batched)
+    assert np.array_equal(sqrt_cov_ell, sqrt_cov_ell_batched)
+
+def test_tiled_noise_sims_rng():
+    shape, wcs = enmap.geometry([0,0], shape=(400, 600), res=np.pi/180/30)
+    covsqrt = get_covsqrt(shape, wcs, enmap.ones(shape, wcs))
+    sel = covsqrt.unmasked_tiles % 3 != 0
+    covsqrt_masked = covsqrt.sametiles(covsqrt[sel], unmasked_tiles=covsqrt.unmasked_tiles[sel])
+
+    # the draws of the unmasked tiles do not depend on the mask or threads
+    seed = [0, 1]
+    sim = tiled_noise.get_tiled_noise_sim(covsqrt, num_arrays=1, seed=seed, verbose=False)
+    sim_masked = tiled_noise.get_tiled_noise_sim(
+        covsqrt_masked, num_arrays=1, seed=seed, nthread=3, verbose=False
+        )
+    # pixels outside the footprint of the masked tiles
+    ty, tx = covsqrt.pix_height + 2*covsqrt.pix_pad_y, covsqrt.pix_width + 2*covsqrt.pix_pad_x
+    footprint = covsqrt.sametiles(
+        enmap.ones((np.sum(~sel), ty, tx), wcs), unmasked_tiles=covsqrt.unmasked_tiles[~sel]
+        ).from_tiled()
+    unmasked = footprint == 0
+    assert np.any(unmasked)
+    assert np.array_equal(sim[..., unmasked], sim_masked[..., unmasked])
+
+    # the legacy stream is unchanged
+    legacy = tiled_noise.get_tiled_noise_sim(
+        covsqrt, num_arrays=1, seed=seed, legacy_rng=True, verbose=False
+        )
+    assert not np.allclose(legacy, sim)
+    assert np.allclose(np.std(legacy), np.std(sim), rtol=0.05)
+
+def test_tiled_noise_sims_flat_triu():
+    shape, wcs = enmap.geometry([0,0], shape=(400, 600), res=np.pi/180/30)
+    covsqrt = get_covsqrt(shape, wcs, enmap.ones(shape, wcs))
+    covsqrt[:] += np.swapaxes(covsqrt, 1, 2) # symmetric
+    packed = tiled_noise.pack_covsqrt(covsqrt)
+    assert packed.shape == (covsqrt.num_tiles, 3, *covsqrt.shape[-2:])
+    assert np.array_equal(packed.unmasked_tiles, covsqrt.unmasked_tiles)
+
+    seeds = [[0, 1], [0, 2]]
+    sims = tiled_noise.get_tiled_noise_sims(packed, seeds, num_arrays=1, verbose=False)
+    dense_sims = tiled_noise.get_tiled_noise_sims(covsqrt, seeds, num_arrays=1, verbose=False)
+    assert np.array_equal(sims, dense_sims)
+
+    # the matrices are only expanded for comparison
+    a = np.asarray(covsqrt)[:, None]
+    rng = np.random.default_rng(1)
+    draws = rng.standard_normal((covsqrt.num_tiles, 2, 2, *covsqrt.shape[-2:]), dtype=np.float32) + \
+        1j*rng.standard_normal((covsqrt.num_tiles, 2, 2, *covsqrt.shape[-2:]), dtype=np.float32)
+    assert np.allclose(
+        utils.symv_flat_triu(np.asarray(packed)[:, None], draws, nthread=3),
+        np.einsum('tsabyx, tsbyx -> tsayx', a, draws), rtol=1e-5, atol=1e-5
+        )